@@ -2,7 +2,12 @@ import requests
 import json
 import sys
 import os
+import socket
 import configparser
+from urllib.parse import quote, unquote, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
 
 import config
 
@@ -20,7 +25,76 @@ YELLOW = "\033[33m"
 CYAN = "\033[36m"
 
 PORT = config.get("server", "port")
-API_URL = f"http://127.0.0.1:{PORT}/"
+
+
+# Support for unix:// URLs: HTTP over a Unix domain socket
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, *args, **kwargs):
+        super().__init__("localhost", *args, **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixHTTPConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """Transport for http+unix://<quoted socket path>/ URLs"""
+
+    def __init__(self):
+        super().__init__()
+        self.pools = {}
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+        if socket_path not in self.pools:
+            self.pools[socket_path] = UnixHTTPConnectionPool(socket_path)
+        return self.pools[socket_path]
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        super().close()
+
+
+def resolve_api_url():
+    """
+    Base URL of the server: RKLLAMA_API_URL if set (http:// or unix:///path/to.sock),
+    otherwise the configured Unix socket when it exists, otherwise TCP on localhost
+    """
+    url = os.environ.get("RKLLAMA_API_URL", "")
+    if not url:
+        unix_socket = config.get("server", "unix_socket", "")
+        if unix_socket and os.path.exists(os.path.expanduser(unix_socket)):
+            url = f"unix://{os.path.abspath(os.path.expanduser(unix_socket))}"
+        else:
+            url = f"http://127.0.0.1:{PORT}"
+    if url.startswith("unix://"):
+        return f"http+unix://{quote(url[len('unix://'):], safe='')}/"
+    return url.rstrip("/") + "/"
+
+
+SESSION = requests.Session()
+SESSION.mount("http+unix://", UnixSocketAdapter())
+API_URL = resolve_api_url()
 
 
 # Displays the help menu with all available commands.
@@ -54,7 +128,7 @@ def print_help_chat():
 # Check status of rkllama API
 def check_status():
     try:
-        response = requests.get(API_URL)
+        response = SESSION.get(API_URL)
         return response.status_code
     except:
         return 500
@@ -62,7 +136,7 @@ def check_status():
 # Retrieves the list of available templates from the server.
 def list_models():
     try:
-        response = requests.get(API_URL + "models")
+        response = SESSION.get(API_URL + "models")
         if response.status_code == 200:
             models = response.json().get("models", [])
             print(f"{GREEN}{BOLD}Available models:{RESET}")
@@ -83,7 +157,7 @@ def load_model(model_name, From=None, huggingface_path=None):
         payload = {"model_name": model_name}
 
     try:
-        response = requests.post(API_URL + "load_model", json=payload)
+        response = SESSION.post(API_URL + "load_model", json=payload)
         if response.status_code == 200:
             print(f"{GREEN}{BOLD}Model {model_name} loaded successfully.{RESET}")
             return True
@@ -98,7 +172,7 @@ def load_model(model_name, From=None, huggingface_path=None):
 # Unloads the currently loaded model.
 def unload_model():
     try:
-        response = requests.post(API_URL + "unload_model")
+        response = SESSION.post(API_URL + "unload_model")
         if response.status_code == 200:
             print(f"{GREEN}{BOLD}Model successfully unloaded.{RESET}")
         else:
@@ -124,7 +198,7 @@ def send_message(message):
 
     try:
         if STREAM_MODE:
-            with requests.post(API_URL + "generate", json=payload, stream=True) as response:
+            with SESSION.post(API_URL + "generate", json=payload, stream=True) as response:
                 
                 if response.status_code == 200:
                     print(f"{CYAN}{BOLD}Assistant:{RESET} ", end="")
@@ -164,7 +238,7 @@ def send_message(message):
                     print(f"{RED}Streaming error: {response.status_code} - {response.text}{RESET}")
 
         else:
-            response = requests.post(API_URL + "generate", json=payload)
+            response = SESSION.post(API_URL + "generate", json=payload)
             if response.status_code == 200:
                 response_json = response.json()
                 assistant_message = response_json["choices"][0]["content"]
@@ -186,7 +260,7 @@ def send_message(message):
 
 # Function to change model if the old model loaded is not the same one to execute
 def switch_model(new_model):
-    response = requests.get(API_URL + "current_model")
+    response = SESSION.get(API_URL + "current_model")
     if response.status_code == 200:
         current_model = response.json().get("model_name")
 
@@ -202,14 +276,14 @@ def switch_model(new_model):
 
 # Function for remove model
 def remove_model(model):
-    response = requests.get(API_URL + "current_model")
+    response = SESSION.get(API_URL + "current_model")
     if response.status_code == 200:
         current_model = response.json().get("model_name")
         if current_model == model:
             print(f"{YELLOW}Unloading the current model before deletion: {current_model}{RESET}")
             unload_model()
 
-    response_rm = requests.delete(API_URL + "remove", json={"model": model})
+    response_rm = SESSION.delete(API_URL + "remove", json={"model": model})
 
     if response_rm.status_code == 200:
         print(f"{GREEN}The model has been successfully deleted!{RESET}")
@@ -225,7 +299,7 @@ def pull_model(model):
     model = repo + "/" + filename
 
     try:
-        response = requests.post(API_URL + "pull", json={"model": model}, stream=True)
+        response = SESSION.post(API_URL + "pull", json={"model": model}, stream=True)
 
         if response.status_code != 200:
             print(f"{RED}Error: Received status code {response.status_code}.{RESET}")
@@ -323,7 +397,7 @@ def show_model_info(model_name):
         data = {"name": model_name}
         
         # Envoyer la requête POST à l'endpoint /api/show
-        response = requests.post(API_URL + "api/show", json=data)
+        response = SESSION.post(API_URL + "api/show", json=data)
         
         if response.status_code == 200:
             model_info = response.json()
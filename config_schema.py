@@ -244,6 +244,10 @@ def create_rkllama_schema() -> ConfigSchema:
     server.integer("port", 8080, "Server port number", min_value=1, max_value=65535)
     server.string("host", "0.0.0.0", "Server host address")
     server.boolean("debug", False, "Enable debug mode")
+    server.string("mode", "flask", "Server stack: threaded Flask server or asyncio (ASGI, requires uvicorn)",
+                 options=["flask", "asgi"])
+    server.integer("worker_threads", 32, "Threads running Flask views in ASGI mode", min_value=1)
+    server.string("unix_socket", "", "Unix domain socket path to listen on in addition to TCP (empty to disable)")
     
     # Paths section
     paths = schema.add_section("paths", description="Path configuration")
@@ -257,6 +261,79 @@ def create_rkllama_schema() -> ConfigSchema:
     # Model section
     model = schema.add_section("model", description="Model configuration")
     model.string("default", "", "Default model to use")
+    model.string("catalog_watch", "inotify", "How the model catalog notices changes to the models directory",
+                options=["inotify", "poll", "off"])
+    model.float("catalog_poll_seconds", 30.0, "Interval of the models directory scans when polling", min_value=1.0)
+    model.boolean("digest_enabled", True, "Compute SHA-256 digests of model files in the background")
+    model.integer("digest_rate_mb", 64, "Read rate limit of the digest computation in MB/s (0 for unlimited)",
+                 min_value=0)
+    model.boolean("blob_store", True, "Store model weights once by digest and link them into model directories")
+    
+    # Download section
+    download = schema.add_section("download", description="Model downloads")
+    download.integer("connections", 4, "Parallel ranged connections per download", min_value=1, max_value=16)
+    download.integer("retries", 5, "Consecutive failed requests before a download is abandoned", min_value=0)
+    download.integer("buffer_kb", 1024, "Size of the network reads and file writes in KB", min_value=8)
+    download.integer("max_concurrent", 1, "Pulls downloading at the same time, others wait in a queue", min_value=1)
+    download.float("max_bandwidth_mb", 0.0, "Bandwidth limit shared by all downloads in MB/s (0 for unlimited)",
+                  min_value=0.0)
+    download.boolean("idle_io_priority", True, "Run downloads in the idle I/O scheduling class")
+    download.string("peers", "", "Comma-separated URLs of RKLLAMA servers to pull model files from before the Hub")
+    download.float("peer_timeout", 2.0, "Timeout of the peer lookups in seconds", min_value=0.1)
+    download.boolean("serve_peers", False, "Serve model files, unauthenticated, to peers pulling them from this server")
+    download.float("progress_interval", 0.5, "Minimum interval between two progress events of a pull in seconds",
+                  min_value=0.05)
+    
+    # Hugging Face section
+    huggingface = schema.add_section("huggingface", description="Hugging Face API access")
+    huggingface.boolean("offline", False, "Never contact the Hugging Face API, serve cached model metadata only")
+    huggingface.float("metadata_ttl_hours", 24.0, "Age after which cached model metadata is refreshed in the background",
+                      min_value=0.0)
+    huggingface.float("timeout", 5.0, "Timeout of the Hugging Face API requests in seconds", min_value=0.5)
+    
+    # Response cache section
+    cache = schema.add_section("cache", description="Deterministic response cache")
+    cache.boolean("enabled", False, "Cache completions of identical prompts (greedy decoding only)")
+    cache.integer("memory_size_mb", 64, "Maximum size of the in-memory cache tier in MB", min_value=0)
+    cache.integer("disk_size_mb", 1024, "Maximum size of the on-disk cache tier in MB", min_value=0)
+    
+    # Scheduler section
+    scheduler = schema.add_section("scheduler", description="NPU request scheduling")
+    scheduler.string("default_lane", "interactive", "Lane of requests without a priority",
+                    options=["interactive", "batch"])
+    scheduler.float("aging_seconds", 60.0, "Wait after which a batch request is served as interactive",
+                   min_value=0.0)
+    scheduler.list("api_keys", [], "API key mappings as key:lane[:weight]")
+    scheduler.string("policy", "fair", "Order of requests within a lane",
+                    options=["fair", "sjf"])
+    scheduler.float("keepalive_seconds", 5.0, "Interval of queue updates sent to waiting streams",
+                   min_value=0.1)
+    
+    # Streaming section
+    streaming = schema.add_section("streaming", description="Streamed response delivery")
+    streaming.integer("coalesce_tokens", 1, "Tokens grouped in a streamed chunk", min_value=1)
+    streaming.float("coalesce_ms", 0.0, "Maximum age of a buffered token before its chunk is sent (0 disables)",
+                   min_value=0.0)
+    streaming.boolean("coalesce_on_boundary", False, "Send the chunk after a newline or punctuation")
+    streaming.float("heartbeat_seconds", 5.0, "Silence after which an empty chunk is streamed (0 disables)",
+                   min_value=0.0)
+    streaming.boolean("heartbeat_details", True, "Add the queue position or prefill progress to empty chunks")
+    streaming.boolean("resume_enabled", True, "Keep streamed generations running after a disconnect for reconnects")
+    streaming.float("resume_grace_seconds", 30.0, "How long a stream is kept without readers or after it ended",
+                   min_value=0.0)
+    streaming.integer("resume_buffer_mb", 16, "Maximum size of the retained stream buffers in MB", min_value=1)
+    
+    # Compression section
+    compression = schema.add_section("compression", description="HTTP response compression")
+    compression.boolean("enabled", True, "Compress responses for clients sending Accept-Encoding gzip or deflate")
+    compression.integer("level", 1, "zlib compression level", min_value=1, max_value=9)
+    compression.integer("min_size_kb", 1, "Minimum size of a non-streamed response to compress in KB",
+                       min_value=0)
+    
+    # NPU worker section
+    worker = schema.add_section("worker", description="NPU worker process")
+    worker.boolean("enabled", False, "Run the RKLLM runtime in a supervised worker process")
+    worker.integer("ring_buffer_kb", 256, "Size of the shared memory token buffer in KB", min_value=4)
     
     # Platform section
     platform = schema.add_section("platform", description="Platform configuration")
@@ -1,12 +1,18 @@
 # Import libs
-import sys, os, subprocess, resource, argparse, shutil, time, requests, configparser, json, threading, datetime, logging
+import sys, os, subprocess, resource, argparse, shutil, time, configparser, json, threading, datetime, logging
 import re
-from dotenv import load_dotenv
 from huggingface_hub import hf_hub_url, HfFileSystem
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response, send_file
 from flask_cors import CORS
+from werkzeug.datastructures import Headers
 from transformers import AutoTokenizer
 
+# Optional: WebSocket chat sessions in Flask mode
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+
 # Local file
 from src.classes import *
 from src.rkllm import *
@@ -14,9 +20,28 @@ from src.process import Request
 import src.variables as variables
 from src.server_utils import process_ollama_chat_request, process_ollama_generate_request
 from src.debug_utils import StreamDebugger, check_response_format
+from src.inflight import request_fingerprint, is_deterministic
+import src.inflight as inflight
+import src.resumable as resumable
+import src.compression as compression
+from src.model_catalog import catalog
+from src.model_index import index as model_index
+from src.blob_store import blobs
+from src.downloader import Download, DownloadError
+from src.peers import peers
+from src.hf_metadata import metadata as hf_metadata_cache
+from src.model_metadata import cache as model_metadata_cache
+from src.modelfile import cache as modelfile_cache, ModelfileConfig, ModelfileError
+from src.pull_jobs import jobs as pull_jobs
+from src.chat_session import ChatSession, WEBSOCKET_PATH, is_cancel
+import src.metrics as metrics
+from src.response_cache import cache as response_cache
+from src.scheduler import scheduler, ticket_for_request
+from src.npu_worker import RKLLMProxy
+import src.npu_worker as npu_worker
 from src.model_utils import (
-    get_simplified_model_name, get_original_model_path, extract_model_details, 
-    initialize_model_mappings, find_model_by_name, get_huggingface_model_info,
+    get_simplified_model_name, get_original_model_path, 
+    find_model_by_name,
     get_context_length
 )
 
@@ -26,6 +51,9 @@ import config
 # Check for debug mode using the improved method
 DEBUG_MODE = config.is_debug_mode()
 
+# Model files are served to the other RKLLAMA servers of the LAN
+SERVE_PEERS = config.get("download", "serve_peers", False, as_type=bool)
+
 # Ensure logs directory exists before configuring logging
 logs_dir = config.get_path("logs")
 os.makedirs(logs_dir, exist_ok=True)
@@ -96,23 +124,34 @@ def load_model(model_name, huggingface_path=None, system="", temperature=1.0, Fr
         time.sleep(0.1)
     
     # Load modelfile
-    load_dotenv(os.path.join(model_dir, "Modelfile"), override=True)
-    
-    from_value = os.getenv("FROM")
-    huggingface_path = os.getenv("HUGGINGFACE_PATH")
+    modelfile = modelfile_cache.get(os.path.join(model_dir, "Modelfile"))
+    if modelfile is None:
+        return None, f"Modelfile not found in '{model_name}' directory."
+    try:
+        modelfile.validate()
+    except ModelfileError as e:
+        return None, str(e)
+
+    from_value = modelfile.model_file
+    huggingface_path = modelfile.huggingface_path
 
     # View config Vars
     print_color(f"FROM: {from_value}\nHuggingFace Path: {huggingface_path}", "green")
-    
-    if not from_value or not huggingface_path:
-        return None, "FROM or HUGGINGFACE_PATH not defined in Modelfile."
 
     # Change value of model_id with huggingface_path
     variables.model_id = huggingface_path
+    # The context the model was exported with, guessed from its family when unknown
+    metadata = model_metadata_cache.get(os.path.join(model_dir, from_value), model_dir, huggingface_path) or {}
     context_length = get_context_length(model_name, config.get_path("models"))
+    if metadata.get("context_length"):
+        logger.info(f"Using the context length of the {from_value} header: {metadata['context_length']} "
+                    f"instead of {context_length}")
+        context_length = metadata["context_length"]
 
     
-    modele_rkllm = RKLLM(os.path.join(model_dir, from_value), model_dir, temperature=float(temperature), context_length=context_length)
+    # The NPU runtime runs in a supervised worker process when enabled
+    model_class = RKLLMProxy if npu_worker.is_enabled() else RKLLM
+    modele_rkllm = model_class(os.path.join(model_dir, from_value), model_dir, temperature=float(temperature), context_length=context_length)
     return modele_rkllm, None
 
 def unload_model():
@@ -121,10 +160,33 @@ def unload_model():
         modele_rkllm.release()
         modele_rkllm = None
 
+def ensure_model_loaded(model_name):
+    """Resolve a model name and load the model if needed, returns (model, full model name)"""
+    global modele_rkllm, current_model
+    
+    full_model_name = find_model_by_name(model_name)
+    if not full_model_name:
+        raise ValueError(f"Model '{model_name}' not found")
+    
+    if current_model != full_model_name:
+        if current_model:
+            unload_model()
+        modele_instance, error = load_model(full_model_name)
+        if error:
+            raise RuntimeError(f"Failed to load model '{full_model_name}': {error}")
+        modele_rkllm = modele_instance
+        current_model = full_model_name
+    return modele_rkllm, full_model_name
+
 app = Flask(__name__)
 # Enable CORS for all routes
 CORS(app)
 
+@app.after_request
+def compress_response(response):
+    # Negotiated gzip/deflate, streamed responses are flushed chunk by chunk
+    return compression.compress_response(response, request.headers.get("Accept-Encoding"))
+
 # Original RKLLAMA Routes:
 # GET    /models
 # POST   /load_model
@@ -136,32 +198,12 @@ CORS(app)
 # Route to view models
 @app.route('/models', methods=['GET'])
 def list_models():
-    # Return the list of available models using config path
-    models_dir = config.get_path("models")
-    
-    if not os.path.exists(models_dir):
-        return jsonify({"error": f"The models directory {models_dir} is not found."}), 500
+    # Return the list of available models from the catalog
+    # (loose .rkllm files are moved into their own directory when it refreshes)
+    if not catalog.available:
+        return jsonify({"error": f"The models directory {catalog.models_dir} is not found."}), 500
 
-    direct_models = [f for f in os.listdir(models_dir) if f.endswith(".rkllm")]
-
-    for model in direct_models:
-        model_name = os.path.splitext(model)[0]
-        model_dir = os.path.join(models_dir, model_name)
-        
-        os.makedirs(model_dir, exist_ok=True)
-        
-        shutil.move(os.path.join(models_dir, model), os.path.join(model_dir, model))
-    
-    model_dirs = []
-    for subdir in os.listdir(models_dir):
-        subdir_path = os.path.join(models_dir, subdir)
-        if os.path.isdir(subdir_path):
-            for file in os.listdir(subdir_path):
-                if file.endswith(".rkllm"):
-                    model_dirs.append(subdir)
-                    break
-
-    return jsonify({"models": model_dirs}), 200
+    return jsonify({"models": [entry["name"] for entry in catalog.models()]}), 200
 
 # Delete a model
 @app.route('/rm', methods=['DELETE'])
@@ -176,78 +218,106 @@ def Rm_model():
 
     os.remove(model_path)
 
-    initialize_model_mappings()
+    catalog.refresh()
+    blobs.collect()
 
     return jsonify({"message": f"The model has been successfully deleted!"}), 200
 
-# route to pull a model
-@app.route('/pull', methods=['POST'])
-def pull_model():
-    @stream_with_context
-    def generate_progress():
-        data = request.json
-        if "model" not in data:
-            yield "Error: Model not specified.\n"
-            return
-
-        splitted = data["model"].split('/')
-        if len(splitted) < 3:
-            yield f"Error: Invalid path '{data['model']}'\n"
-            return
+def run_pull(job):
+    """Download a model file from LAN peers or Hugging Face, run in the background by a pull job"""
+    file = job.model.split('/')[2]
+    repo = job.model.replace(f"/{file}", "")
 
-        file = splitted[2]
-        repo = data["model"].replace(f"/{file}", "")
+    # Use Hugging Face HfFileSystem to get the file metadata
+    try:
+        fs = HfFileSystem()
+        file_info = fs.info(repo + "/" + file)
+    except Exception as e:
+        if not peers.urls:
+            raise
+        # Peers are looked up by repo and file name instead of digest
+        logger.warning(f"Hugging Face metadata of {file} unavailable ({e}), asking peers only")
+        file_info = None
+    if file_info is not None and file_info["size"] == 0:
+        raise ValueError("Unable to retrieve file size.")
+
+    # Use config to get models path
+    model_dir = os.path.join(config.get_path("models"), file.replace('.rkllm', ''))
+    os.makedirs(model_dir, exist_ok=True)
 
+    # Define a file to download
+    local_filename = os.path.join(model_dir, file)
+
+    # Create fonfiguration file for model
+    create_modelfile(huggingface_path=repo, From=file)
+
+    sha256 = (file_info.get("lfs") or {}).get("sha256") if file_info else None
+    if sha256 and model_index.digest(local_filename) == sha256:
+        # Already downloaded and unchanged
+        job.update(digest=f"sha256:{sha256}")
+        return
+
+    # Ranged, parallel and resumable download into a .part file, renamed once verified
+    download = None
+    source = peers.locate(job.model, sha256)
+    if source is not None:
+        logger.info(f"Pulling {file} from peer {source['peer']}")
+        job.update(source=source["peer"])
+        download = Download.from_config(source["url"], local_filename, sha256=source["sha256"])
         try:
-            # Use Hugging Face HfFileSystem to get the file metadata
-            fs = HfFileSystem()
-            file_info = fs.info(repo + "/" + file)
-
-            total_size = file_info["size"]  # File size in bytes
-            if total_size == 0:
-                yield "Error: Unable to retrieve file size.\n"
-                return
-
-            # Use config to get models path
-            model_dir = os.path.join(config.get_path("models"), file.replace('.rkllm', ''))
-            os.makedirs(model_dir, exist_ok=True)
-
-            # Define a file to download
-            local_filename = os.path.join(model_dir, file)
-
-            # Create fonfiguration file for model
-            create_modelfile(huggingface_path=repo, From=file)
+            job.track(download)
+        except DownloadError as e:
+            if job.cancelled or file_info is None:
+                raise
+            # What the peer sent is kept when the digest is known, the Hub download resumes it
+            logger.warning(f"Pull of {file} from peer {source['peer']} failed ({e}), falling back to Hugging Face")
+            download = None
+
+    if download is None:
+        if file_info is None:
+            raise ValueError(f"{file} is not available from peers and Hugging Face is unreachable")
+        job.update(source="huggingface")
+        download = Download.from_config(hf_hub_url(repo_id=repo, filename=file), local_filename, sha256=sha256)
+        job.track(download)
+
+    if download.verified:
+        model_index.record(local_filename, download.sha256)
+
+    job.update(status="writing manifest")
+    catalog.refresh()
+
+def start_pull(model):
+    """Start pulling a model, or join its pull in progress, returns (job, error)"""
+    if not model:
+        return None, "Model not specified."
+    if len(model.split('/')) < 3:
+        return None, f"Invalid path '{model}'"
+    return pull_jobs.start(model, run_pull), None
+
+def pull_text_progress(job):
+    """Progress of a pull job as the text lines of /pull"""
+    announced = False
+    for event in job.events():
+        if "error" in event:
+            yield f"Error: {event['error']}\n"
+        elif "total" in event:
+            if not announced:
+                announced = True
+                yield f"Downloading {job.model.split('/')[-1]} ({event['total'] / (1024**2):.2f} MB)...\n"
+            yield f"{int(event['completed'] / event['total'] * 100)}%\n"
+        elif event["status"] == "success":
+            yield "100%\n"
 
-            yield f"Downloading {file} ({total_size / (1024**2):.2f} MB)...\n"
+# route to pull a model
+@app.route('/pull', methods=['POST'])
+def pull_model():
+    data = request.json or {}
+    job, error = start_pull(data.get("model"))
+    if error:
+        return Response(f"Error: {error}\n", content_type='text/plain')
 
-            try:
-                # Download the file with progress
-                url = hf_hub_url(repo_id=repo, filename=file)
-                with requests.get(url, stream=True) as r, open(local_filename, "wb") as f:
-                    downloaded_size = 0
-                    chunk_size = 8192  # 8KB
-
-                    for chunk in r.iter_content(chunk_size=chunk_size):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded_size += len(chunk)
-                            progress = int((downloaded_size / total_size) * 100)
-                            yield f"{progress}%\n"
-
-            except Exception as download_error:
-                # Remove the file if an error occurs during download
-                if os.path.exists(local_filename):
-                    os.remove(local_filename)
-                yield f"Error during download: {str(download_error)}\n"
-                return
-
-        except Exception as e:
-            yield f"Error: {str(e)}\n"
-
-    # Use the appropriate content type for streaming responses
-    is_ollama_request = request.path.startswith('/api/')
-    content_type = 'application/x-ndjson' if is_ollama_request else 'text/plain'
-    return Response(generate_progress(), content_type=content_type)
+    # Several clients pulling the same model watch a single download
+    return Response(pull_text_progress(job), content_type='text/plain')
 
 # Route for loading a model into the NPU
 @app.route('/load_model', methods=['POST'])
@@ -311,49 +381,46 @@ def recevoir_message():
     # define modelfile path
     modelfile = os.path.join(modele_rkllm.model_dir, "Modelfile")
 
-    variables.verrou.acquire()
-    return Request(modele_rkllm, modelfile)
+    # Queued with the other NPU requests, the ticket holds variables.verrou
+    ticket = ticket_for_request(request.headers, request.remote_addr)
+    scheduler.wait(ticket)
+    try:
+        result = Request(modele_rkllm, modelfile, custom_request=request)
+    except BaseException:
+        scheduler.release(ticket)
+        raise
+    response = result[0] if isinstance(result, tuple) else result
+    if getattr(response, "is_streamed", False):
+        # The NPU is held until the stream has been sent
+        response.call_on_close(lambda: scheduler.release(ticket))
+    else:
+        scheduler.release(ticket)
+    return result
 
 # Ollama API compatibility routes
 
 @app.route('/api/tags', methods=['GET'])
 def list_ollama_models():
-    # Return models in Ollama API format
-    models_dir = config.get_path("models")
-    
-    if not os.path.exists(models_dir):
-        return jsonify({"models": []}), 200
-
+    # Return models in Ollama API format, from the catalog (no directory scan)
     models = []
-    for subdir in os.listdir(models_dir):
-        subdir_path = os.path.join(models_dir, subdir)
-        if os.path.isdir(subdir_path):
-            for file in os.listdir(subdir_path):
-                if file.endswith(".rkllm"):
-                    size = os.path.getsize(os.path.join(subdir_path, file))
-                    
-                    # Generate a simplified model name in Ollama style
-                    simple_name = get_simplified_model_name(subdir)
-                    
-                    # Extract parameter size and quantization details if available
-                    model_details = extract_model_details(subdir)
-                    
-                    models.append({
-                        "name": simple_name,        # Use simplified name like qwen:3b
-                        "model": simple_name,       # Match Ollama's format
-                        "modified_at": datetime.datetime.fromtimestamp(
-                            os.path.getmtime(os.path.join(subdir_path, file))
-                        ).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-                        "size": size,
-                        "digest": "",               # Ollama field (not used but included for compatibility)
-                        "details": {
-                            "format": "rkllm",
-                            "family": "llama",      # Default family
-                            "parameter_size": model_details.get("parameter_size", "Unknown"),
-                            "quantization_level": model_details.get("quantization_level", "Unknown")
-                        }
-                    })
-                    break
+    for entry in catalog.models():
+        # Simplified model name in Ollama style, parameter size and quantization details
+        simple_name = entry["simple_name"]
+        model_details = entry["details"]
+        
+        models.append({
+            "name": simple_name,        # Use simplified name like qwen:3b
+            "model": simple_name,       # Match Ollama's format
+            "modified_at": datetime.datetime.fromtimestamp(entry["mtime"]).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "size": entry["size"],
+            "digest": model_index.digest(entry["path"]) or "",  # Empty until the file is hashed
+            "details": {
+                "format": "rkllm",
+                "family": "llama",      # Default family
+                "parameter_size": model_details.get("parameter_size", "Unknown"),
+                "quantization_level": model_details.get("quantization_level", "Unknown")
+            }
+        })
 
     return jsonify({"models": models}), 200
 
@@ -370,67 +437,47 @@ def show_model_info():
     if original_model_path:
         model_name = original_model_path
         
-    model_dir = os.path.join(config.get_path("models"), model_name)
-    
-    if not os.path.exists(model_dir):
+    entry = catalog.get(model_name)
+    if entry is None:
         return jsonify({"error": f"Model '{model_name}' not found"}), 404
 
-    # Read modelfile content if available
-    modelfile_path = os.path.join(model_dir, "Modelfile")
-    modelfile_content = ""
-    system_prompt = ""
-    template = "{{ .Prompt }}"
-    license_text = ""
-    huggingface_path = None
-    temperature = 0.8  # Default temperature
-    
-    if os.path.exists(modelfile_path):
-        with open(modelfile_path, "r") as f:
-            modelfile_content = f.read()
-            
-            # Extract system prompt if available
-            system_match = re.search(r'SYSTEM="(.*?)"', modelfile_content, re.DOTALL)
-            if system_match:
-                system_prompt = system_match.group(1).strip()
-            
-            # Check for template pattern
-            template_match = re.search(r'TEMPLATE="(.*?)"', modelfile_content, re.DOTALL)
-            if template_match:
-                template = template_match.group(1).strip()
-            
-            # Check for LICENSE pattern (some modelfiles have this)
-            license_match = re.search(r'LICENSE="(.*?)"', modelfile_content, re.DOTALL)
-            if license_match:
-                license_text = license_match.group(1).strip()
-            
-            # Extract HuggingFace path for API access
-            hf_path_match = re.search(r'HUGGINGFACE_PATH="(.*?)"', modelfile_content, re.DOTALL)
-            if hf_path_match:
-                huggingface_path = hf_path_match.group(1).strip()
-            
-            # Extract temperature if available
-            temp_match = re.search(r'TEMPERATURE=(\d+\.?\d*)', modelfile_content)
-            if temp_match:
-                try:
-                    temperature = float(temp_match.group(1))
-                except ValueError:
-                    pass
-    
-    # Find the .rkllm file
-    model_file = None
-    for file in os.listdir(model_dir):
-        if file.endswith(".rkllm"):
-            model_file = file
-            break
-    
-    if not model_file:
-        return jsonify({"error": f"Model file not found in '{model_name}' directory"}), 404
-    
-    file_path = os.path.join(model_dir, model_file)
-    size = os.path.getsize(file_path)
+    cached = show_responses.get(model_name)
+    if cached is not None:
+        huggingface_path = cached["huggingface_path"]
+        # Serves the cached metadata, refreshed in the background once stale
+        hf_metadata_cache.get(huggingface_path)
+        if cached["signature"] == show_signature(entry, huggingface_path):
+            metrics.increment("show.hits")
+            return jsonify(cached["response"]), 200
+
+    response, huggingface_path = build_show_response(model_name, entry)
+    show_responses[model_name] = {"signature": show_signature(entry, huggingface_path),
+                                  "huggingface_path": huggingface_path, "response": response}
+    return jsonify(response), 200
+
+# /api/show responses by model, rebuilt when the signature of the model changes
+show_responses = {}
+
+def show_signature(entry, huggingface_path):
+    """What an /api/show response depends on: model file, Modelfile, digest, config.json and Hugging Face metadata"""
+    metadata = model_metadata_cache.get(entry["path"], entry["dir"], huggingface_path) or {}
+    return (entry["mtime"], entry["modelfile_mtime"], model_index.digest(entry["path"]),
+            hf_metadata_cache.fetched_at(huggingface_path), metadata.get("extracted_at"))
+
+def build_show_response(model_name, entry):
+    """Assemble the /api/show response of a model, returns (response, Hugging Face path)"""
+    # Modelfile settings, parsed again only when the file changes
+    modelfile = modelfile_cache.get(os.path.join(entry["dir"], "Modelfile")) or ModelfileConfig({})
+    system_prompt = modelfile.system.strip()
+    template = (modelfile.template or "{{ .Prompt }}").strip()
+    license_text = modelfile.license.strip()
+    huggingface_path = modelfile.huggingface_path
+    temperature = modelfile.temperature if modelfile.temperature is not None else 0.8  # Default temperature
+
+    size = entry["size"]
     
     # Extract model details
-    model_details = extract_model_details(model_name)
+    model_details = entry["details"]
     parameter_size = model_details.get("parameter_size", "Unknown")
     quantization_level = model_details.get("quantization_level", "Unknown")
     
@@ -438,8 +485,8 @@ def show_model_info():
     family = "llama"  # default family
     families = ["llama"]
     
-    # Try to get enhanced information from Hugging Face API
-    hf_metadata = get_huggingface_model_info(huggingface_path) if huggingface_path else None
+    # Enhanced information from Hugging Face, cached on disk
+    hf_metadata = hf_metadata_cache.get(huggingface_path) if huggingface_path else None
     
     # Use HF metadata to improve model info if available
     if hf_metadata:
@@ -536,7 +583,7 @@ def show_model_info():
     
     if DEBUG_MODE:
         # In debug mode, use absolute paths to help with troubleshooting
-        model_blob_path = f"{model_dir}/{model_file}"
+        model_blob_path = entry["path"]
         ollama_modelfile += f"FROM {model_blob_path}\n"
     else:
         # In normal mode, use the simplified name format that Ollama clients expect
@@ -654,8 +701,15 @@ def show_model_info():
         # Default to English
         model_info["general.languages"] = ["en"]
     
-    # Add architecture-specific parameters based on model family
-    if family == "qwen2":
+    # Architecture parameters read from the model file and its config.json, else guessed from the family
+    metadata = model_metadata_cache.get(entry["path"], entry["dir"], huggingface_path) or {}
+    if metadata.get("quantization"):
+        quantization_level = metadata["quantization"]
+    if metadata.get("architecture"):
+        model_info["general.architecture"] = metadata["architecture"]
+        model_info.update({f"{metadata['architecture']}.{name}": value
+                           for name, value in metadata["model_info"].items()})
+    elif family == "qwen2":
         model_info.update({
             "qwen2.attention.head_count": 16,
             "qwen2.attention.head_count_kv": 2,
@@ -687,11 +741,11 @@ def show_model_info():
             "mistral.embedding_length": 4096,
             "mistral.feed_forward_length": 14336
         })
+    if metadata.get("context_length") and not metadata.get("architecture"):
+        model_info[f"{family}.context_length"] = metadata["context_length"]
     
     # Calculate modified timestamp
-    modified_at = datetime.datetime.fromtimestamp(
-        os.path.getmtime(file_path)
-    ).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    modified_at = datetime.datetime.fromtimestamp(entry["mtime"]).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
     
     # Format parameters string nicely
     parameters_str = parameter_size
@@ -719,6 +773,7 @@ def show_model_info():
         },
         "model_info": model_info,
         "size": size,
+        "digest": model_index.digest(entry["path"]) or "",
         "modified_at": modified_at
     }
     
@@ -732,7 +787,7 @@ def show_model_info():
             "likes": hf_metadata.get('likes', 0)
         }
     
-    return jsonify(response), 200
+    return response, huggingface_path
 
 @app.route('/api/create', methods=['POST'])
 def create_model():
@@ -750,33 +805,103 @@ def create_model():
         f.write(modelfile)
     
     # Parse the modelfile to extract parameters
-    modelfile_lines = modelfile.strip().split('\n')
-    from_line = next((line for line in modelfile_lines if line.startswith('FROM=')), None)
-    huggingface_path = next((line for line in modelfile_lines if line.startswith('HUGGINGFACE_PATH=')), None)
+    model_config = ModelfileConfig.parse(modelfile)
+    try:
+        model_config.validate()
+    except ModelfileError as e:
+        return jsonify({"error": f"Invalid Modelfile: {e}"}), 400
     
-    if not from_line or not huggingface_path:
-        return jsonify({"error": "Invalid Modelfile: missing FROM or HUGGINGFACE_PATH"}), 400
+    from_value = model_config.model_file
     
-    # Extract values
-    from_value = from_line.split('=')[1].strip('"\'')
-    huggingface_path = huggingface_path.split('=')[1].strip('"\'')
+    # Weights already present in another model are linked rather than copied
+    link_model_weights(model_dir, from_value)
+    catalog.refresh()
     
     # For compatibility with existing implementation
     return jsonify({"status": "success", "model": model_name}), 200
 
+def link_model_weights(model_dir, file_name):
+    """Link the .rkllm file named by FROM into a model directory from a model holding it"""
+    destination = os.path.join(model_dir, file_name)
+    if os.path.exists(destination):
+        return True
+    source = next((entry["path"] for entry in catalog.models() if entry["file"] == file_name), None)
+    if source is None:
+        return False
+    blobs.link(source, destination)
+    return True
+
+@app.route('/api/copy', methods=['POST'])
+def copy_model_ollama():
+    data = request.json or {}
+    source = data.get('source')
+    destination = data.get('destination')
+    
+    if not source or not destination:
+        return jsonify({"error": "Missing source or destination"}), 400
+    if os.path.basename(destination) != destination:
+        return jsonify({"error": f"Invalid destination name '{destination}'"}), 400
+    
+    full_model_name = find_model_by_name(source)
+    entry = catalog.get(full_model_name) if full_model_name else None
+    if entry is None:
+        return jsonify({"error": f"Model '{source}' not found"}), 404
+    
+    destination_dir = os.path.join(config.get_path("models"), destination)
+    if os.path.exists(destination_dir):
+        return jsonify({"error": f"Model '{destination}' already exists"}), 400
+    
+    try:
+        os.makedirs(destination_dir)
+        # The weights are linked to the same blob, only the Modelfile is copied
+        method = blobs.link(entry["path"], os.path.join(destination_dir, entry["file"]))
+        if entry["modelfile"]:
+            with open(os.path.join(destination_dir, "Modelfile"), "w") as f:
+                f.write(entry["modelfile"])
+    except Exception as e:
+        shutil.rmtree(destination_dir, ignore_errors=True)
+        logger.error(f"Failed to copy model '{full_model_name}': {str(e)}")
+        return jsonify({"error": f"Failed to copy model: {str(e)}"}), 500
+    
+    if DEBUG_MODE:
+        logger.debug(f"Copied model '{full_model_name}' to '{destination}' ({method})")
+    catalog.refresh()
+    return jsonify({}), 200
+
 @app.route('/api/pull', methods=['POST'])
 def pull_model_ollama():
-    # TODO: Implement the pull model
-    data = request.json
-    model = data.get('name')
+    data = request.json or {}
+    model = data.get('model') or data.get('name')
     
     if not model:
         return jsonify({"error": "Missing model name"}), 400
 
-    # Ollama API uses application/x-ndjson for streaming
-    response_stream = pull_model()  # Call the existing function directly
-    response_stream.content_type = 'application/x-ndjson'
-    return response_stream
+    job, error = start_pull(model)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not data.get('stream', True):
+        job.wait()
+        return jsonify(job.event()), 500 if job.error else 200
+
+    # Ollama progress events ({status, digest, total, completed}), throttled by the job
+    return Response((f"{json.dumps(event)}\n" for event in job.events()), content_type='application/x-ndjson')
+
+# Pull queue: queued, running and recently finished pulls
+@app.route('/api/pulls', methods=['GET'])
+def list_pulls():
+    return jsonify({"pulls": pull_jobs.list()}), 200
+
+@app.route('/api/pulls', methods=['DELETE'])
+def cancel_pull():
+    data = request.json or {}
+    model = data.get('model') or data.get('name')
+    
+    if not model:
+        return jsonify({"error": "Missing model name"}), 400
+    if not pull_jobs.cancel(model):
+        return jsonify({"error": f"No pull of '{model}' in progress"}), 404
+    return jsonify({}), 200
 
 @app.route('/api/delete', methods=['DELETE'])
 def delete_model_ollama():
@@ -808,7 +933,9 @@ def delete_model_ollama():
             logger.debug(f"Deleting model directory: {model_path}")
         shutil.rmtree(model_path)
         
-        initialize_model_mappings()
+        catalog.refresh()
+        # Weights shared with other models stay until their last model is deleted
+        blobs.collect()
         
         return jsonify({}), 200
     except Exception as e:
@@ -819,7 +946,7 @@ def delete_model_ollama():
 def generate_ollama():
     global modele_rkllm, current_model
     
-    lock_acquired = False  # Track lock status
+    ticket = None  # Scheduler ticket, released here only on errors
 
     try:
         data = request.json
@@ -832,6 +959,13 @@ def generate_ollama():
         format_spec = data.get('format')
         options = data.get('options', {})
         
+        # Reasoning models: return thinking separately and/or cap its length
+        think = data.get('think')
+        think_budget = data.get('think_budget')
+        
+        # Place in the NPU queue: priority lane and client identity
+        ticket = ticket_for_request(request.headers, request.remote_addr, options)
+        
         if DEBUG_MODE:
             logger.debug(f"API generate request: model={model_name}, stream={stream}, format={format_spec}")
 
@@ -861,36 +995,84 @@ def generate_ollama():
             modele_rkllm = modele_instance
             current_model = model_name
 
-        # Acquire lock before processing
-        variables.verrou.acquire()
-        lock_acquired = True
-        
-        # DIRECTLY use the GenerateEndpointHandler instead of the process_ollama_generate_request wrapper
         from src.server_utils import GenerateEndpointHandler
-        return GenerateEndpointHandler.handle_request(
+
+        # Identical streaming requests (dashboards, retrying clients) share a single generation
+        if stream and is_deterministic(options):
+            fingerprint = request_fingerprint(request.path, {
+                "model": model_name,
+                "prompt": prompt,
+                "system": system,
+                "format": format_spec,
+                "options": options,
+                "think": think,
+                "think_budget": think_budget
+            })
+            shared_stream, created = inflight.registry.get_or_create(fingerprint)
+            
+            if created:
+                model_instance = modele_rkllm
+                
+                shared_ticket = ticket
+                # Joiners get the same request ID, any of them can reconnect
+                request_id = resumable.streams.register(shared_stream)
+                
+                def produce():
+                    response = GenerateEndpointHandler.handle_request(
+                        modele_rkllm=model_instance,
+                        model_name=model_name,
+                        prompt=prompt,
+                        system=system,
+                        stream=True,
+                        format_spec=format_spec,
+                        options=options,
+                        think=think,
+                        think_budget=think_budget,
+                        ticket=shared_ticket
+                    )
+                    return resumable.with_request_id(response.response, request_id)
+                
+                inflight.registry.run(shared_stream, produce)
+            else:
+                scheduler.release(ticket)
+                if DEBUG_MODE:
+                    logger.debug(f"Joining in-flight generation {fingerprint[:12]}")
+            
+            response = Response(shared_stream.subscribe(), content_type='application/x-ndjson')
+            # Lets the ASGI server await new chunks without tying up a thread
+            response.shared_stream = shared_stream
+            if getattr(shared_stream, "request_id", None):
+                response.headers[resumable.REQUEST_ID_HEADER] = shared_stream.request_id
+            return response
+
+        # DIRECTLY use the GenerateEndpointHandler instead of the process_ollama_generate_request wrapper
+        # The NPU is waited for through the scheduler ticket and held until the response is complete
+        response = GenerateEndpointHandler.handle_request(
             modele_rkllm=modele_rkllm,
             model_name=model_name,
             prompt=prompt,
             system=system,
             stream=stream,
             format_spec=format_spec,
-            options=options
+            options=options,
+            think=think,
+            think_budget=think_budget,
+            ticket=ticket
         )
+        # Streamed responses survive a dropped connection, see /api/stream
+        return resumable.make_resumable(response, ticket) if stream else response
     except Exception as e:
+        scheduler.release(ticket)
         if DEBUG_MODE:
             logger.exception(f"Error in generate_ollama: {str(e)}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        # Only release if we acquired it
-        if lock_acquired and variables.verrou.locked():
-            variables.verrou.release()
 
 # Also update the chat endpoint for consistency
 @app.route('/api/chat', methods=['POST'])
 def chat_ollama():
     global modele_rkllm, current_model
     
-    lock_acquired = False  # Track lock status
+    ticket = None  # Scheduler ticket, released here only on errors
 
     try:
         data = request.json
@@ -903,6 +1085,13 @@ def chat_ollama():
         format_spec = data.get('format')
         options = data.get('options', {})
         
+        # Reasoning models: return thinking separately and/or cap its length
+        think = data.get('think')
+        think_budget = data.get('think_budget')
+        
+        # Place in the NPU queue: priority lane and client identity
+        ticket = ticket_for_request(request.headers, request.remote_addr, options)
+        
         if DEBUG_MODE:
             logger.debug(f"API chat request: model={model_name}, format={format_spec}")
         
@@ -978,10 +1167,6 @@ def chat_ollama():
             modele_rkllm.format_schema = format_spec
             modele_rkllm.format_options = options
         
-        # Acquire lock before processing the request
-        variables.verrou.acquire()
-        lock_acquired = True  # Mark lock as acquired
-        
         # Create custom request for processing
         custom_req = type('obj', (object,), {
             'json': {
@@ -1001,26 +1186,24 @@ def chat_ollama():
         
         # Process the request - this won't release the lock
         from src.server_utils import ChatEndpointHandler
-        return ChatEndpointHandler.handle_request(
+        response = ChatEndpointHandler.handle_request(
             modele_rkllm=modele_rkllm,
             model_name=model_name,
             messages=messages,
             system=system,
             stream=stream,
             format_spec=format_spec,
-            options=options
+            options=options,
+            think=think,
+            think_budget=think_budget,
+            ticket=ticket
         )
+        return resumable.make_resumable(response, ticket) if stream else response
     
     except Exception as e:
+        scheduler.release(ticket)
         logger.exception("Error in chat_ollama")
         return jsonify({"error": str(e)}), 500
-    
-    finally:
-        # Only release if we acquired it
-        if lock_acquired and variables.verrou.locked():
-            if DEBUG_MODE:
-                logger.debug("Releasing lock in chat_ollama")
-            variables.verrou.release()
 
 # Only include debug endpoint if in debug mode
 if DEBUG_MODE:
@@ -1051,6 +1234,119 @@ def embeddings_ollama():
         "error": "Embeddings not supported in RKLLAMA"
     }), 501
 
+# Runtime metrics (request coalescing, caches, scheduling...)
+@app.route('/api/metrics', methods=['GET'])
+def metrics_route():
+    return jsonify(metrics.snapshot()), 200
+
+# Progress of the model file digests computation
+@app.route('/api/index', methods=['GET'])
+def model_index_route():
+    return jsonify(model_index.progress()), 200
+
+# Blob store content (weights shared between models)
+@app.route('/api/blobs', methods=['GET'])
+def blobs_route():
+    return jsonify(blobs.stats()), 200
+
+# Blob download (ranges supported), used by peers pulling a model from this server
+@app.route('/api/blobs/<digest>', methods=['GET', 'HEAD'])
+def blob_download(digest):
+    digest = digest.replace("sha256:", "", 1)
+    path = blobs.blob_path(digest) if blobs.has(digest) else None
+    if path is None:
+        # Without the blob store, the model file itself
+        path = next((entry["path"] for entry in catalog.models() if model_index.digest(entry["path"]) == digest),
+                    None)
+    if path is None or not SERVE_PEERS:
+        return "", 404
+    return send_file(path, mimetype="application/octet-stream", conditional=True, etag=digest, max_age=0)
+
+# Peers looking for a model file by Hugging Face repo and file name
+@app.route('/api/peer/lookup', methods=['POST'])
+def peer_lookup():
+    data = request.json or {}
+    model = data.get("model", "")
+    if len(model.split('/')) < 3:
+        return jsonify({"error": f"Invalid path '{model}'"}), 400
+    if not SERVE_PEERS:
+        return jsonify({"error": "Serving peers is disabled"}), 404
+
+    file = model.split('/')[2]
+    repo = model.replace(f"/{file}", "")
+    for entry in catalog.models():
+        model_config = modelfile_cache.get(os.path.join(entry["dir"], "Modelfile"))
+        if entry["file"] != file or model_config is None or model_config.huggingface_path != repo:
+            continue
+        digest = model_index.digest(entry["path"])
+        if digest:
+            return jsonify({"digest": f"sha256:{digest}", "size": entry["size"]}), 200
+    return jsonify({"error": f"'{model}' not found"}), 404
+
+# Response cache statistics and maintenance
+@app.route('/api/cache', methods=['GET', 'DELETE'])
+def response_cache_route():
+    if request.method == 'DELETE':
+        response_cache.clear()
+        return jsonify({"message": "Response cache cleared."}), 200
+    return jsonify(response_cache.stats()), 200
+
+# NPU queue: pending requests and wait times per priority lane
+@app.route('/api/scheduler', methods=['GET'])
+def scheduler_route():
+    return jsonify(scheduler.stats()), 200
+
+@app.route('/api/stream/<request_id>', methods=['GET'])
+def resume_stream(request_id):
+    """Replay a streamed generation from a chunk offset and follow it until it ends"""
+    stream = resumable.streams.get(request_id)
+    if stream is None:
+        return jsonify({"error": f"Unknown or expired request ID '{request_id}'"}), 404
+    
+    offset = request.args.get("offset", 0, type=int)
+    if offset < 0 or offset > len(stream.chunks):
+        return jsonify({"error": f"Offset must be between 0 and {len(stream.chunks)}"}), 400
+    
+    metrics.increment("streams.reconnects")
+    response = Response(stream.subscribe(offset), content_type='application/x-ndjson')
+    response.shared_stream = stream
+    response.offset = offset
+    response.headers[resumable.REQUEST_ID_HEADER] = request_id
+    return response
+
+@app.route('/api/stream/<request_id>', methods=['DELETE'])
+def cancel_stream(request_id):
+    """Stop a detached generation instead of waiting for the grace period"""
+    if not resumable.streams.cancel(request_id):
+        return jsonify({"error": f"Unknown or expired request ID '{request_id}'"}), 404
+    return jsonify({}), 200
+
+# WebSocket chat sessions in Flask mode (the ASGI mode serves them natively)
+if Sock is not None:
+    sock = Sock(app)
+    
+    @sock.route(WEBSOCKET_PATH)
+    def chat_websocket(ws):
+        session = ChatSession(ensure_model_loaded, Headers(list(request.headers.items())), request.remote_addr)
+        pending = []
+        while True:
+            data = pending.pop(0) if pending else ws.receive()
+            frames = session.handle(data)
+            try:
+                for frame in frames:
+                    ws.send(json.dumps(frame))
+                    # Frames sent during a turn: cancel now, the others once it ends
+                    incoming = ws.receive(timeout=0)
+                    while incoming is not None:
+                        if is_cancel(incoming):
+                            session.cancel()
+                        else:
+                            pending.append(incoming)
+                        incoming = ws.receive(timeout=0)
+            finally:
+                if hasattr(frames, "close"):
+                    frames.close()
+
 # Version endpoint for Ollama API compatibility
 @app.route('/api/version', methods=['GET'])
 def ollama_version():
@@ -1067,6 +1363,14 @@ def default_route():
         "github": "https://github.com/notpunhnox/rkllama"
     }), 200
 
+def prepare_unix_socket(path):
+    """Resolve the socket path and remove a stale socket left by a previous run"""
+    path = os.path.abspath(os.path.expanduser(path))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+    return path
+
 # Launch function
 def main():
     # Define the arguments for the launch function
@@ -1113,14 +1417,41 @@ def main():
 
     # Initialize model mappings at server startup
     print_color("Initializing model mappings...", "cyan")
-    initialize_model_mappings()
+    catalog.start()
+    blobs.collect()
+    # Pulls interrupted by the last shutdown continue from their partial files
+    pull_jobs.resume(run_pull)
 
     # Start the API server with the chosen port
     print_color(f"Start the API at http://localhost:{port}", "blue")
     
+    host = config.get("server", "host", "0.0.0.0")
+    
+    # Optional Unix domain socket for clients running on the same board
+    unix_socket = config.get("server", "unix_socket", "")
+    if unix_socket:
+        unix_socket = prepare_unix_socket(unix_socket)
+        print_color(f"Also listening on unix://{unix_socket}", "blue")
+    
+    # ASGI mode: asyncio connections, generations on a dedicated NPU thread
+    if config.get("server", "mode", "flask") == "asgi":
+        try:
+            from src.asgi import serve
+            serve(app, host, int(port), unix_socket, load_model=ensure_model_loaded)
+            return
+        except ImportError as e:
+            print_color(f"ASGI mode requires uvicorn ({e}), falling back to the Flask server", "yellow")
+    
+    if unix_socket:
+        from werkzeug.serving import make_server
+        unix_server = make_server(f"unix://{unix_socket}", 0, app, threaded=True)
+        threading.Thread(target=unix_server.serve_forever, name="rkllama-unix-socket", daemon=True).start()
+    
     # Set Flask debug mode to match our debug flag
     flask_debug = config.is_debug_mode()
-    app.run(host=config.get("server", "host", "0.0.0.0"), port=int(port), threaded=True, debug=flask_debug)
+    # The reloader would restart the process and bind the Unix socket twice
+    app.run(host=host, port=int(port), threaded=True, debug=flask_debug,
+            use_reloader=flask_debug and not unix_socket)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
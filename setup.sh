@@ -83,7 +83,7 @@ pip3 install -r "$INSTALL_DIR/requirements.txt"
 # Install python libraries
 echo -e "\e[32m=======Installing Python dependencies=======\e[0m"
 # Add flask-cors to the pip install command
-pip install requests flask huggingface_hub flask-cors python-dotenv transformers
+pip install requests flask huggingface_hub flask-cors transformers
 
 # Make client.sh and server.sh executable
 echo -e "${CYAN}Making scripts executable${RESET}"
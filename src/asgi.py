@@ -0,0 +1,302 @@
+import asyncio
+import json
+import logging
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from werkzeug.datastructures import Headers
+
+import config
+from .scheduler import scheduler, KEEPALIVE_SECONDS
+from .chat_session import ChatSession, WEBSOCKET_PATH, is_cancel
+
+logger = logging.getLogger("rkllama.asgi")
+
+_END = object()
+
+
+def build_environ(scope, body):
+    """Build the WSGI environ of an ASGI HTTP request"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),  # No port on Unix domain sockets
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1] or 0),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "wsgi.input_terminated": True
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            continue
+        else:
+            key = f"HTTP_{name.upper().replace('-', '_')}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """
+    ASGI front-end for the Flask application.
+
+    Requests are dispatched to the Flask views in a bounded worker pool, so
+    routes keep identical request and response shapes. Streamed bodies are not
+    iterated by the worker pool: responses of /api/generate and /api/chat carry
+    their scheduler ticket, the event loop awaits the NPU grant, and every step
+    of the generation runs on a single dedicated NPU thread feeding the
+    connection. Coalesced and resumed streams carry their SharedStream and
+    are awaited on the event loop. Idle and queued streaming connections don't
+    hold a thread.
+
+    WebSocket chat sessions are served natively on WEBSOCKET_PATH, with
+    `load_model` resolving and loading the model of a session.
+    """
+
+    def __init__(self, flask_app, worker_threads=32, load_model=None):
+        self.flask_app = flask_app
+        self.load_model = load_model
+        self.workers = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix="rkllama-worker")
+        self.npu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rkllama-npu")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.handle_websocket(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.workers.shutdown(wait=False)
+                self.npu_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def dispatch(self, environ):
+        """Run the Flask view for a request, like Flask.wsgi_app without consuming the body"""
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                return app.full_dispatch_request()
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+
+    async def handle_http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.extend(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self.workers, self.dispatch, build_environ(scope, bytes(body)))
+
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in response.headers.items()]
+        })
+
+        if not response.is_streamed:
+            await send({"type": "http.response.body", "body": response.get_data()})
+            return
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            if getattr(response, "shared_stream", None) is not None:
+                await self.stream_shared(response, send, disconnected)
+            else:
+                await self.stream_body(response, send, disconnected)
+        finally:
+            watcher.cancel()
+
+    async def stream_body(self, response, send, disconnected):
+        """Send a streamed body, chunk by chunk, as it is produced"""
+        loop = asyncio.get_running_loop()
+        ticket = getattr(response, "ticket", None)
+        # Only generations run on the NPU thread, other streams (pull progress)
+        # may block for long and use the worker pool
+        executor = self.npu_executor if ticket is not None else self.workers
+        if ticket is not None:
+            ticket.keepalive = 0
+
+        iterator = iter(response.response)
+        try:
+            while not disconnected.is_set():
+                if ticket is not None and ticket.pending:
+                    # Queued: await the grant here instead of blocking the NPU thread
+                    await scheduler.wait_async(ticket, KEEPALIVE_SECONDS)
+                    if disconnected.is_set():
+                        break
+
+                chunk = await loop.run_in_executor(executor, next, iterator, _END)
+                if chunk is _END:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            # Connection lost while sending
+            pass
+        finally:
+            # Closing the generator aborts the NPU run and releases the ticket, or
+            # detaches a resumable generation
+            try:
+                await loop.run_in_executor(executor, response.close)
+            except Exception as e:
+                logger.debug(f"Error closing streamed response: {e}")
+            # A resumable generation keeps its ticket while it runs detached
+            if not getattr(response.response, "detached", False):
+                scheduler.release(ticket)
+
+    async def stream_shared(self, response, send, disconnected):
+        """
+        Send the chunks of a shared generation (coalesced request or resumed
+        stream), awaited on the event loop: idle subscribers don't hold a thread
+        """
+        chunks = response.shared_stream.subscribe_async(getattr(response, "offset", 0))
+        # Compression wraps the blocking generator, the chunks go through it here
+        encode = getattr(response.response, "encode", None)
+        disconnect = asyncio.ensure_future(disconnected.wait())
+        step = None
+        try:
+            while True:
+                step = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait({step, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+                if not step.done():
+                    break
+                try:
+                    chunk = step.result()
+                except StopAsyncIteration:
+                    break
+                if encode is not None:
+                    chunk = encode(chunk)
+                elif isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": encode(None) if encode is not None else b""})
+        except OSError:
+            # Connection lost while sending
+            pass
+        finally:
+            disconnect.cancel()
+            if step is not None and not step.done():
+                # Leave the stream now, it may be abandoned before its next chunk
+                step.cancel()
+                await asyncio.wait({step})
+            await chunks.aclose()
+            # The blocking generator of the response was never started
+            response.close()
+
+
+    async def handle_websocket(self, scope, receive, send):
+        """Run a chat session over a WebSocket, turns are generated in the worker pool"""
+        if (await receive())["type"] != "websocket.connect":
+            return
+        if scope["path"] != WEBSOCKET_PATH or self.load_model is None:
+            await send({"type": "websocket.close", "code": 1008})
+            return
+        await send({"type": "websocket.accept"})
+
+        headers = Headers([(name.decode("latin-1"), value.decode("latin-1"))
+                           for name, value in scope.get("headers", [])])
+        session = ChatSession(self.load_model, headers, (scope.get("client") or ("",))[0])
+        incoming = asyncio.Queue()
+
+        async def read_frames():
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    session.cancel()
+                    await incoming.put(None)
+                    return
+                data = message.get("text")
+                if data is None:
+                    data = (message.get("bytes") or b"").decode("utf-8", "replace")
+                if is_cancel(data):
+                    session.cancel()
+                else:
+                    await incoming.put(data)
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.ensure_future(read_frames())
+        connected = True
+        try:
+            while connected:
+                data = await incoming.get()
+                if data is None:
+                    break
+                frames = iter(session.handle(data))
+                try:
+                    while True:
+                        frame = await loop.run_in_executor(self.workers, next, frames, _END)
+                        if frame is _END:
+                            break
+                        if reader.done():
+                            connected = False
+                            break
+                        await send({"type": "websocket.send", "text": json.dumps(frame)})
+                finally:
+                    if hasattr(frames, "close"):
+                        await loop.run_in_executor(self.workers, frames.close)
+        except OSError:
+            pass
+        finally:
+            reader.cancel()
+
+
+def serve(flask_app, host, port, unix_socket=None, load_model=None):
+    """Run the server in ASGI mode with uvicorn, on TCP and optionally a Unix domain socket"""
+    import uvicorn
+
+    app = AsgiApp(flask_app, config.get("server", "worker_threads", 32, as_type=int), load_model)
+    server = uvicorn.Server(uvicorn.Config(app, log_level="debug" if config.is_debug_mode() else "info"))
+
+    sockets = [socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET)]
+    if unix_socket:
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix.bind(unix_socket)
+        sockets.append(unix)
+    server.run(sockets=sockets)
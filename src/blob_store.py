@@ -0,0 +1,230 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+
+import config
+from . import metrics
+from .model_index import index as model_index
+
+logger = logging.getLogger("rkllama.blob_store")
+
+# ioctl sharing the extents of a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Errors of os.link meaning hardlinks are not possible there (another filesystem, FAT...)
+LINK_UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+
+def link_file(source, destination, allow_copy=True):
+    """
+    Make `destination` hold the content of `source` without copying it when possible
+
+    Returns:
+        "hardlink", "reflink" or "copy", None when only a copy was possible and
+        `allow_copy` is False
+    """
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in LINK_UNSUPPORTED:
+            raise
+
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return "reflink"
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+
+    if not allow_copy:
+        return None
+    shutil.copyfile(source, destination)
+    return "copy"
+
+
+class BlobStore:
+    """
+    Model weights stored once, by content digest.
+
+    Every .rkllm file of the models directory is linked to a blob named after
+    its SHA-256 (`sha256-<hex>`, like Ollama) once the model index knows its
+    digest. A model file with the same content as an existing blob is replaced
+    by a link to it, so that variants of a model (other Modelfile, system
+    prompt or temperature) share their weights. Model directories keep a
+    regular-looking .rkllm file, the runtime loads it as before.
+
+    Hardlinked model files are counted by the link count of their blob.
+    Reflinked ones share extents but not the inode, so they are recorded in
+    `reflinks.json`. A blob that is neither hardlinked nor reflinked by an
+    existing model file is referenced by no model anymore and is removed by
+    `collect`.
+    """
+
+    def __init__(self, blobs_dir, enabled=True):
+        self.blobs_dir = blobs_dir
+        self.enabled = enabled
+        self.manifest_path = os.path.join(blobs_dir, "reflinks.json")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            os.path.join(config.get_path("data"), "blobs"),
+            enabled=config.get("model", "blob_store", True, as_type=bool)
+        )
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, f"sha256-{digest}")
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def _load_reflinks(self):
+        """Reflinked model files by blob digest"""
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable {self.manifest_path}: {e}")
+            return {}
+
+    def _save_reflinks(self, reflinks):
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(reflinks, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def _add_reflink(self, digest, path):
+        """Record a model file sharing the extents of a blob, the lock held"""
+        reflinks = self._load_reflinks()
+        paths = reflinks.setdefault(digest, [])
+        path = os.path.realpath(path)
+        if path not in paths:
+            paths.append(path)
+            self._save_reflinks(reflinks)
+
+    def _live_reflinks(self, reflinks, digest, size):
+        """Recorded reflinks of a blob that still hold its content"""
+        return [path for path in reflinks.get(digest, []) if os.path.isfile(path) and os.path.getsize(path) == size]
+
+    def ingest(self, path, digest):
+        """Link a model file to the blob of its digest (model index listener)"""
+        if not self.enabled:
+            return
+        blob = self.blob_path(digest)
+        with self._lock:
+            try:
+                blob_stat = os.stat(blob)
+            except FileNotFoundError:
+                os.makedirs(self.blobs_dir, exist_ok=True)
+                temp_blob = f"{blob}.tmp"
+                # A full copy would double the disk usage, only links make a blob
+                method = link_file(path, temp_blob, allow_copy=False)
+                if method is None:
+                    logger.debug(f"Cannot link {path} into {self.blobs_dir}, not stored as a blob")
+                    return
+                os.replace(temp_blob, blob)
+                if method == "reflink":
+                    self._add_reflink(digest, path)
+                metrics.increment("blobs.stored")
+                return
+
+            stat = os.stat(path)
+            if os.path.samestat(stat, blob_stat):
+                return
+
+            # Same weights stored twice, keep a single copy
+            temp_path = f"{path}.link"
+            method = link_file(blob, temp_path, allow_copy=False)
+            if method is None:
+                return
+            os.replace(temp_path, path)
+            if method == "reflink":
+                self._add_reflink(digest, path)
+            metrics.increment("blobs.deduplicated")
+            metrics.increment("blobs.deduplicated_bytes", stat.st_size)
+            logger.info(f"{path} has the same content as {os.path.basename(blob)}, now linked to it "
+                        f"({stat.st_size / 1024 ** 2:.0f} MB freed)")
+        # The link has the blob's mtime, keep the digest without reading the file again
+        model_index.record(path, digest)
+
+    def link(self, source, destination):
+        """
+        Give `destination` the weights of the model file `source`, in O(1) when
+        the blob store or the filesystem allows it
+
+        Returns:
+            The method used: "hardlink", "reflink" or "copy"
+        """
+        digest = model_index.digest(source)
+        if self.enabled and digest is not None and self.has(digest):
+            source = self.blob_path(digest)
+        temp_path = f"{destination}.tmp"
+        method = link_file(source, temp_path)
+        os.replace(temp_path, destination)
+        if digest is not None:
+            model_index.record(destination, digest)
+            if method == "reflink" and source == self.blob_path(digest):
+                with self._lock:
+                    self._add_reflink(digest, destination)
+        metrics.increment(f"blobs.links.{method}")
+        return method
+
+    def collect(self):
+        """Remove the blobs no model links to anymore, returns the number of bytes freed"""
+        if not os.path.isdir(self.blobs_dir):
+            return 0
+        freed = 0
+        with self._lock:
+            reflinks = self._load_reflinks()
+            live_reflinks = {}
+            for name in os.listdir(self.blobs_dir):
+                if not name.startswith("sha256-"):
+                    continue
+                path = os.path.join(self.blobs_dir, name)
+                digest = name.replace("sha256-", "", 1)
+                try:
+                    stat = os.stat(path)
+                    if not name.endswith(".tmp"):
+                        live_reflinks[digest] = self._live_reflinks(reflinks, digest, stat.st_size)
+                        if stat.st_nlink > 1 or live_reflinks[digest]:
+                            continue
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Cannot collect blob {name}: {e}")
+                    continue
+                freed += stat.st_size
+                metrics.increment("blobs.collected")
+            live_reflinks = {digest: paths for digest, paths in live_reflinks.items() if paths}
+            if live_reflinks != reflinks:
+                self._save_reflinks(live_reflinks)
+        if freed:
+            logger.info(f"Removed unreferenced blobs ({freed / 1024 ** 2:.0f} MB freed)")
+        return freed
+
+    def stats(self):
+        blobs = []
+        if os.path.isdir(self.blobs_dir):
+            reflinks = self._load_reflinks()
+            for name in sorted(os.listdir(self.blobs_dir)):
+                if not name.startswith("sha256-") or name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(self.blobs_dir, name))
+                digest = name.replace("sha256-", "", 1)
+                blobs.append({"digest": f"sha256:{digest}", "size": stat.st_size,
+                              "references": stat.st_nlink - 1
+                              + len(self._live_reflinks(reflinks, digest, stat.st_size))})
+        return {"enabled": self.enabled, "blobs": blobs, "size": sum(blob["size"] for blob in blobs)}
+
+
+blobs = BlobStore.from_config()
+model_index.listeners.append(blobs.ingest)
@@ -0,0 +1,200 @@
+import json
+import logging
+
+from .server_utils import ChatEndpointHandler
+from .scheduler import scheduler, ticket_for_request
+from . import metrics
+
+logger = logging.getLogger("rkllama.chat_session")
+
+WEBSOCKET_PATH = "/api/chat/ws"
+
+# Fields of the final /api/chat chunk reported in the "done" frame
+METRIC_FIELDS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                 "eval_count", "eval_duration", "done_reason")
+
+
+def parse_frame(data):
+    """Decode an incoming text frame, None when it is not a JSON object"""
+    if isinstance(data, (str, bytes)):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return None
+    return data if isinstance(data, dict) else None
+
+
+def is_cancel(data):
+    """Cancel frames are handled as soon as they arrive, even during a turn"""
+    frame = parse_frame(data)
+    return frame is not None and frame.get("type") == "cancel"
+
+
+class ChatSession:
+    """
+    Conversation held by a persistent connection (WebSocket).
+
+    The history stays on the server: each turn only carries the new user
+    message. Turns run through ChatEndpointHandler, like /api/chat, and are
+    translated into frames. Incoming frames:
+
+        {"type": "options", "model": ..., "system": ..., "options": {...}, "think": ...}
+        {"type": "message", "content": "..."}
+        {"type": "cancel"}
+        {"type": "reset"}
+
+    Outgoing frames: "token" (content, thinking), "queue" and "prefill"
+    progress, "heartbeat", "done" (with the turn's metrics), "options",
+    "reset" and "error".
+
+    The transport runs the generator returned by `handle` and forwards its
+    frames; `cancel` may be called from another thread while a turn runs.
+    """
+
+    def __init__(self, load_model, headers=None, remote_addr=None, model=None):
+        self.load_model = load_model  # model name -> (RKLLM instance, full model name)
+        self.headers = headers or {}
+        self.remote_addr = remote_addr
+        self.model = model
+        self.system = ""
+        self.options = {}
+        self.think = None
+        self.messages = []
+        self.turns = 0
+        self.busy = False
+        self.cancelled = False
+
+    def handle(self, frame):
+        """Process an incoming frame, returning the iterable of frames to send back"""
+        frame = parse_frame(frame)
+        if frame is None:
+            return [self.error("Frames must be JSON objects")]
+
+        frame_type = frame.get("type")
+        if frame_type == "cancel":
+            self.cancel()
+            return []
+        if self.busy:
+            return [self.error("A turn is already running, send a cancel frame first")]
+        if frame_type == "options":
+            return [self.update_options(frame)]
+        if frame_type == "reset":
+            self.messages = []
+            return [{"type": "reset"}]
+        if frame_type == "message":
+            content = frame.get("content")
+            if not isinstance(content, str) or not content:
+                return [self.error("Missing message content")]
+            return self.turn(content)
+        return [self.error(f"Unknown frame type {frame_type!r}")]
+
+    def update_options(self, frame):
+        if "model" in frame:
+            self.model = frame["model"]
+        if "system" in frame:
+            self.system = frame["system"] or ""
+        if "think" in frame:
+            self.think = frame["think"]
+        if isinstance(frame.get("options"), dict):
+            self.options.update(frame["options"])
+        return {"type": "options", "model": self.model, "system": self.system, "think": self.think,
+                "options": self.options}
+
+    def cancel(self):
+        if self.busy:
+            self.cancelled = True
+
+    @staticmethod
+    def error(message):
+        return {"type": "error", "error": message}
+
+    def turn(self, content):
+        """Generate the answer to a user message, yielding frames"""
+        if not self.model:
+            yield self.error("No model selected, send an options frame with a model first")
+            return
+
+        self.busy = True
+        self.cancelled = False
+        self.turns += 1
+        self.messages.append({"role": "user", "content": content})
+        answer = ""
+        thinking = ""
+        ticket = None
+        lines = None
+        try:
+            modele_rkllm, model_name = self.load_model(self.model)
+            ticket = ticket_for_request(self.headers, self.remote_addr, self.options)
+            # The handler appends format instructions to the messages, keep the history intact
+            response = ChatEndpointHandler.handle_request(
+                modele_rkllm=modele_rkllm,
+                model_name=model_name,
+                messages=[dict(message) for message in self.messages],
+                system=self.system,
+                stream=True,
+                options=self.options,
+                think=self.think,
+                ticket=ticket
+            )
+            lines = response.response
+            for line in lines:
+                if self.cancelled:
+                    break
+                frame = self.frame(json.loads(line))
+                if frame["type"] == "token":
+                    answer += frame["content"]
+                    thinking += frame.get("thinking", "")
+                elif frame["type"] == "done":
+                    frame["turn"] = self.turns
+                yield frame
+                if frame["type"] in ("done", "error"):
+                    break
+
+            if self.cancelled:
+                metrics.increment("chat_session.cancelled_turns")
+                yield {"type": "done", "done_reason": "cancelled", "turn": self.turns}
+        except Exception as e:
+            logger.exception("Error in chat session turn")
+            yield self.error(str(e))
+        finally:
+            # Closing the stream aborts the NPU run and releases the scheduler ticket; the ticket
+            # must not be released before, while the generation may still be running
+            if lines is not None and hasattr(lines, "close"):
+                lines.close()
+            else:
+                scheduler.release(ticket)
+            if answer:
+                # A cancelled answer stays in the history as far as it went
+                message = {"role": "assistant", "content": answer}
+                if thinking:
+                    message["thinking"] = thinking
+                self.messages.append(message)
+            else:
+                # Nothing was generated (error, early cancel): forget the question
+                self.messages.pop()
+            self.busy = False
+            self.cancelled = False
+
+    @staticmethod
+    def frame(chunk):
+        """Translate an /api/chat chunk into a frame"""
+        if "error" in chunk:
+            return {"type": "error", "error": chunk["error"]}
+        if chunk.get("done"):
+            frame = {"type": "done"}
+            frame.update({name: chunk[name] for name in METRIC_FIELDS if name in chunk})
+            if chunk.get("eval_duration"):
+                frame["tokens_per_second"] = round(chunk.get("eval_count", 0) / (chunk["eval_duration"] / 1e9), 2)
+            return frame
+        if "queue" in chunk:
+            return dict({"type": "queue"}, **chunk["queue"])
+        if "prefill" in chunk:
+            return dict({"type": "prefill"}, **chunk["prefill"])
+
+        message = chunk.get("message", {})
+        if not message.get("content") and "thinking" not in message:
+            return {"type": "heartbeat"}
+        frame = {"type": "token", "content": message.get("content", "")}
+        if "thinking" in message:
+            frame["thinking"] = message["thinking"]
+        return frame
@@ -0,0 +1,60 @@
+import datetime
+import functools
+import json
+import time
+
+# C implementation when available, as used by json.dumps
+from json.encoder import encode_basestring_ascii as _encode_string
+
+# Streamed chunks are serialized from precomputed templates: only the timestamp
+# and the escaped text are spliced in. The output is byte-identical to
+# json.dumps() on the equivalent dict (default separators, ASCII escaping).
+
+_timestamp_cache = (None, "")
+
+
+def timestamp():
+    """Current time formatted like datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")"""
+    global _timestamp_cache
+    now = time.time()
+    second = int(now)
+    micro = round((now - second) * 1_000_000)
+    if micro >= 1_000_000:
+        second += 1
+        micro -= 1_000_000
+
+    # The date and time part only changes once per second
+    cached_second, prefix = _timestamp_cache
+    if cached_second != second:
+        prefix = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%dT%H:%M:%S.")
+        _timestamp_cache = (second, prefix)
+    return f"{prefix}{micro:06d}Z"
+
+
+def encode_string(value):
+    """JSON encoding of a value, with a fast path for strings"""
+    if isinstance(value, str):
+        return _encode_string(value)
+    return json.dumps(value)
+
+
+@functools.lru_cache(maxsize=64)
+def _model_prefix(model_name):
+    return '{"model": ' + json.dumps(model_name) + ', "created_at": "'
+
+
+def chat_chunk(model_name, content, thinking=None):
+    """Line of an intermediate /api/chat chunk"""
+    line = (_model_prefix(model_name) + timestamp() + '", "message": {"role": "assistant", "content": '
+            + encode_string(content))
+    if thinking is not None:
+        line += ', "thinking": ' + encode_string(thinking)
+    return line + '}, "done": false}\n'
+
+
+def generate_chunk(model_name, response, thinking=None):
+    """Line of an intermediate /api/generate chunk"""
+    line = _model_prefix(model_name) + timestamp() + '", "response": ' + encode_string(response) + ', "done": false'
+    if thinking is not None:
+        line += ', "thinking": ' + encode_string(thinking)
+    return line + '}\n'
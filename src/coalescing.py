@@ -0,0 +1,128 @@
+import math
+import time
+
+import config
+from . import metrics
+
+# Characters after which a coalesced chunk is sent right away when flushing on boundaries
+BOUNDARY_CHARACTERS = frozenset(".!?,;:\n。！？，；：")
+
+# Bounds of the coalescing policy a request can ask for
+MAX_COALESCE_TOKENS = 256
+MAX_COALESCE_MS = 10000.0
+
+
+class TokenCoalescer:
+    """
+    Groups streamed tokens into fewer chunks.
+
+    A chunk is sent once `max_tokens` tokens are buffered, once the oldest
+    buffered token is `max_ms` old when a new one arrives, or, with
+    `on_boundary`, after a newline or punctuation, whichever comes first.
+    With `max_tokens` = 1 (the default) every token is sent as it arrives.
+
+    Content and thinking text are never mixed in a chunk: a change of kind
+    flushes the buffer first.
+
+    `label` names the source of the policy in /api/metrics ("default",
+    "configured" or "request"), never the client-chosen values themselves.
+    """
+
+    def __init__(self, max_tokens=1, max_ms=0, on_boundary=False, label="default"):
+        self.max_tokens = min(max(int(max_tokens), 1), MAX_COALESCE_TOKENS)
+        self.max_ms = min(max(float(max_ms), 0.0), MAX_COALESCE_MS)
+        self.on_boundary = bool(on_boundary)
+        self.label = label
+
+        self._content = []
+        self._thinking = None
+        self._count = 0
+        self._first_at = None
+
+    @classmethod
+    def from_options(cls, options=None):
+        """Server-wide policy from [streaming], overridden by the request options"""
+        max_tokens = config.get("streaming", "coalesce_tokens", 1, as_type=int)
+        max_ms = config.get("streaming", "coalesce_ms", 0, as_type=float)
+        on_boundary = config.get("streaming", "coalesce_on_boundary", False, as_type=bool)
+        label = "configured"
+
+        if isinstance(options, dict) and any(name in options for name in
+                                             ("coalesce_tokens", "coalesce_ms", "coalesce_boundary")):
+            label = "request"
+            # Invalid or non-finite values ("inf", "nan", Infinity) keep the configured policy
+            try:
+                value = float(options.get("coalesce_tokens", max_tokens))
+                if math.isfinite(value):
+                    max_tokens = int(value)
+            except (ValueError, TypeError):
+                pass
+            try:
+                value = float(options.get("coalesce_ms", max_ms))
+                if math.isfinite(value):
+                    max_ms = value
+            except (ValueError, TypeError):
+                pass
+            on_boundary = bool(options.get("coalesce_boundary", on_boundary))
+
+        return cls(max_tokens, max_ms, on_boundary, label)
+
+    def _take(self):
+        if self._count == 0:
+            return []
+        delay = (time.time() - self._first_at) * 1000
+        metrics.observe(f"stream.delay_ms.{self.label}", delay)
+        chunk = ("".join(self._content), None if self._thinking is None else "".join(self._thinking))
+        self._content = []
+        self._thinking = None
+        self._count = 0
+        self._first_at = None
+        return [chunk]
+
+    def add(self, content, thinking=None):
+        """Buffer a token and return the list of (content, thinking) chunks to send now"""
+        ready = []
+        if self._count and (thinking is None) != (self._thinking is None):
+            ready += self._take()
+
+        now = time.time()
+        if self._count == 0:
+            self._first_at = now
+            self._thinking = None if thinking is None else []
+        self._content.append(content)
+        if thinking is not None:
+            self._thinking.append(thinking)
+        self._count += 1
+
+        text = thinking if thinking is not None else content
+        if (self._count >= self.max_tokens
+                or (self.max_ms and (now - self._first_at) * 1000 >= self.max_ms)
+                or (self.on_boundary and text and text.rstrip(" ")[-1:] in BOUNDARY_CHARACTERS)):
+            ready += self._take()
+        return ready
+
+    def flush(self):
+        """Return the buffered chunk, if any, once the generation has ended"""
+        return self._take()
+
+
+def measure_stream(lines, label):
+    """
+    Pass the lines of a streamed response through, counting chunks and bytes
+
+    The totals of each response are recorded in /api/metrics per source of the
+    coalescing policy (see TokenCoalescer).
+    """
+    chunks = 0
+    size = 0
+    try:
+        for line in lines:
+            chunks += 1
+            size += len(line.encode("utf-8")) if isinstance(line, str) else len(line)
+            yield line
+    finally:
+        # Closing the wrapper must stop the generation too
+        if hasattr(lines, "close"):
+            lines.close()
+        metrics.observe(f"stream.chunks.{label}", chunks)
+        metrics.observe(f"stream.bytes.{label}", size)
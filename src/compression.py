@@ -0,0 +1,132 @@
+import time
+import zlib
+
+import config
+from . import metrics
+
+# zlib window bits of each content coding: gzip header, or zlib header for HTTP "deflate"
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+ENABLED = config.get("compression", "enabled", True, as_type=bool)
+LEVEL = config.get("compression", "level", 1, as_type=int)
+MIN_SIZE = config.get("compression", "min_size_kb", 1, as_type=int) * 1024
+
+
+def negotiate(accept_encoding):
+    """
+    Pick the content coding to use from an Accept-Encoding header
+
+    Returns:
+        "gzip", "deflate", or None when the client accepts neither
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class CompressedStream:
+    """
+    Compresses the chunks of a streamed body as they are produced.
+
+    Each chunk is followed by a sync flush, so that the client can decode it
+    as soon as it arrives. Other attributes are those of the wrapped stream.
+    """
+
+    def __init__(self, chunks, encoding, level=LEVEL):
+        self.chunks = iter(chunks)
+        self.encoding = encoding
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        self.finished = False
+
+    def __getattr__(self, name):
+        return getattr(self.chunks, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            return self.encode(None)
+        return self.encode(chunk)
+
+    def encode(self, chunk):
+        """Compress a chunk of the body, None at its end (for chunks not read from the wrapped stream)"""
+        if chunk is None:
+            self.finished = True
+            tail = self._compress(None)
+            self._record()
+            return tail
+
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        return self._compress(chunk)
+
+    def _compress(self, chunk):
+        started = time.thread_time()
+        if chunk is None:
+            data = self.compressor.flush()
+        else:
+            self.bytes_in += len(chunk)
+            data = self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.thread_time() - started
+        self.bytes_out += len(data)
+        return data
+
+    def _record(self):
+        metrics.observe("compression.stream.bytes_in", self.bytes_in)
+        metrics.observe("compression.stream.bytes_out", self.bytes_out)
+        metrics.observe("compression.stream.cpu_ms", self.cpu_time * 1000)
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+
+def compress_response(response, accept_encoding):
+    """Compress a response for a client that accepts it (Flask after_request hook)"""
+    if not ENABLED or response.status_code in (204, 206, 304) or "Content-Encoding" in response.headers:
+        return response
+    if response.direct_passthrough:
+        # Files (model blobs) are sent as they are, ranges of them must stay valid
+        return response
+    encoding = negotiate(accept_encoding)
+    response.vary.add("Accept-Encoding")
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = CompressedStream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        started = time.thread_time()
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, ENCODINGS[encoding])
+        compressed = compressor.compress(data) + compressor.flush()
+        metrics.observe("compression.body.cpu_ms", (time.thread_time() - started) * 1000)
+        metrics.observe("compression.body.bytes_in", len(data))
+        metrics.observe("compression.body.bytes_out", len(compressed))
+        response.set_data(compressed)
+
+    response.headers["Content-Encoding"] = encoding
+    return response
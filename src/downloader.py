@@ -0,0 +1,378 @@
+import ctypes
+import hashlib
+import json
+import logging
+import os
+import platform
+import re
+import threading
+import time
+
+import requests
+
+import config
+from . import metrics
+
+logger = logging.getLogger("rkllama.downloader")
+
+# Ranges smaller than this are not split between connections
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+# Progress of the segments is saved every STATE_INTERVAL bytes written
+STATE_INTERVAL = 32 * 1024 * 1024
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# ioprio_set(2): idle class, only served when no other process needs the disk
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {"aarch64": 30, "x86_64": 251, "armv7l": 314, "armv8l": 314}
+
+
+class DownloadError(Exception):
+    """A download failed; its partial file is kept for resuming unless it was corrupt"""
+
+
+def parse_etag(value):
+    """ETag without weak marker nor quotes"""
+    if not value:
+        return None
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"')
+
+
+def set_idle_io_priority():
+    """Move the calling thread to the idle I/O scheduling class, False where it is not supported"""
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        result = libc.syscall(number, IOPRIO_WHO_PROCESS, threading.get_native_id(),
+                              IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except (OSError, AttributeError):
+        return False
+    return result == 0
+
+
+class TokenBucket:
+    """
+    Bandwidth limit shared by all downloads, in bytes per second.
+
+    Readers take tokens for the bytes they received; when the bucket is empty
+    they sleep until the rate pays their debt back. The bucket holds at most
+    one second worth of tokens. A rate of zero disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.get("download", "max_bandwidth_mb", 0, as_type=float) * 1024 * 1024)
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            metrics.observe("download.throttled_ms", delay * 1000)
+            time.sleep(delay)
+
+
+# Shared by all downloads, so that the limit holds whatever the number of pulls and connections
+bandwidth = TokenBucket.from_config()
+
+
+class Download:
+    """
+    Download of a file over HTTP, resumable and split into parallel ranges.
+
+    The file is written to `<destination>.part`, preallocated to its full size,
+    with each connection writing its own range at its offset. The progress of
+    every range is saved next to it (`<destination>.part.json`), so that an
+    interrupted download resumes with HTTP Range requests where it stopped, as
+    long as the remote size and ETag (or SHA-256, when resuming from another
+    source) are unchanged. Failed requests are retried
+    with backoff. Once complete, the size and SHA-256 (given, or the ETag when
+    it is one, as for Hugging Face LFS files) are verified and the file is
+    renamed into place.
+
+    Servers which ignore Range requests are downloaded from the start over a
+    single connection. Received bytes go through the `bandwidth` token bucket,
+    and with `idle_io` the download threads only use the disk when nothing
+    else does.
+    """
+
+    def __init__(self, url, destination, sha256=None, connections=4, retries=5, buffer_size=1024 * 1024,
+                 timeout=30, bandwidth=None, idle_io=False):
+        self.url = url
+        self.destination = destination
+        self.part_path = f"{destination}.part"
+        self.state_path = f"{destination}.part.json"
+        self.sha256 = sha256
+        self.connections = max(1, connections)
+        self.retries = retries
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.bandwidth = bandwidth
+        self.idle_io = idle_io
+
+        self.size = None
+        self.etag = None
+        self.ranges = False
+        self.verified = False
+        self.phase = "pending"  # then "probing", "downloading", "verifying", "done"
+        self.segments = []  # [start, end, written] with end exclusive
+        self.resumed = 0
+        self.error = None
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._unsaved = 0
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, url, destination, sha256=None):
+        return cls(
+            url, destination, sha256=sha256,
+            connections=config.get("download", "connections", 4, as_type=int),
+            retries=config.get("download", "retries", 5, as_type=int),
+            buffer_size=config.get("download", "buffer_kb", 1024, as_type=int) * 1024,
+            bandwidth=bandwidth,
+            idle_io=config.get("download", "idle_io_priority", True, as_type=bool)
+        )
+
+    @property
+    def downloaded(self):
+        return sum(segment[2] for segment in self.segments)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rkllama-download", daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """Wait for the end of the download, True when it finished (successfully or not)"""
+        return self._done.wait(timeout)
+
+    def result(self):
+        """Path of the downloaded file, raises DownloadError if the download failed"""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.destination
+
+    def cancel(self):
+        """Stop downloading, the partial file is kept for a later resume"""
+        self._cancelled.set()
+
+    def discard(self):
+        """Remove the partial file of a stopped download"""
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run(self):
+        """Download in the calling thread, returns the path of the downloaded file"""
+        self._run()
+        return self.result()
+
+    def _run(self):
+        started = time.time()
+        if self.idle_io:
+            # Also covers the verification, which reads the whole file
+            set_idle_io_priority()
+        try:
+            self.phase = "probing"
+            self._probe()
+            self._prepare()
+            self.phase = "downloading"
+            if self.downloaded < self.size:
+                workers = [threading.Thread(target=self._fetch_segment, args=(segment,), daemon=True)
+                           for segment in self.segments if segment[2] < segment[1] - segment[0]]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                self._save_state()
+                if self._cancelled.is_set():
+                    raise DownloadError("Download cancelled")
+                if self.error is not None:
+                    raise self.error
+            self._finish()
+            elapsed = time.time() - started
+            metrics.increment("download.completed")
+            metrics.increment("download.bytes", self.size - self.resumed)
+            metrics.observe("download.mb_per_second", (self.size - self.resumed) / 1024 ** 2 / max(elapsed, 1e-6))
+            logger.info(f"Downloaded {os.path.basename(self.destination)} ({self.size / 1024 ** 2:.0f} MB, "
+                        f"{self.resumed / 1024 ** 2:.0f} MB resumed) in {elapsed:.1f}s")
+        except DownloadError as e:
+            self.error = e
+            metrics.increment("download.failed")
+        except Exception as e:
+            self.error = DownloadError(str(e))
+            metrics.increment("download.failed")
+        finally:
+            self.phase = "done"
+            self._done.set()
+
+    def _probe(self):
+        """Get the size and ETag of the remote file"""
+        response = requests.head(self.url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        self.size = int(response.headers.get("Content-Length", 0)) or None
+        self.etag = parse_etag(response.headers.get("ETag"))
+        self.ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+        # Hugging Face redirects LFS files to a CDN, the SHA-256 is the ETag of the first response
+        for hop in response.history:
+            linked = parse_etag(hop.headers.get("X-Linked-Etag"))
+            if linked:
+                self.etag = linked
+                self.size = int(hop.headers.get("X-Linked-Size", self.size or 0)) or self.size
+        if self.sha256 is None and self.etag and SHA256_PATTERN.match(self.etag):
+            self.sha256 = self.etag
+
+        if not self.size:
+            raise DownloadError(f"Unable to retrieve the size of {self.url}")
+
+    def _prepare(self):
+        """Load the state of a previous attempt, or split the file into segments"""
+        state = None
+        if os.path.exists(self.part_path) and os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, "r") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        # Same file: same ETag from the same server, or same SHA-256 from another source (e.g. a peer)
+        same_content = state and (state.get("etag") == self.etag
+                                  or (self.sha256 is not None and state.get("sha256") == self.sha256))
+        if same_content and state.get("size") == self.size and self.ranges:
+            self.segments = state["segments"]
+            self.resumed = self.downloaded
+            logger.info(f"Resuming {os.path.basename(self.destination)} at "
+                        f"{self.resumed / 1024 ** 2:.0f} / {self.size / 1024 ** 2:.0f} MB")
+            metrics.increment("download.resumed")
+            return
+
+        connections = self.connections if self.ranges else 1
+        segment_size = max(MIN_SEGMENT_SIZE, -(-self.size // connections))
+        self.segments = [[start, min(start + segment_size, self.size), 0]
+                         for start in range(0, self.size, segment_size)]
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.size)
+        self._save_state()
+
+    def _save_state(self):
+        with self._lock:
+            state = json.dumps({"url": self.url, "size": self.size, "etag": self.etag, "sha256": self.sha256,
+                                "segments": self.segments})
+            self._unsaved = 0
+        with self._state_lock:
+            temp_path = f"{self.state_path}.tmp"
+            with open(temp_path, "w") as f:
+                f.write(state)
+            os.replace(temp_path, self.state_path)
+
+    def _fetch_segment(self, segment):
+        if self.idle_io:
+            set_idle_io_priority()
+        failures = 0
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            with requests.Session() as session:
+                while segment[2] < segment[1] - segment[0] and not self._cancelled.is_set():
+                    if self.error is not None:
+                        return
+                    written = segment[2]
+                    try:
+                        self._fetch_range(session, fd, segment)
+                    except DownloadError as e:
+                        self.error = e
+                        return
+                    except (requests.RequestException, OSError) as e:
+                        # Errors after some progress don't count against the retries
+                        failures = 1 if segment[2] > written else failures + 1
+                        metrics.increment("download.retries")
+                        if failures > self.retries:
+                            self.error = DownloadError(f"Download failed after {self.retries} retries: {e}")
+                            return
+                        logger.debug(f"Range {segment[0] + segment[2]}-{segment[1] - 1} failed ({e}), retrying")
+                        self._cancelled.wait(min(2 ** failures, 30))
+        finally:
+            os.close(fd)
+
+    def _fetch_range(self, session, fd, segment):
+        start, end, written = segment
+        headers = {}
+        if not self.ranges:
+            # Without ranges, a retry downloads the whole file again
+            segment[2] = written = 0
+        else:
+            headers["Range"] = f"bytes={start + written}-{end - 1}"
+        with session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if self.ranges and response.status_code != 206:
+                # Ranges are not honored after all, the partial file can't be completed
+                raise DownloadError(f"Server answered a range request with status {response.status_code}")
+            offset = start + written
+            for chunk in response.iter_content(chunk_size=self.buffer_size):
+                if self._cancelled.is_set():
+                    return
+                if self.bandwidth is not None:
+                    self.bandwidth.consume(len(chunk))
+                chunk = chunk[:end - offset]
+                while chunk:
+                    count = os.pwrite(fd, chunk, offset)
+                    chunk = chunk[count:]
+                    offset += count
+                    with self._lock:
+                        segment[2] = offset - start
+                        self._unsaved += count
+                        save = self._unsaved >= STATE_INTERVAL
+                    if save:
+                        self._save_state()
+                if offset >= end:
+                    return
+        if offset < end:
+            raise requests.ConnectionError(f"Connection closed at {offset} of range {start}-{end - 1}")
+
+    def _finish(self):
+        """Verify the downloaded file and move it into place"""
+        actual_size = os.path.getsize(self.part_path)
+        if actual_size != self.size or self.downloaded != self.size:
+            raise DownloadError(f"Size mismatch: expected {self.size} bytes, got {self.downloaded}")
+
+        if self.sha256:
+            self.phase = "verifying"
+            sha256 = hashlib.sha256()
+            with open(self.part_path, "rb") as f:
+                while True:
+                    block = f.read(8 * 1024 * 1024)
+                    if not block:
+                        break
+                    sha256.update(block)
+            if sha256.hexdigest() != self.sha256:
+                # Corrupt: resuming would keep the corruption, start over next time
+                os.remove(self.part_path)
+                os.remove(self.state_path)
+                metrics.increment("download.corrupt")
+                raise DownloadError(f"SHA-256 mismatch: expected {self.sha256}, got {sha256.hexdigest()}")
+            self.verified = True
+
+        with open(self.part_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self.part_path, self.destination)
+        os.remove(self.state_path)
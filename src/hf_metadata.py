@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import config
+from . import metrics
+from .model_utils import get_huggingface_model_info
+
+logger = logging.getLogger("rkllama.hf_metadata")
+
+
+class HuggingFaceMetadata:
+    """
+    Hugging Face model metadata, cached on disk by repository.
+
+    Cached metadata is served as is while younger than `ttl`; older metadata is
+    still served, and refreshed in the background (stale-while-revalidate). A
+    request only waits for the API the first time a repository is looked up,
+    at most `timeout` seconds; after a failure, retries happen in the
+    background every `retry_seconds`. In offline mode the API is never
+    contacted and only cached metadata is served.
+    """
+
+    def __init__(self, cache_dir, ttl=24 * 3600.0, offline=False, timeout=5.0, retry_seconds=300.0):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self._entries = {}  # repo -> {"fetched_at", "data"}
+        self._failed_at = {}  # repo -> time of the last failed fetch
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            os.path.join(config.get_path("data"), "hf_metadata"),
+            ttl=config.get("huggingface", "metadata_ttl_hours", 24.0, as_type=float) * 3600,
+            offline=config.get("huggingface", "offline", False, as_type=bool),
+            timeout=config.get("huggingface", "timeout", 5.0, as_type=float)
+        )
+
+    def _path(self, repo):
+        return os.path.join(self.cache_dir, f"{repo.replace('/', '--')}.json")
+
+    def _load(self, repo):
+        try:
+            with open(self._path(repo), "r") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable metadata cache of {repo}: {e}")
+            return None
+        self._entries[repo] = entry
+        return entry
+
+    def _store(self, repo, data):
+        entry = {"fetched_at": time.time(), "data": data}
+        self._entries[repo] = entry
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{self._path(repo)}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, self._path(repo))
+        except OSError as e:
+            logger.warning(f"Cannot save the metadata cache of {repo}: {e}")
+
+    def get(self, repo):
+        """Metadata of a repository, None when unknown (or the repository doesn't exist)"""
+        if not repo or "/" not in repo:
+            return None
+        entry = self._entries.get(repo) or self._load(repo)
+        if entry is not None:
+            if time.time() - entry["fetched_at"] >= self.ttl:
+                metrics.increment("hf_metadata.stale")
+                self._refresh_async(repo)
+            else:
+                metrics.increment("hf_metadata.hits")
+            return entry["data"]
+
+        metrics.increment("hf_metadata.misses")
+        if self.offline:
+            return None
+        if repo in self._failed_at:
+            # Already failed once, don't make requests wait for the network again
+            self._refresh_async(repo)
+            return None
+        return self._fetch(repo)
+
+    def fetched_at(self, repo):
+        """When the cached metadata of a repository was fetched, None when there is none"""
+        entry = self._entries.get(repo)
+        return entry["fetched_at"] if entry else None
+
+    def _refresh_async(self, repo):
+        if self.offline:
+            return
+        with self._lock:
+            if repo in self._refreshing or time.time() - self._failed_at.get(repo, 0) < self.retry_seconds:
+                return
+            self._refreshing.add(repo)
+
+        def refresh():
+            try:
+                self._fetch(repo)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(repo)
+
+        threading.Thread(target=refresh, name="rkllama-hf-metadata", daemon=True).start()
+
+    def _fetch(self, repo):
+        started = time.time()
+        try:
+            data = get_huggingface_model_info(repo, timeout=self.timeout, raise_errors=True)
+        except requests.RequestException as e:
+            self._failed_at[repo] = time.time()
+            metrics.increment("hf_metadata.failures")
+            logger.debug(f"Cannot fetch the metadata of {repo}: {e}")
+            entry = self._entries.get(repo)
+            return entry["data"] if entry else None
+
+        self._failed_at.pop(repo, None)
+        self._store(repo, data)
+        metrics.observe("hf_metadata.fetch_ms", (time.time() - started) * 1000)
+        return data
+
+
+metadata = HuggingFaceMetadata.from_config()
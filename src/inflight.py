@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger("rkllama.inflight")
+
+
+def request_fingerprint(endpoint, payload):
+    """
+    Canonical hash of a generation request
+
+    Args:
+        endpoint: API path the request was sent to
+        payload: Dictionary of the fields that influence the generated output
+
+    Returns:
+        Hex SHA-256 digest, identical for byte-identical requests
+    """
+    canonical = json.dumps({"endpoint": endpoint, "payload": payload}, sort_keys=True,
+                           separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(options):
+    """Only greedy decoding (top_k = 1, the RKLLM default) produces identical outputs"""
+    if not isinstance(options, dict):
+        return True
+    try:
+        return int(options.get("top_k", 1)) == 1
+    except (ValueError, TypeError):
+        return False
+
+
+class SharedStream:
+    """
+    Buffered output of a single generation, readable by any number of subscribers.
+
+    The producer appends chunks as they are generated; each subscriber replays
+    the buffered prefix and then follows the live stream until it finishes.
+    Once nobody has been listening for `grace` seconds the stream is abandoned
+    and the producer may stop.
+
+    `subscribe` blocks its thread while waiting for new chunks,
+    `subscribe_async` awaits them on an event loop instead.
+    """
+
+    def __init__(self, key=None, grace=0):
+        self.key = key
+        self.grace = grace
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.finished_at = None
+        self.idle_since = None
+        self.subscribers = 0
+        self.total_subscribers = 0
+        self._condition = threading.Condition()
+        self._waiters = []  # (event loop, future) of the async subscribers waiting for a chunk
+
+    @property
+    def abandoned(self):
+        return (not self.done and self.subscribers == 0 and self.idle_since is not None
+                and time.time() - self.idle_since >= self.grace)
+
+    def append(self, chunk):
+        with self._condition:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self._notify()
+
+    def finish(self):
+        with self._condition:
+            self.done = True
+            self.finished_at = time.time()
+            self._notify()
+
+    def _notify(self):
+        """Wake up every waiting subscriber, the condition held"""
+        self._condition.notify_all()
+        for loop, waiter in self._waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+        self._waiters = []
+
+    def detach(self):
+        """A reader that is not a subscriber (the original client) went away"""
+        with self._condition:
+            if self.subscribers == 0:
+                self.idle_since = time.time()
+
+    def _attach(self):
+        with self._condition:
+            self.subscribers += 1
+            self.total_subscribers += 1
+            self.idle_since = None
+
+    def _leave(self):
+        with self._condition:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                # Nobody is listening anymore: the producer stops after the grace period
+                self.idle_since = time.time()
+
+    def subscribe(self, offset=0):
+        """Generator yielding chunks from `offset`, waiting for new ones until the stream is done"""
+        self._attach()
+        position = offset
+        try:
+            while True:
+                with self._condition:
+                    while position >= len(self.chunks) and not self.done:
+                        self._condition.wait()
+                    pending = self.chunks[position:]
+                    finished = self.done
+                position += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if finished and position >= len(self.chunks):
+                    return
+        finally:
+            self._leave()
+
+    async def subscribe_async(self, offset=0):
+        """Like `subscribe`, awaiting new chunks on the running event loop instead of blocking a thread"""
+        loop = asyncio.get_running_loop()
+        self._attach()
+        position = offset
+        try:
+            while True:
+                with self._condition:
+                    pending = self.chunks[position:]
+                    finished = self.done
+                    waiter = None
+                    if not pending and not finished:
+                        waiter = loop.create_future()
+                        self._waiters.append((loop, waiter))
+                if waiter is not None:
+                    await waiter
+                    continue
+                position += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if finished and position >= len(self.chunks):
+                    return
+        finally:
+            self._leave()
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class InflightRegistry:
+    """Registry of pending and in-flight generations, keyed by request fingerprint"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key):
+        """
+        Return the stream for `key`, creating it if needed
+
+        Returns:
+            Tuple of (SharedStream, created)
+        """
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None and not stream.abandoned:
+                metrics.increment("inflight.coalesced_requests")
+                return stream, False
+            stream = SharedStream(key)
+            self._streams[key] = stream
+            return stream, True
+
+    def remove(self, stream):
+        with self._lock:
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+
+    def run(self, stream, produce, lock=None):
+        """
+        Drive a producer in a background thread and fan its output out to subscribers
+
+        Args:
+            stream: SharedStream created by get_or_create
+            produce: Callable returning an iterable of chunks (run while holding `lock`)
+            lock: Optional lock serializing access to the NPU
+        """
+        def worker():
+            chunks = None
+            try:
+                if lock is not None:
+                    lock.acquire()
+                try:
+                    chunks = produce()
+                    for chunk in chunks:
+                        stream.append(chunk)
+                        if stream.abandoned:
+                            logger.debug(f"All subscribers left, stopping generation {stream.key[:12]}")
+                            break
+                finally:
+                    if chunks is not None and hasattr(chunks, "close"):
+                        chunks.close()
+                    if lock is not None:
+                        lock.release()
+            except Exception as e:
+                logger.exception("Error in shared generation")
+                stream.append(f"{json.dumps({'error': str(e)})}\n")
+            finally:
+                self.remove(stream)
+                stream.finish()
+                metrics.observe("inflight.fanout", stream.total_subscribers)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        return thread
+
+
+registry = InflightRegistry()
@@ -0,0 +1,47 @@
+import threading
+import time
+
+# Process-wide counters and observations exposed by /api/metrics
+_lock = threading.Lock()
+_counters = {}
+_observations = {}
+_started_at = time.time()
+
+
+def increment(name, value=1):
+    """Increment a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """Record an observation (count, sum, min, max and last value are kept)"""
+    with _lock:
+        entry = _observations.get(name)
+        if entry is None:
+            _observations[name] = {"count": 1, "sum": value, "min": value, "max": value, "last": value}
+        else:
+            entry["count"] += 1
+            entry["sum"] += value
+            entry["min"] = min(entry["min"], value)
+            entry["max"] = max(entry["max"], value)
+            entry["last"] = value
+
+
+def get_counter(name, default=0):
+    """Get the current value of a counter"""
+    with _lock:
+        return _counters.get(name, default)
+
+
+def snapshot():
+    """Return a copy of all metrics, with averages computed for observations"""
+    with _lock:
+        observations = {}
+        for name, entry in _observations.items():
+            observations[name] = dict(entry, avg=entry["sum"] / entry["count"])
+        return {
+            "uptime": time.time() - _started_at,
+            "counters": dict(_counters),
+            "observations": observations
+        }
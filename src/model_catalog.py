@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import shutil
+import threading
+import time
+
+import config
+from . import metrics
+from .model_index import index as model_index
+from .model_metadata import cache as metadata_cache
+from .modelfile import cache as modelfile_cache
+from .model_utils import get_simplified_model_name, extract_model_details, initialize_model_mappings
+
+logger = logging.getLogger("rkllama.model_catalog")
+
+# inotify events that change the catalog (see inotify(7))
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# Quiet period after a change before the catalog is rebuilt (a download or copy emits many events)
+DEBOUNCE_SECONDS = 0.5
+
+
+class Inotify:
+    """Minimal inotify binding through libc, raises OSError where it is unavailable"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+    def add_watch(self, path):
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            logger.debug(f"inotify_add_watch({path}) failed: {os.strerror(errno)}")
+
+    def wait(self, timeout=None):
+        """Wait for events, return True if any were read (their content is not needed)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ModelCatalog:
+    """
+    In-memory catalog of the models directory.
+
+    Each model directory holding a .rkllm file is described once: file name,
+    size, mtime, simplified name, details and Modelfile content. Listings and
+    lookups are served from memory; the catalog is rebuilt when inotify
+    reports a change, or when a periodic scan sees one where inotify is not
+    available. Loose .rkllm files at the top of the models directory are moved
+    into their own directory during a refresh. New or modified model files are
+    handed to the model index to compute their digest.
+    """
+
+    def __init__(self, models_dir=None, watch="inotify", poll_seconds=30.0):
+        self.models_dir = models_dir or config.get_path("models")
+        self.watch = watch
+        self.poll_seconds = poll_seconds
+        self.available = False
+        self._entries = {}
+        self._signature = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            watch=config.get("model", "catalog_watch", "inotify"),
+            poll_seconds=config.get("model", "catalog_poll_seconds", 30.0, as_type=float)
+        )
+
+    def models(self):
+        """Entries of all models, sorted by directory name"""
+        entries = self._entries
+        return [entries[name] for name in sorted(entries)]
+
+    def get(self, name):
+        return self._entries.get(name)
+
+    def names(self):
+        return list(self._entries)
+
+    def _relocate_loose_files(self):
+        for file in os.listdir(self.models_dir):
+            if not file.endswith(".rkllm") or not os.path.isfile(os.path.join(self.models_dir, file)):
+                continue
+            model_dir = os.path.join(self.models_dir, os.path.splitext(file)[0])
+            os.makedirs(model_dir, exist_ok=True)
+            shutil.move(os.path.join(self.models_dir, file), os.path.join(model_dir, file))
+            logger.info(f"Moved {file} into its own model directory")
+
+    def _scan(self):
+        """Describe every model directory, returns (entries, signature)"""
+        entries = {}
+        signature = []
+        for name in os.listdir(self.models_dir):
+            model_dir = os.path.join(self.models_dir, name)
+            if not os.path.isdir(model_dir):
+                continue
+            files = sorted(os.listdir(model_dir))
+            model_file = next((file for file in files if file.endswith(".rkllm")), None)
+            if model_file is None:
+                continue
+
+            path = os.path.join(model_dir, model_file)
+            stat = os.stat(path)
+            modelfile_path = os.path.join(model_dir, "Modelfile")
+            modelfile = ""
+            modelfile_mtime = None
+            if os.path.exists(modelfile_path):
+                modelfile_mtime = os.path.getmtime(modelfile_path)
+                with open(modelfile_path, "r") as f:
+                    modelfile = f.read()
+            model_config = modelfile_cache.get(modelfile_path)
+            metadata = metadata_cache.get(path, model_dir, model_config.huggingface_path if model_config else None)
+            details = extract_model_details(name)
+            if metadata and metadata["quantization"]:
+                details["quantization_level"] = metadata["quantization"]
+
+            entries[name] = {
+                "name": name,
+                "simple_name": get_simplified_model_name(name),
+                "dir": model_dir,
+                "file": model_file,
+                "path": path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "details": details,
+                "modelfile": modelfile,
+                "modelfile_mtime": modelfile_mtime,
+                "metadata": metadata or {}
+            }
+            signature.append((name, tuple(files), stat.st_size, stat.st_mtime_ns, modelfile_mtime,
+                              entries[name]["metadata"].get("extracted_at")))
+        return entries, tuple(sorted(signature))
+
+    def refresh(self, force=True):
+        """Rebuild the catalog, only when something changed unless `force`"""
+        with self._lock:
+            started = time.time()
+            if not os.path.isdir(self.models_dir):
+                logger.warning(f"Models directory not found: {self.models_dir}")
+                self.available = False
+                self._entries = {}
+                self._signature = None
+                initialize_model_mappings([])
+                return
+
+            self._relocate_loose_files()
+            entries, signature = self._scan()
+            self.available = True
+            if not force and signature == self._signature:
+                return
+
+            self._entries = entries
+            self._signature = signature
+            initialize_model_mappings(list(entries))
+            model_index.schedule(entry["path"] for entry in entries.values())
+            metrics.increment("catalog.refreshes")
+            metrics.observe("catalog.refresh_ms", (time.time() - started) * 1000)
+            logger.debug(f"Model catalog refreshed: {len(entries)} models")
+
+    def start(self):
+        """Build the catalog and keep it current in the background"""
+        self.refresh()
+        if self.watch == "off" or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="rkllama-model-catalog", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        inotify = None
+        if self.watch == "inotify":
+            try:
+                inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logger.info(f"inotify unavailable ({e}), polling the models directory every "
+                            f"{self.poll_seconds:g}s")
+
+        while True:
+            try:
+                if inotify is None:
+                    time.sleep(self.poll_seconds)
+                    self.refresh(force=False)
+                    continue
+
+                # Watches are (re)added after each refresh, for new model directories
+                inotify.add_watch(self.models_dir)
+                for name in os.listdir(self.models_dir):
+                    if os.path.isdir(os.path.join(self.models_dir, name)):
+                        inotify.add_watch(os.path.join(self.models_dir, name))
+
+                if inotify.wait(self.poll_seconds):
+                    while inotify.wait(DEBOUNCE_SECONDS):
+                        pass
+                    self.refresh(force=False)
+            except Exception:
+                logger.exception("Error while watching the models directory")
+                time.sleep(self.poll_seconds)
+
+
+catalog = ModelCatalog.from_config()
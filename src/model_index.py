@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+from . import metrics
+
+logger = logging.getLogger("rkllama.model_index")
+
+READ_SIZE = 8 * 1024 * 1024
+
+
+class ModelIndex:
+    """
+    Persistent index of the SHA-256 digests of model files.
+
+    Digests are stored in a JSON file with the size and mtime of the file
+    they were computed from, and reused as long as both are unchanged. Files
+    are hashed once, in a background thread, with large sequential reads
+    throttled to `rate_bytes` per second so that hashing doesn't starve model
+    loading on slow storage.
+    """
+
+    def __init__(self, path, enabled=True, rate_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.enabled = enabled
+        self.rate_bytes = rate_bytes
+        self._entries = {}  # real path -> {"size", "mtime_ns", "digest"}
+        self._pending = []
+        self._current = None  # {"path", "size", "done"} while a file is hashed
+        self._hashed = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self.listeners = []  # called with (path, digest) for each file with a known digest
+        self._load()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            os.path.join(config.get_path("data"), "model_index.json"),
+            enabled=config.get("model", "digest_enabled", True, as_type=bool),
+            rate_bytes=config.get("model", "digest_rate_mb", 64, as_type=int) * 1024 * 1024
+        )
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                self._entries = json.load(f).get("files", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable model index {self.path}: {e}")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with self._condition:
+            data = json.dumps({"files": self._entries}, indent=1, sort_keys=True)
+        with open(temp_path, "w") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+    def digest(self, path):
+        """SHA-256 of a file as hex, or None while it is unknown or outdated"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = self._entries.get(os.path.realpath(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["digest"]
+        return None
+
+    def record(self, path, digest):
+        """Store the digest of a file known without reading it (e.g. a link to an indexed file)"""
+        stat = os.stat(path)
+        with self._condition:
+            self._entries[os.path.realpath(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                                     "digest": digest}
+        self._save()
+
+    def _notify(self, path, digest):
+        for listener in self.listeners:
+            try:
+                listener(path, digest)
+            except Exception:
+                logger.exception(f"Model index listener failed for {path}")
+
+    def schedule(self, paths):
+        """Queue the files whose digest is unknown or outdated for hashing"""
+        if not self.enabled:
+            return
+        known = []
+        with self._condition:
+            for path in paths:
+                real_path = os.path.realpath(path)
+                digest = self.digest(real_path)
+                if digest is not None:
+                    known.append((real_path, digest))
+                elif real_path not in self._pending:
+                    self._pending.append(real_path)
+            if self._pending and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rkllm-model-index", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        for path, digest in known:
+            self._notify(path, digest)
+
+    def progress(self):
+        with self._condition:
+            current = dict(self._current) if self._current else None
+            pending = list(self._pending)
+        pending_bytes = 0
+        for path in pending:
+            try:
+                pending_bytes += os.path.getsize(path)
+            except OSError:
+                pass
+        return {
+            "enabled": self.enabled,
+            "indexed": len(self._entries),
+            "hashed": self._hashed,
+            "pending": len(pending),
+            "pending_bytes": pending_bytes,
+            "current": current,
+            "rate_limit_bytes": self.rate_bytes
+        }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                path = self._pending[0]
+            try:
+                self._hash(path)
+            except OSError as e:
+                logger.warning(f"Cannot hash {path}: {e}")
+            finally:
+                with self._condition:
+                    self._current = None
+                    if path in self._pending:
+                        self._pending.remove(path)
+
+    def _hash(self, path):
+        stat = os.stat(path)
+        if self.digest(path) is not None:
+            return
+        with self._condition:
+            self._current = {"path": path, "size": stat.st_size, "done": 0}
+
+        started = time.time()
+        sha256 = hashlib.sha256()
+        buffer = bytearray(READ_SIZE)
+        view = memoryview(buffer)
+        done = 0
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                sha256.update(view[:count])
+                done += count
+                self._current["done"] = done
+                if self.rate_bytes > 0:
+                    # Sleep off the time the reads were ahead of the rate limit
+                    ahead = done / self.rate_bytes - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            if hasattr(os, "posix_fadvise"):
+                # Hashing shouldn't push the loaded model out of the page cache
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        if os.stat(path).st_mtime_ns != stat.st_mtime_ns:
+            # Modified while it was read, hash it again later
+            logger.debug(f"{path} changed while hashing")
+            return
+
+        with self._condition:
+            self._entries[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": sha256.hexdigest()}
+            self._hashed += 1
+        self._save()
+        self._notify(path, sha256.hexdigest())
+        elapsed = time.time() - started
+        metrics.observe("model_index.hash_seconds", elapsed)
+        logger.info(f"Indexed {os.path.basename(path)} ({stat.st_size / 1024 ** 2:.0f} MB in {elapsed:.1f}s)")
+
+
+index = ModelIndex.from_config()
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from . import metrics
+from .model_utils import QUANT_MAPPING
+
+logger = logging.getLogger("rkllama.model_metadata")
+
+# Bytes at the start of a .rkllm file searched for the metadata written by the toolkit
+HEADER_BYTES = 1024 * 1024
+
+# Ollama model_info keys (prefixed by the architecture) and the config.json fields they come from
+CONFIG_FIELDS = {
+    "attention.head_count": "num_attention_heads",
+    "attention.head_count_kv": "num_key_value_heads",
+    "attention.layer_norm_rms_epsilon": "rms_norm_eps",
+    "block_count": "num_hidden_layers",
+    "context_length": "max_position_embeddings",
+    "embedding_length": "hidden_size",
+    "feed_forward_length": "intermediate_size",
+    "rope.freq_base": "rope_theta",
+    "vocab_size": "vocab_size",
+}
+
+# Keys of the .rkllm header metadata
+HEADER_CONTEXT_KEYS = ("max_context_len", "max_context", "max_seq_len")
+HEADER_ARCHITECTURE_KEYS = ("model_type", "architecture")
+HEADER_QUANTIZATION_KEYS = ("quantized_dtype", "dtype", "quant_type")
+HEADER_PLATFORM_KEYS = ("target_platform", "platform")
+
+# Context lengths the RKLLM runtime accepts for max_context_len
+MIN_CONTEXT_LENGTH = 256
+MAX_CONTEXT_LENGTH = 131072
+
+HEADER_VALUE_PATTERN = re.compile(
+    rb'"?(max_context_len|max_context|max_seq_len|model_type|quantized_dtype|quant_type|target_platform)"?'
+    rb'\s*[:=]\s*"?([A-Za-z0-9_.\-]+)"?')
+
+
+def read_rkllm_header(path):
+    """
+    Metadata embedded at the start of a .rkllm file
+
+    The container format of the toolkit is not documented; the export settings
+    (max context, quantization, platform) and the model configuration are
+    stored as text in the header. JSON objects and key/value pairs found in the
+    first HEADER_BYTES are collected, unknown layouts give an empty result.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER_BYTES)
+    except OSError:
+        return {}
+
+    found = {}
+    decoder = json.JSONDecoder()
+    text = header.decode("latin-1")
+    position = text.find("{")
+    while position != -1:
+        try:
+            value, end = decoder.raw_decode(text, position)
+        except ValueError:
+            position = text.find("{", position + 1)
+            continue
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if isinstance(item, (str, int, float)):
+                    found.setdefault(key, item)
+        position = text.find("{", end)
+
+    for match in HEADER_VALUE_PATTERN.finditer(header):
+        key = match.group(1).decode()
+        value = match.group(2).decode()
+        found.setdefault(key, int(value) if value.isdigit() else value)
+    return found
+
+
+def find_config_json(model_dir, huggingface_path=None):
+    """
+    Hugging Face config.json of a model: in its directory, or else in the local
+    Hugging Face cache (downloaded with the tokenizer), never from the network
+    """
+    path = os.path.join(model_dir, "config.json")
+    if os.path.exists(path):
+        return path
+    if huggingface_path:
+        try:
+            from huggingface_hub import try_to_load_from_cache
+            cached = try_to_load_from_cache(huggingface_path, "config.json")
+        except Exception:
+            return None
+        if isinstance(cached, str) and os.path.exists(cached):
+            return cached
+    return None
+
+
+def read_config_json(path):
+    if path is None:
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable {path}: {e}")
+        return None
+
+
+def first_value(values, keys):
+    return next((values[key] for key in keys if values.get(key) not in (None, "")), None)
+
+
+def valid_context_length(value, max_position_embeddings=None):
+    """
+    Whether a context length found in a .rkllm header can be trusted
+
+    The header is scanned without knowing its layout, so the value must look
+    like an exported context: a power of two, or a multiple of 1024, within
+    the range the runtime accepts, and no longer than the context the model
+    was trained for when config.json says so.
+    """
+    if isinstance(value, bool) or not isinstance(value, int):
+        return False
+    if not MIN_CONTEXT_LENGTH <= value <= MAX_CONTEXT_LENGTH:
+        return False
+    if value & (value - 1) and value % 1024:
+        return False
+    if isinstance(max_position_embeddings, int) and value > max_position_embeddings:
+        return False
+    return True
+
+
+def extract_metadata(model_path, config_path=None):
+    """
+    Describe a model from its .rkllm header and config.json (see find_config_json)
+
+    Returns:
+        Dictionary with "architecture", "context_length" (the maximum the model
+        was exported with), "quantization", "platform" and "model_info" (Ollama
+        keys without the architecture prefix), each None or empty when unknown
+    """
+    header = read_rkllm_header(model_path)
+    model_config = read_config_json(config_path) or {}
+
+    architecture = first_value(header, HEADER_ARCHITECTURE_KEYS) or model_config.get("model_type")
+    quantization = first_value(header, HEADER_QUANTIZATION_KEYS)
+
+    # Sub-configs of multimodal models hold the language model fields
+    text_config = model_config.get("text_config") or model_config
+    model_info = {name: text_config[field] for name, field in CONFIG_FIELDS.items()
+                  if isinstance(text_config.get(field), (int, float))}
+
+    context_length = first_value(header, HEADER_CONTEXT_KEYS)
+    if context_length is not None and not valid_context_length(context_length,
+                                                               text_config.get("max_position_embeddings")):
+        logger.warning(f"Ignoring implausible context length {context_length!r} in the header of {model_path}")
+        context_length = None
+    if context_length is not None:
+        # The runtime is limited to the context the model was exported with
+        model_info["context_length"] = context_length
+
+    return {
+        "architecture": architecture,
+        "context_length": context_length,
+        "quantization": QUANT_MAPPING.get(str(quantization).lower(), quantization) if quantization else None,
+        "platform": first_value(header, HEADER_PLATFORM_KEYS),
+        "model_info": model_info,
+        "sources": [name for name, values in (("rkllm", header), ("config.json", model_config)) if values],
+        "extracted_at": time.time()
+    }
+
+
+class MetadataCache:
+    """Extracted metadata by model file, recomputed when the file or its config changes"""
+
+    def __init__(self):
+        self._entries = {}  # model path -> (signature, metadata)
+        self._lock = threading.Lock()
+
+    def get(self, model_path, model_dir, huggingface_path=None):
+        """Metadata of a model file (see extract_metadata), None when the file doesn't exist"""
+        try:
+            stat = os.stat(model_path)
+        except OSError:
+            return None
+        config_path = find_config_json(model_dir, huggingface_path)
+        config_mtime = os.path.getmtime(config_path) if config_path else None
+        signature = (stat.st_size, stat.st_mtime_ns, config_path, config_mtime)
+
+        cached = self._entries.get(model_path)
+        if cached is not None and cached[0] == signature:
+            metrics.increment("model_metadata.hits")
+            return cached[1]
+
+        started = time.time()
+        metadata = extract_metadata(model_path, config_path)
+        metrics.observe("model_metadata.extract_ms", (time.time() - started) * 1000)
+        with self._lock:
+            self._entries[model_path] = (signature, metadata)
+        return metadata
+
+
+cache = MetadataCache()
@@ -12,6 +12,7 @@ logger = logging.getLogger("rkllama.model_utils")
 SIMPLE_TO_FULL_MAP = {}  # Maps simplified names (e.g., "qwen2:3b") to full paths
 FULL_TO_SIMPLE_MAP = {}  # Maps full paths to simplified names
 TAG_TO_MODEL_MAP = {}  # Maps tag names from /api/tags to real model names
+MODEL_DIRS = []  # Model directory names known to the mappings
 
 # Mapping from RKLLM quantization types to Ollama-style formats
 QUANT_MAPPING = {
@@ -25,12 +26,15 @@ QUANT_MAPPING = {
     'w8a8_g512': 'Q8_K_M',
 }
 
-def get_huggingface_model_info(model_path):
+def get_huggingface_model_info(model_path, timeout=5, raise_errors=False):
     """
     Fetch model metadata from Hugging Face API if available.
     
     Args:
         model_path: HuggingFace repository path (e.g., 'c01zaut/Qwen2.5-3B-Instruct-RK3588-1.1.4')
+        timeout: Timeout of the API request in seconds
+        raise_errors: Raise requests.RequestException when the API can't be reached,
+            instead of returning None as for a model that doesn't exist
         
     Returns:
         Dictionary with enhanced model metadata or None if not available
@@ -44,7 +48,7 @@ def get_huggingface_model_info(model_path):
         
         # Extract repo_id from HUGGINGFACE_PATH
         url = f"https://huggingface.co/api/models/{model_path}"
-        response = requests.get(url, timeout=5)
+        response = requests.get(url, timeout=timeout)
         
         if response.status_code == 200:
             data = response.json()
@@ -158,10 +162,14 @@ def get_huggingface_model_info(model_path):
             
             return data
         else:
+            if raise_errors and response.status_code >= 500:
+                response.raise_for_status()
             if debug_mode:
                 logger.debug(f"Failed to get HF data: {response.status_code}")
             return None
     except Exception as e:
+        if raise_errors and isinstance(e, requests.RequestException):
+            raise
         debug_mode = config.is_debug_mode()
         if debug_mode:
             logger.exception(f"Error fetching HF model info: {str(e)}")
@@ -356,38 +364,45 @@ def get_original_model_path(simplified_name):
         return SIMPLE_TO_FULL_MAP[simplified_name]
     return None
 
-def initialize_model_mappings():
+def initialize_model_mappings(model_dirs=None):
     """
-    Initialize the model name mappings by scanning the models directory
-    This should be called at server startup
+    Initialize the model name mappings
+    
+    Args:
+        model_dirs: Names of the model directories (from the model catalog),
+            the models directory is scanned when omitted
     """
     global SIMPLE_TO_FULL_MAP, FULL_TO_SIMPLE_MAP, TAG_TO_MODEL_MAP
     SIMPLE_TO_FULL_MAP.clear()
     FULL_TO_SIMPLE_MAP.clear()
     TAG_TO_MODEL_MAP.clear()
     
-    # Use config module to get models directory path
-    models_dir = config.get_path("models")
-    
-    if not os.path.exists(models_dir):
-        logger.warning(f"Models directory not found: {models_dir}")
-        return
+    if model_dirs is None:
+        # Use config module to get models directory path
+        models_dir = config.get_path("models")
+        
+        if not os.path.exists(models_dir):
+            logger.warning(f"Models directory not found: {models_dir}")
+            MODEL_DIRS[:] = []
+            return
+        
+        model_dirs = [model_dir for model_dir in os.listdir(models_dir)
+                      if os.path.isdir(os.path.join(models_dir, model_dir))
+                      and any(f.endswith('.rkllm') for f in os.listdir(os.path.join(models_dir, model_dir)))]
+    MODEL_DIRS[:] = model_dirs
     
     # First pass: Create simplified names for all models
     model_names = {}  # Maps simple name to a list of full model names
     
-    for model_dir in os.listdir(models_dir):
-        full_path = os.path.join(models_dir, model_dir)
-        
-        if os.path.isdir(full_path) and any(f.endswith('.rkllm') for f in os.listdir(full_path)):
-            simple_name = get_simplified_model_name(model_dir)
+    for model_dir in model_dirs:
+        simple_name = get_simplified_model_name(model_dir)
 
-            # Build tag alias mapping for Open WebUI
-            TAG_TO_MODEL_MAP[simple_name] = model_dir    
-    
-            if simple_name not in model_names:
-                model_names[simple_name] = []
-            model_names[simple_name].append(model_dir)
+        # Build tag alias mapping for Open WebUI
+        TAG_TO_MODEL_MAP[simple_name] = model_dir    
+
+        if simple_name not in model_names:
+            model_names[simple_name] = []
+        model_names[simple_name].append(model_dir)
     
     # Second pass: Handle collisions by detecting differences
     for simple_name, full_names in model_names.items():
@@ -503,22 +518,14 @@ def find_model_by_name(name):
         return TAG_TO_MODEL_MAP[name]
 
     
-    # Check if it's a fully qualified path that exists directly
-    models_dir = config.get_path("models")
-    direct_path = os.path.join(models_dir, name)
-    if os.path.isdir(direct_path):
-        # It exists directly, make sure we use the collision-aware name
-        return name
-    
     # Try case-insensitive matching
     for full_name in FULL_TO_SIMPLE_MAP.keys():
         if name.lower() == full_name.lower():
             return full_name
             
     # Check if any of the model directories contain the name
-    for model_dir in os.listdir(models_dir):
-        full_path = os.path.join(models_dir, model_dir)
-        if os.path.isdir(full_path) and name.lower() in model_dir.lower():
+    for model_dir in MODEL_DIRS:
+        if name.lower() in model_dir.lower():
             return model_dir
     
     # If we get here, the model was not found
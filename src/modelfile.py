@@ -0,0 +1,117 @@
+import logging
+import os
+import re
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger("rkllama.modelfile")
+
+# KEY=value lines, as written for python-dotenv: optional "export", double quoted values (with
+# escapes, possibly spanning lines), single quoted values, or bare values ending at a " #" comment
+LINE_PATTERN = re.compile(r"""
+    ^[ \t]*(?:export[ \t]+)?(?P<key>[A-Za-z_][A-Za-z0-9_.]*)[ \t]*=[ \t]*
+    (?:
+        (?:"(?P<double>(?:\\.|[^"\\])*)"|'(?P<single>(?:\\.|[^'\\])*)')[ \t]*(?:\#[^\n]*)?
+        |(?P<bare>[^\n]*?)(?:[ \t]+\#[^\n]*)?
+    )[ \t]*$""", re.MULTILINE | re.VERBOSE)
+
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", '"': '"', "'": "'", "\\": "\\"}
+
+
+def parse_values(text):
+    """Values of a Modelfile by key, the last one winning when a key is repeated"""
+    values = {}
+    for match in LINE_PATTERN.finditer(text):
+        if match.group("double") is not None:
+            value = re.sub(r"\\(.)", lambda escape: ESCAPES.get(escape.group(1), escape.group(0)),
+                           match.group("double"), flags=re.DOTALL)
+        elif match.group("single") is not None:
+            value = match.group("single").replace("\\'", "'")
+        else:
+            value = match.group("bare").strip()
+        values[match.group("key")] = value
+    return values
+
+
+class ModelfileError(ValueError):
+    """A Modelfile that a model can't be loaded with"""
+
+
+class ModelfileConfig:
+    """
+    Settings of a model, read from its Modelfile.
+
+    Known keys are exposed as typed attributes; every value stays available in
+    `values`. Invalid values are reported by `validate`, which also requires
+    FROM and HUGGINGFACE_PATH, rather than when parsing, so that listing and
+    showing a model never fail on its Modelfile.
+    """
+
+    def __init__(self, values, path=None):
+        self.path = path
+        self.values = values
+        self.errors = []
+        self.model_file = values.get("FROM") or None
+        self.huggingface_path = values.get("HUGGINGFACE_PATH") or None
+        self.system = values.get("SYSTEM", "")
+        self.template = values.get("TEMPLATE") or None
+        self.license = values.get("LICENSE", "")
+        self.tokenizer = values.get("TOKENIZER") or None
+        self.temperature = None
+        if values.get("TEMPERATURE"):
+            try:
+                self.temperature = float(values["TEMPERATURE"])
+            except ValueError:
+                self.errors.append(f"TEMPERATURE is not a number: {values['TEMPERATURE']}")
+
+    @classmethod
+    def parse(cls, text, path=None):
+        return cls(parse_values(text), path)
+
+    def validate(self):
+        """Raise ModelfileError when a model can't be loaded with this Modelfile"""
+        if not self.model_file or not self.huggingface_path:
+            raise ModelfileError("FROM or HUGGINGFACE_PATH not defined in Modelfile.")
+        if self.errors:
+            raise ModelfileError("; ".join(self.errors))
+        return self
+
+
+class ModelfileCache:
+    """Parsed Modelfiles by path, parsed again when the file changes"""
+
+    def __init__(self):
+        self._entries = {}  # path -> ((mtime, size), ModelfileConfig)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """ModelfileConfig of a Modelfile, None when it doesn't exist"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._entries.get(path)
+        if cached is not None and cached[0] == signature:
+            metrics.increment("modelfile.cache_hits")
+            return cached[1]
+
+        metrics.increment("modelfile.cache_misses")
+        started = time.time()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                modelfile = ModelfileConfig.parse(f.read(), path)
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Cannot read {path}: {e}")
+            return None
+        metrics.observe("modelfile.parse_ms", (time.time() - started) * 1000)
+        for error in modelfile.errors:
+            logger.warning(f"{path}: {error}")
+        with self._lock:
+            self._entries[path] = (signature, modelfile)
+        return modelfile
+
+
+cache = ModelfileCache()
@@ -0,0 +1,355 @@
+import atexit
+import importlib
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+import config
+import src.variables as variables
+from . import metrics
+
+logger = logging.getLogger("rkllama.npu_worker")
+
+# Ring buffer records
+RECORD_TEXT = 0
+RECORD_END = 1
+
+_HEADER = struct.Struct("<QQ")  # write position, read position
+_POSITION = struct.Struct("<Q")
+_RECORD = struct.Struct("<iI")  # record type, payload length
+
+
+class WorkerCrashedError(RuntimeError):
+    """The NPU worker process died while serving a request"""
+
+
+class TokenRing:
+    """
+    Single-producer single-consumer ring buffer in shared memory.
+
+    The worker writes decoded text records, the front-end reads them. Positions
+    are monotonic byte counters stored in the header; the lock only guards the
+    header updates so that they are seen after the payload on both sides.
+    """
+
+    def __init__(self, shm, lock):
+        self.shm = shm
+        self.lock = lock
+        self.capacity = shm.size - _HEADER.size
+
+    @classmethod
+    def create(cls, capacity, lock):
+        shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + capacity)
+        _HEADER.pack_into(shm.buf, 0, 0, 0)
+        return cls(shm, lock)
+
+    @classmethod
+    def attach(cls, name, lock):
+        return cls(shared_memory.SharedMemory(name=name), lock)
+
+    def _positions(self):
+        with self.lock:
+            return _HEADER.unpack_from(self.shm.buf, 0)
+
+    def _copy_in(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        base = _HEADER.size
+        self.shm.buf[base + offset:base + offset + first] = data[:first]
+        if first < len(data):
+            self.shm.buf[base:base + len(data) - first] = data[first:]
+
+    def _copy_out(self, position, length):
+        offset = position % self.capacity
+        first = min(length, self.capacity - offset)
+        base = _HEADER.size
+        data = bytes(self.shm.buf[base + offset:base + offset + first])
+        if first < length:
+            data += bytes(self.shm.buf[base:base + length - first])
+        return data
+
+    def write(self, record_type, payload=b""):
+        """Append a record, waiting for the reader when the buffer is full"""
+        limit = self.capacity // 2 - _RECORD.size
+        for start in range(0, max(len(payload), 1), max(limit, 1)):
+            chunk = payload[start:start + limit]
+            record = _RECORD.pack(record_type, len(chunk)) + chunk
+            while True:
+                write_position, read_position = self._positions()
+                if self.capacity - (write_position - read_position) >= len(record):
+                    break
+                time.sleep(0.001)
+            self._copy_in(write_position, record)
+            with self.lock:
+                _POSITION.pack_into(self.shm.buf, 0, write_position + len(record))
+
+    def read(self):
+        """Return the list of (record_type, payload) records available"""
+        write_position, read_position = self._positions()
+        records = []
+        position = read_position
+        while write_position - position >= _RECORD.size:
+            record_type, length = _RECORD.unpack(self._copy_out(position, _RECORD.size))
+            records.append((record_type, self._copy_out(position + _RECORD.size, length)))
+            position += _RECORD.size + length
+        if position != read_position:
+            with self.lock:
+                _POSITION.pack_into(self.shm.buf, _POSITION.size, position)
+        return records
+
+    def reset(self):
+        with self.lock:
+            _HEADER.pack_into(self.shm.buf, 0, 0, 0)
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _RingTextList(list):
+    """Stands in for variables.global_text in the worker: the callback's text goes to the ring"""
+
+    def __init__(self, ring):
+        super().__init__()
+        self.ring = ring
+
+    def append(self, text):
+        self.ring.write(RECORD_TEXT, text.encode("utf-8"))
+
+
+def worker_main(conn, shm_name, lock):
+    """Entry point of the worker process, which owns the RKLLM runtime"""
+    ring = TokenRing.attach(shm_name, lock)
+
+    # The runtime callback appends to the global_text of its own module
+    # (src.callback is shadowed by the ctypes callback object on the package)
+    from .rkllm import RKLLM
+    callback_module = importlib.import_module(".callback", __package__)
+    variables.global_text = callback_module.global_text = _RingTextList(ring)
+
+    model = None
+    run_thread = None
+
+    def run_model(tokens):
+        try:
+            model.run(tokens)
+        finally:
+            ring.write(RECORD_END)
+
+    while True:
+        try:
+            command, args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        try:
+            if command == "load":
+                model = RKLLM(**args)
+            elif command == "run":
+                run_thread = threading.Thread(target=run_model, args=(args,), daemon=True)
+                run_thread.start()
+            elif command == "abort":
+                if model is not None:
+                    model.abort()
+            elif command == "release":
+                if run_thread is not None:
+                    run_thread.join()
+                if model is not None:
+                    model.release()
+                    model = None
+            elif command == "shutdown":
+                conn.send(("ok", None))
+                break
+            conn.send(("ok", None))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+    ring.close()
+
+
+class WorkerSupervisor:
+    """
+    Runs the NPU worker process and restarts it when it dies.
+
+    Commands go through a pipe, generated text comes back through a shared
+    memory TokenRing. After a crash, the model that was loaded is loaded again
+    in the new worker, and requests that were running fail with
+    WorkerCrashedError.
+    """
+
+    def __init__(self, ring_bytes=256 * 1024):
+        self.ring_bytes = ring_bytes
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.conn = None
+        self.ring = None
+        self.model_args = None
+        self.generation = 0  # Incremented on each (re)start
+        self._lock = threading.RLock()
+        self._stopping = False
+        self._monitor = None
+
+    def start(self):
+        with self._lock:
+            if self.ring is not None:
+                # A request may still be reading the old ring, it is closed once unreferenced
+                self.ring.shm.unlink()
+            self.ring = TokenRing.create(self.ring_bytes, self.context.Lock())
+            self.conn, child_conn = self.context.Pipe()
+            self.process = self.context.Process(target=worker_main, name="rkllama-npu-worker",
+                                                args=(child_conn, self.ring.shm.name, self.ring.lock),
+                                                daemon=True)
+            self.process.start()
+            child_conn.close()
+            self.generation += 1
+            logger.info(f"NPU worker started (pid {self.process.pid})")
+
+        if self._monitor is None:
+            self._monitor = threading.Thread(target=self._watch, name="rkllama-npu-supervisor", daemon=True)
+            self._monitor.start()
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def _watch(self):
+        while not self._stopping:
+            time.sleep(1)
+            if self._stopping or self.alive():
+                continue
+            logger.error(f"NPU worker died (exit code {self.process.exitcode}), restarting")
+            metrics.increment("npu_worker.restarts")
+            try:
+                self.restart()
+            except Exception:
+                logger.exception("Failed to restart the NPU worker")
+
+    def restart(self):
+        with self._lock:
+            self.start()
+            if self.model_args is not None:
+                self.request("load", self.model_args)
+
+    def request(self, command, args=None):
+        """Send a command to the worker and wait for its reply"""
+        with self._lock:
+            if not self.alive():
+                raise WorkerCrashedError("NPU worker is not running")
+            try:
+                self.conn.send((command, args))
+                while not self.conn.poll(0.1):
+                    if not self.alive():
+                        raise WorkerCrashedError(f"NPU worker died during '{command}'")
+                status, message = self.conn.recv()
+            except (EOFError, OSError) as e:
+                raise WorkerCrashedError(f"NPU worker connection lost: {e}")
+            if status != "ok":
+                raise RuntimeError(message)
+            if command == "load":
+                self.model_args = args
+            elif command == "release":
+                self.model_args = None
+
+    def stop(self):
+        self._stopping = True
+        with self._lock:
+            if self.alive():
+                try:
+                    self.request("shutdown")
+                except Exception:
+                    pass
+                self.process.join(timeout=5)
+                if self.process.is_alive():
+                    self.process.kill()
+            if self.ring is not None:
+                self.ring.close(unlink=True)
+                self.ring = None
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor():
+    """Start the worker on first use"""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = WorkerSupervisor(config.get("worker", "ring_buffer_kb", 256, as_type=int) * 1024)
+            _supervisor.start()
+            atexit.register(_supervisor.stop)
+        return _supervisor
+
+
+def is_enabled():
+    return config.get("worker", "enabled", False, as_type=bool)
+
+
+class RKLLMProxy:
+    """
+    Drop-in replacement for RKLLM backed by the NPU worker process.
+
+    run() blocks until the generation ends and feeds the generated text into
+    variables.global_text, like the runtime callback does in-process. When the
+    worker dies during a run, `error` is set to a WorkerCrashedError.
+    """
+
+    def __init__(self, model_path, model_dir, temperature=0.8, context_length=2048, lora_model_path=None,
+                 prompt_cache_path=None):
+        self.format_schema = None
+        self.format_type = None
+        self.format_options = {}
+        self.model_dir = model_dir
+        self.model_path = model_path
+        self.temperature = temperature
+        self.context_length = context_length
+        self.error = None
+
+        self.supervisor = get_supervisor()
+        self.supervisor.request("load", {
+            "model_path": model_path,
+            "model_dir": model_dir,
+            "temperature": temperature,
+            "context_length": context_length,
+            "lora_model_path": lora_model_path,
+            "prompt_cache_path": prompt_cache_path
+        })
+
+    def run(self, prompt_tokens):
+        self.error = None
+        if prompt_tokens[-1] != 2:
+            prompt_tokens.append(2)
+
+        supervisor = self.supervisor
+        generation = supervisor.generation
+        ring = supervisor.ring
+        ring.reset()
+        try:
+            supervisor.request("run", list(prompt_tokens))
+        except WorkerCrashedError as e:
+            self.error = e
+            return
+
+        while True:
+            for record_type, payload in ring.read():
+                if record_type == RECORD_END:
+                    return
+                variables.global_text.append(payload.decode("utf-8"))
+            if supervisor.generation != generation or not supervisor.alive():
+                self.error = WorkerCrashedError("NPU worker crashed during generation")
+                return
+            time.sleep(0.002)
+
+    def abort(self):
+        try:
+            self.supervisor.request("abort")
+        except WorkerCrashedError:
+            pass
+
+    def release(self):
+        try:
+            self.supervisor.request("release")
+        except WorkerCrashedError:
+            self.supervisor.model_args = None
@@ -0,0 +1,80 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+import config
+from . import metrics
+
+logger = logging.getLogger("rkllama.peers")
+
+
+class Peers:
+    """
+    Other RKLLAMA servers of the LAN to fetch model files from before the Hub.
+
+    Peers are asked in parallel whether they hold a file, by digest when it is
+    known, or else by Hugging Face repo and file name. The first one holding it
+    serves it from its blob endpoint, which supports ranges like the Hub does.
+    """
+
+    def __init__(self, urls=(), timeout=2.0):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls):
+        urls = config.get("download", "peers", "")
+        return cls(
+            urls=[url.strip() for url in urls.split(",") if url.strip()],
+            timeout=config.get("download", "peer_timeout", 2.0, as_type=float)
+        )
+
+    def _ask(self, url, model, sha256):
+        """Where a peer serves the file, None when it doesn't have it"""
+        if sha256:
+            response = requests.head(f"{url}/api/blobs/sha256:{sha256}", timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            response = requests.post(f"{url}/api/peer/lookup", json={"model": model}, timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            sha256 = response.json()["digest"].replace("sha256:", "", 1)
+            size = response.json()["size"]
+        return {"peer": url, "url": f"{url}/api/blobs/sha256:{sha256}", "sha256": sha256, "size": size}
+
+    def locate(self, model, sha256=None):
+        """
+        Find a peer holding a model file
+
+        Args:
+            model: Hugging Face repo and file name, as given to /pull
+            sha256: Digest of the file, when known
+
+        Returns:
+            {"peer", "url", "sha256", "size"} of the first peer found, or None
+        """
+        if not self.urls:
+            return None
+        executor = ThreadPoolExecutor(max_workers=len(self.urls), thread_name_prefix="rkllama-peers")
+        try:
+            futures = [executor.submit(self._ask, url, model, sha256) for url in self.urls]
+            for future in as_completed(futures):
+                try:
+                    source = future.result()
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    logger.debug(f"Peer lookup failed: {e}")
+                    continue
+                if source is not None:
+                    metrics.increment("peers.hits")
+                    return source
+        finally:
+            # Don't wait for slower peers once one has the file
+            executor.shutdown(wait=False)
+        metrics.increment("peers.misses")
+        return None
+
+
+peers = Peers.from_config()
@@ -7,6 +7,7 @@ import logging
 from config import is_debug_mode  # Import the config module
 from .format_utils import create_format_instruction, validate_format_response
 from src.model_utils import get_simplified_model_name  # Import at the top level
+from .chunk_format import chat_chunk
 
 logger = logging.getLogger("rkllama.process")
 
@@ -16,15 +17,13 @@ DEBUG_MODE = is_debug_mode()
 import os
 from typing import Optional
 from transformers import AutoTokenizer
-from dotenv import load_dotenv
+from .modelfile import cache as modelfile_cache
 
 def load_tokenizer(modelfile: str, model_id: str) -> Optional[AutoTokenizer]:
 
-    # Load environment variables from Modelfile
-    load_dotenv(modelfile, override=True)
-
-    # Retrieve custom tokenizer path
-    custom_tokenizer = os.getenv("TOKENIZER")
+    # Retrieve custom tokenizer path from the Modelfile
+    model_config = modelfile_cache.get(modelfile)
+    custom_tokenizer = model_config.tokenizer if model_config else None
     tokenizer = None
 
     if custom_tokenizer:
@@ -185,16 +184,7 @@ def Request(modele_rkllm, modelfile, custom_request=None):
                                 
                                 if variables.global_status != 1:
                                     # Intermediate chunks - minimal fields only
-                                    ollama_chunk = {
-                                        "model": simplified_model_name,
-                                        "created_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-                                        "message": {
-                                            "role": "assistant",
-                                            "content": current_token
-                                        },
-                                        "done": False
-                                    }
-                                    yield f"{json.dumps(ollama_chunk)}\n"
+                                    yield chat_chunk(simplified_model_name, current_token)
                                 else:
                                     # This is the final token from the model, mark that we're ready to send final message
                                     final_message_sent = True
@@ -0,0 +1,294 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+from . import metrics
+
+logger = logging.getLogger("rkllama.pull_jobs")
+
+# Weight of the latest sample in the smoothed download throughput
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class PullJob:
+    """
+    A model pull running in the background, watched by any number of clients.
+
+    The runner reports its progress through `update` and `track`; watchers
+    iterate `events`, which yields Ollama-style progress events at most once
+    per interval, and always yields the final one.
+    """
+
+    def __init__(self, model, interval=0.5):
+        self.model = model
+        self.interval = interval
+        self.status = "queued"
+        self.digest = None
+        self.total = None
+        self.completed = 0
+        self.throughput = None  # bytes per second
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.download = None
+        self.source = None  # peer URL or "huggingface", once known
+        self.position = None  # in the queue, while queued
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def update(self, **fields):
+        with self._condition:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait for the end of the job, True when it ended"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.done, timeout)
+
+    def finish(self, error=None):
+        if self.cancelled:
+            status, error = "cancelled", "Pull cancelled"
+        else:
+            status = "error" if error else "success"
+        self.update(status=status, error=error, done=True, finished_at=time.time())
+
+    def cancel(self):
+        """Stop the pull, its partial download is discarded"""
+        self.update(cancelled=True)
+        if self.download is not None:
+            self.download.cancel()
+
+    def track(self, download):
+        """Start a Download and report its progress until it ends, raises DownloadError on failure"""
+        self.download = download
+        if self.cancelled:
+            raise RuntimeError("Pull cancelled")
+        download.start()
+        try:
+            last_time, last_completed = time.time(), download.downloaded
+            while not download.wait(self.interval):
+                now, completed = time.time(), download.downloaded
+                if completed > last_completed and now > last_time:
+                    # Samples taken during a resume or a retry backoff are left out
+                    rate = (completed - last_completed) / (now - last_time)
+                    throughput = rate if self.throughput is None else (
+                        THROUGHPUT_SMOOTHING * rate + (1 - THROUGHPUT_SMOOTHING) * self.throughput)
+                else:
+                    throughput = self.throughput
+                last_time, last_completed = now, completed
+                self._report(download, throughput)
+            self._report(download, self.throughput)
+            download.result()
+        finally:
+            download.cancel()
+            if self.cancelled:
+                download.wait()
+                download.discard()
+
+    def _report(self, download, throughput):
+        digest = f"sha256:{download.sha256}" if download.sha256 else None
+        if download.phase == "verifying":
+            status = "verifying sha256 digest"
+        elif digest:
+            status = f"pulling {download.sha256[:12]}"
+        else:
+            status = f"pulling {self.model.split('/')[-1]}"
+        self.update(status=status, digest=digest, total=download.size, completed=download.downloaded,
+                    throughput=throughput)
+
+    def event(self):
+        """Ollama /api/pull progress event, with throughput (bytes/s) and ETA (seconds) while downloading"""
+        if self.error:
+            return {"error": self.error}
+        event = {"status": self.status}
+        if self.digest:
+            event["digest"] = self.digest
+        if self.status == "queued" and self.position is not None:
+            event["position"] = self.position
+        if self.total and not self.done:
+            event["total"] = self.total
+            event["completed"] = self.completed
+            if self.throughput:
+                event["throughput"] = round(self.throughput)
+                event["eta"] = round((self.total - self.completed) / self.throughput, 1)
+        return event
+
+    def describe(self):
+        """State of the job for the pull jobs API"""
+        description = {"model": self.model, "status": self.status, "source": self.source,
+                       "created_at": self.created_at,
+                       "started_at": self.started_at, "finished_at": self.finished_at}
+        description.update({name: value for name, value in self.event().items() if name != "status"})
+        return description
+
+    def events(self):
+        """Progress events until the job ends, throttled to one per interval"""
+        version = -1
+        while True:
+            with self._condition:
+                if self.version == version and not self.done:
+                    self._condition.wait(self.interval)
+                if self.version == version and not self.done:
+                    continue
+                version = self.version
+                event = self.event()
+                done = self.done
+            yield event
+            if done:
+                return
+            time.sleep(self.interval)
+
+
+class PullJobs:
+    """
+    Queue of the model pulls, by model.
+
+    At most `max_concurrent` pulls run at once, the others wait in order.
+    Pulling a model that is already queued or being pulled watches that job
+    instead of downloading it again. Finished jobs are kept for `retention`
+    seconds so that a late watcher still sees how the pull ended.
+
+    Unfinished pulls are saved to `state_path` and queued again by `resume`
+    on startup, their downloads resuming from their partial files.
+    """
+
+    def __init__(self, interval=0.5, retention=60.0, max_concurrent=1, state_path=None):
+        self.interval = interval
+        self.retention = retention
+        self.max_concurrent = max_concurrent
+        self.state_path = state_path
+        self._jobs = {}
+        self._queue = []  # queued jobs, in order
+        self._running = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            interval=config.get("download", "progress_interval", 0.5, as_type=float),
+            max_concurrent=config.get("download", "max_concurrent", 1, as_type=int),
+            state_path=os.path.join(config.get_path("data"), "pull_jobs.json")
+        )
+
+    def get(self, model):
+        return self._jobs.get(model)
+
+    def list(self):
+        with self._condition:
+            self._prune()
+            return [job.describe() for job in sorted(self._jobs.values(), key=lambda job: job.created_at)]
+
+    def start(self, model, runner):
+        """
+        Queue the pull of a model, or join the pull already queued or running
+
+        Args:
+            model: Model to pull (Hugging Face repo and file)
+            runner: Function doing the pull, called with the job in a background thread
+
+        Returns:
+            The PullJob to watch
+        """
+        with self._condition:
+            self._prune()
+            job = self._jobs.get(model)
+            if job is not None and not job.done:
+                metrics.increment("pull.joined")
+                return job
+            job = PullJob(model, interval=self.interval)
+            self._jobs[model] = job
+            self._queue.append(job)
+            self._update_positions()
+        self._save()
+        metrics.increment("pull.started")
+        threading.Thread(target=self._run, args=(job, runner), name="rkllama-pull", daemon=True).start()
+        return job
+
+    def cancel(self, model):
+        """Cancel a queued or running pull, False when there is none"""
+        with self._condition:
+            job = self._jobs.get(model)
+            if job is None or job.done:
+                return False
+            job.cancel()
+            self._condition.notify_all()
+        metrics.increment("pull.cancelled")
+        return True
+
+    def resume(self, runner):
+        """Queue again the pulls that were unfinished when the server stopped"""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r") as f:
+                models = json.load(f).get("models", [])
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable pull jobs {self.state_path}: {e}")
+            return
+        for model in models:
+            logger.info(f"Resuming the pull of {model}")
+            self.start(model, runner)
+
+    def _save(self):
+        if not self.state_path:
+            return
+        with self._condition:
+            models = [job.model for job in sorted(self._jobs.values(), key=lambda job: job.created_at)
+                      if not job.done]
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"models": models}, f)
+        os.replace(temp_path, self.state_path)
+
+    def _update_positions(self):
+        for position, job in enumerate(self._queue):
+            if job.position != position:
+                job.update(position=position)
+
+    def _run(self, job, runner):
+        with self._condition:
+            while not job.cancelled and (self._queue[0] is not job or self._running >= self.max_concurrent):
+                self._condition.wait()
+            self._queue.remove(job)
+            self._update_positions()
+            if not job.cancelled:
+                self._running += 1
+        if job.cancelled:
+            job.finish()
+            self._save()
+            return
+
+        job.update(status="pulling manifest", position=None, started_at=time.time())
+        try:
+            runner(job)
+            job.finish()
+            metrics.increment("pull.succeeded")
+        except Exception as e:
+            if not job.cancelled:
+                logger.error(f"Pull of {job.model} failed: {e}")
+                metrics.increment("pull.failed")
+            job.finish(error=str(e))
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+            self._save()
+
+    def _prune(self):
+        now = time.time()
+        for model, job in list(self._jobs.items()):
+            if job.done and now - job.finished_at >= self.retention:
+                del self._jobs[model]
+
+
+jobs = PullJobs.from_config()
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from . import metrics
+from .model_index import index as model_index
+
+logger = logging.getLogger("rkllama.response_cache")
+
+
+def model_fingerprint(model_path):
+    """
+    Identify the content of a model file
+
+    The fingerprint changes whenever the file is replaced or modified, which
+    invalidates every cached response produced by the previous version. The
+    content digest from the model index is used once it is known, so that
+    copies of the same model share their cached responses.
+    """
+    digest = model_index.digest(model_path)
+    if digest is not None:
+        return digest[:32]
+    try:
+        stat = os.stat(model_path)
+    except OSError:
+        return None
+    identity = f"{os.path.realpath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()[:32]
+
+
+class ResponseCache:
+    """
+    Deterministic completion cache with a size-bounded in-memory LRU and a disk tier.
+
+    Entries are keyed by (model fingerprint, prompt token ids, sampling parameters,
+    request options, format spec) and hold the generated segments so that a hit
+    can be replayed as a normal stream.
+    """
+
+    def __init__(self, enabled=False, memory_bytes=64 * 1024 * 1024, disk_bytes=1024 * 1024 * 1024, cache_dir=None):
+        self.enabled = enabled
+        self.memory_limit = memory_bytes
+        self.disk_limit = disk_bytes
+        self.cache_dir = cache_dir
+
+        self._memory = OrderedDict()  # key -> (entry, size)
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._fingerprints = {}  # model path -> current fingerprint
+        self._lock = threading.Lock()
+
+        if self.enabled and self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_bytes = self._scan_disk_usage()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            enabled=config.get("cache", "enabled", False, as_type=bool),
+            memory_bytes=config.get("cache", "memory_size_mb", 64, as_type=int) * 1024 * 1024,
+            disk_bytes=config.get("cache", "disk_size_mb", 1024, as_type=int) * 1024 * 1024,
+            cache_dir=os.path.join(config.get_path("data"), "response_cache")
+        )
+
+    def _scan_disk_usage(self):
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _entry_path(self, fingerprint, key):
+        return os.path.join(self.cache_dir, fingerprint, f"{key}.json")
+
+    def make_key(self, model_path, prompt_tokens, sampling=None, options=None, format_spec=None):
+        """
+        Build the cache key for a request, or return None if caching is disabled
+
+        The model fingerprint is checked on every call, so a model file that
+        changed on disk purges the entries of its previous version.
+        """
+        if not self.enabled or not model_path:
+            return None
+
+        fingerprint = model_fingerprint(model_path)
+        if fingerprint is None:
+            return None
+
+        with self._lock:
+            previous = self._fingerprints.get(model_path)
+            self._fingerprints[model_path] = fingerprint
+        if previous and previous != fingerprint:
+            logger.info(f"Model file changed, invalidating cached responses for {model_path}")
+            self.invalidate(previous)
+
+        material = json.dumps({
+            "prompt_tokens": list(prompt_tokens),
+            "sampling": sampling or {},
+            "options": options or {},
+            "format": format_spec
+        }, sort_keys=True, separators=(",", ":"), default=str)
+        digest = hashlib.sha256(material.encode("utf-8")).hexdigest()
+        return f"{fingerprint}/{digest}"
+
+    def get(self, key):
+        """Look up an entry, promoting disk hits to the memory tier"""
+        if not key:
+            return None
+
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                self._memory.move_to_end(key)
+                entry = item[0]
+            else:
+                entry = None
+
+        if entry is None and self.cache_dir:
+            fingerprint, digest = key.split("/", 1)
+            path = self._entry_path(fingerprint, digest)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                os.utime(path)  # Keep recently used entries on disk
+                self._remember(key, entry)
+            except (OSError, ValueError):
+                entry = None
+
+        if entry is None:
+            metrics.increment("cache.misses")
+            return None
+
+        metrics.increment("cache.hits")
+        metrics.increment("cache.saved_npu_seconds", entry.get("npu_seconds", 0))
+        return entry
+
+    def put(self, key, segments, stats, npu_seconds):
+        """Store the segments and stats of a completed generation"""
+        if not key:
+            return
+
+        entry = {
+            "segments": [list(segment) for segment in segments],
+            "stats": {k: v for k, v in stats.items() if k not in ("prompt_eval_time", "start_time")},
+            "npu_seconds": npu_seconds,
+            "created_at": time.time()
+        }
+        self._remember(key, entry)
+
+        if self.cache_dir:
+            fingerprint, digest = key.split("/", 1)
+            path = self._entry_path(fingerprint, digest)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entry, f)
+                os.replace(tmp_path, path)
+                with self._lock:
+                    self._disk_bytes += os.path.getsize(path)
+                self._trim_disk()
+            except OSError as e:
+                logger.warning(f"Failed to write cache entry {path}: {e}")
+
+    def _remember(self, key, entry):
+        size = len(json.dumps(entry))
+        if size > self.memory_limit:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[1]
+            self._memory[key] = (entry, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_limit and self._memory:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+
+    def _trim_disk(self):
+        with self._lock:
+            if self._disk_bytes <= self.disk_limit:
+                return
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    pass
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.disk_limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def invalidate(self, fingerprint):
+        """Drop every entry produced by a given version of a model file"""
+        prefix = f"{fingerprint}/"
+        with self._lock:
+            for key in [k for k in self._memory if k.startswith(prefix)]:
+                self._memory_bytes -= self._memory.pop(key)[1]
+        if self.cache_dir:
+            shutil.rmtree(os.path.join(self.cache_dir, fingerprint), ignore_errors=True)
+            with self._lock:
+                self._disk_bytes = self._scan_disk_usage()
+
+    def clear(self):
+        """Remove all cached responses"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self.cache_dir and os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock:
+            self._disk_bytes = 0
+
+    def stats(self):
+        hits = metrics.get_counter("cache.hits")
+        misses = metrics.get_counter("cache.misses")
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+                "saved_npu_seconds": metrics.get_counter("cache.saved_npu_seconds"),
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_limit": self.memory_limit,
+                "disk_bytes": self._disk_bytes,
+                "disk_limit": self.disk_limit
+            }
+
+
+cache = ResponseCache.from_config()
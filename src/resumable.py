@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+import config
+from . import metrics
+from .inflight import SharedStream
+from .scheduler import KEEPALIVE_SECONDS
+
+logger = logging.getLogger("rkllama.resumable")
+
+REQUEST_ID_HEADER = "X-Request-Id"
+
+
+def with_request_id(lines, request_id):
+    """Add the request ID to the first chunk of a streamed response"""
+    lines = iter(lines)
+    try:
+        for line in lines:
+            if request_id is not None:
+                chunk = json.loads(line)
+                chunk["request_id"] = request_id
+                line = f"{json.dumps(chunk)}\n"
+                request_id = None
+            yield line
+    finally:
+        if hasattr(lines, "close"):
+            lines.close()
+
+
+class RetainedStreams:
+    """
+    Buffers of streamed generations, kept so that clients can reconnect.
+
+    A stream stays available for `grace` seconds after it finished, or after
+    its last reader went away. When the retained buffers exceed `max_bytes`,
+    finished streams are dropped first, oldest first, then generations nobody
+    is reading, which stops them. Streams with readers are never dropped.
+    """
+
+    def __init__(self, enabled=True, grace=30.0, max_bytes=16 * 1024 * 1024):
+        self.enabled = enabled
+        self.grace = grace
+        self.max_bytes = max_bytes
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            enabled=config.get("streaming", "resume_enabled", True, as_type=bool),
+            grace=config.get("streaming", "resume_grace_seconds", 30.0, as_type=float),
+            max_bytes=config.get("streaming", "resume_buffer_mb", 16, as_type=int) * 1024 * 1024
+        )
+
+    def register(self, stream):
+        """Assign a request ID to a stream, None when streams are not retained"""
+        if not self.enabled:
+            return None
+        request_id = uuid.uuid4().hex
+        stream.request_id = request_id
+        stream.grace = self.grace
+        with self._lock:
+            self._streams[request_id] = stream
+        self.prune()
+        return request_id
+
+    def get(self, request_id):
+        self.prune()
+        with self._lock:
+            return self._streams.get(request_id)
+
+    def cancel(self, request_id):
+        """Stop a generation as soon as nobody reads it anymore, and forget it"""
+        with self._lock:
+            stream = self._streams.pop(request_id, None)
+        if stream is not None:
+            stream.grace = 0
+        return stream is not None
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            for request_id, stream in list(self._streams.items()):
+                if stream.done and now - stream.finished_at >= self.grace:
+                    del self._streams[request_id]
+                elif stream.abandoned:
+                    del self._streams[request_id]
+
+            total = sum(stream.size for stream in self._streams.values())
+            if total > self.max_bytes:
+                finished = sorted((s for s in self._streams.values() if s.done), key=lambda s: s.finished_at)
+                idle = sorted((s for s in self._streams.values() if not s.done and s.idle_since is not None
+                               and s.subscribers == 0), key=lambda s: s.idle_since)
+                for stream in finished + idle:
+                    if total <= self.max_bytes:
+                        break
+                    del self._streams[stream.request_id]
+                    stream.grace = 0
+                    total -= stream.size
+                    metrics.increment("streams.evicted")
+            count = len(self._streams)
+
+        metrics.observe("streams.retained_bytes", total)
+        metrics.observe("streams.retained", count)
+
+
+class ResumableStream:
+    """
+    Lines of a streamed response, recorded into a SharedStream as they are sent.
+
+    When the client disconnects mid-generation, the remaining lines are drained
+    into the stream by a background thread instead of aborting the NPU run, so
+    that a reconnecting client can resume from its offset. The generation stops
+    once nobody has been reading it for the grace period.
+    """
+
+    def __init__(self, lines, stream, ticket=None):
+        self.lines = iter(lines)
+        self.stream = stream
+        self.ticket = ticket
+        self.started = False
+        self.finished = False
+        self.detached = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            line = next(self.lines)
+        except BaseException:
+            self.finished = True
+            self.stream.finish()
+            raise
+        self.started = True
+        self.stream.append(line)
+        return line
+
+    def close(self):
+        if self.finished or self.detached:
+            return
+        if not self.started:
+            # Nothing was generated yet, there is nothing worth keeping
+            self.finished = True
+            self._close_lines()
+            self.stream.finish()
+            return
+
+        self.detached = True
+        if self.ticket is not None:
+            # Queued in ASGI mode: nobody awaits the grant anymore, block in the drain thread
+            self.ticket.keepalive = KEEPALIVE_SECONDS
+        self.stream.detach()
+        metrics.increment("streams.detached")
+        threading.Thread(target=self._drain, name="rkllama-stream-drain", daemon=True).start()
+
+    def _close_lines(self):
+        if hasattr(self.lines, "close"):
+            self.lines.close()
+
+    def _drain(self):
+        try:
+            for line in self.lines:
+                self.stream.append(line)
+                if self.stream.abandoned:
+                    logger.debug(f"Nobody reconnected to {self.stream.request_id}, stopping generation")
+                    break
+        except Exception as e:
+            logger.exception("Error in detached generation")
+            self.stream.append(f"{json.dumps({'error': str(e)})}\n")
+        finally:
+            self._close_lines()
+            self.finished = True
+            self.stream.finish()
+
+
+def make_resumable(response, ticket=None):
+    """Record a streamed generation response so that its client can reconnect"""
+    stream = SharedStream()
+    request_id = streams.register(stream)
+    if request_id is None:
+        return response
+    response.response = ResumableStream(with_request_id(response.response, request_id), stream, ticket)
+    response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+streams = RetainedStreams.from_config()
@@ -14,6 +14,9 @@ class RKLLM(object):
         self.format_type = None
         self.format_options = {}
         self.model_dir = model_dir
+        self.model_path = model_path
+        self.temperature = temperature
+        self.context_length = context_length
         
         rkllm_param = RKLLMParam()
         rkllm_param.model_path = bytes(model_path, 'utf-8')
@@ -56,6 +59,10 @@ class RKLLM(object):
         self.rkllm_destroy.argtypes = [RKLLM_Handle_t]
         self.rkllm_destroy.restype = ctypes.c_int
 
+        self.rkllm_abort = rkllm_lib.rkllm_abort
+        self.rkllm_abort.argtypes = [RKLLM_Handle_t]
+        self.rkllm_abort.restype = ctypes.c_int
+
         self.lora_adapter_path = None
         self.lora_model_name = None
         if lora_model_path:
@@ -112,5 +119,9 @@ class RKLLM(object):
 
         return
 
+    def abort(self):
+        # Stop the current generation, rkllm_run returns as soon as possible
+        return self.rkllm_abort(self.handle)
+
     def release(self):
         self.rkllm_destroy(self.handle)
@@ -0,0 +1,419 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+
+import config
+import src.variables as variables
+from . import metrics
+
+logger = logging.getLogger("rkllama.scheduler")
+
+# Interval of the queue updates sent to streamed requests waiting for the NPU
+KEEPALIVE_SECONDS = config.get("scheduler", "keepalive_seconds", 5.0, as_type=float)
+
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+LANES = (LANE_INTERACTIVE, LANE_BATCH)
+
+POLICY_FAIR = "fair"
+POLICY_SJF = "sjf"
+
+# Interval at which an ASGI request granted the NPU polls the lock still held outside the scheduler
+LOCK_POLL_SECONDS = 0.05
+
+# Segment phase of the queue updates yielded while a streamed request waits
+PHASE_QUEUED = "queued"
+
+# Accepted spellings of the priority header / option
+LANE_ALIASES = {
+    "interactive": LANE_INTERACTIVE,
+    "high": LANE_INTERACTIVE,
+    "chat": LANE_INTERACTIVE,
+    "batch": LANE_BATCH,
+    "low": LANE_BATCH,
+    "background": LANE_BATCH
+}
+
+
+def parse_lane(value):
+    """Map a priority value to a lane name, or None if it is not recognized"""
+    if not isinstance(value, str):
+        return None
+    return LANE_ALIASES.get(value.strip().lower())
+
+
+def parse_api_keys(entries):
+    """
+    Parse the `[scheduler] api_keys` setting
+
+    Each entry is `key:lane[:weight]`, e.g. `abc123:batch:0.5`.
+
+    Returns:
+        Dictionary mapping API keys to (lane, weight)
+    """
+    mapping = {}
+    for entry in entries or []:
+        parts = [part.strip() for part in str(entry).split(":")]
+        if len(parts) < 2 or not parts[0] or parse_lane(parts[1]) is None:
+            logger.warning(f"Ignoring invalid scheduler api_keys entry: {entry!r}")
+            continue
+        weight = 1.0
+        if len(parts) > 2:
+            try:
+                weight = max(float(parts[2]), 0.01)
+            except ValueError:
+                logger.warning(f"Invalid weight in scheduler api_keys entry: {entry!r}")
+        mapping[parts[0]] = (parse_lane(parts[1]), weight)
+    return mapping
+
+
+def get_api_key(headers):
+    """Extract the API key of a request from its headers"""
+    auth = headers.get("Authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip()
+    return headers.get("X-API-Key") or None
+
+
+class CostModel:
+    """
+    Per-model estimate of the NPU time of a request.
+
+    Prefill and decode rates and the typical output length are learned from
+    completed generations with an exponentially weighted moving average.
+    Until a model has been measured, conservative defaults are used.
+    """
+
+    DEFAULT_PREFILL_RATE = 100.0  # prompt tokens per second
+    DEFAULT_DECODE_RATE = 10.0  # generated tokens per second
+    DEFAULT_OUTPUT_TOKENS = 256
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _update(self, values, name, value):
+        previous = values.get(name)
+        values[name] = value if previous is None else previous + self.alpha * (value - previous)
+
+    def observe(self, model, prompt_tokens, prefill_seconds, output_tokens, decode_seconds):
+        """Record the timings of a completed generation"""
+        with self._lock:
+            values = self._models.setdefault(model, {})
+            if prompt_tokens > 0 and prefill_seconds > 0:
+                self._update(values, "prefill_rate", prompt_tokens / prefill_seconds)
+            if output_tokens > 1 and decode_seconds > 0:
+                self._update(values, "decode_rate", (output_tokens - 1) / decode_seconds)
+            self._update(values, "output_tokens", output_tokens)
+
+    def prefill_seconds(self, model, prompt_tokens):
+        """Estimated duration of the prefill of a prompt"""
+        with self._lock:
+            rate = self._models.get(model, {}).get("prefill_rate", self.DEFAULT_PREFILL_RATE)
+        return prompt_tokens / rate
+
+    def estimate(self, model, prompt_tokens, num_predict=None):
+        """Estimated NPU seconds for a request"""
+        with self._lock:
+            values = dict(self._models.get(model, {}))
+        output_tokens = values.get("output_tokens", self.DEFAULT_OUTPUT_TOKENS)
+        if num_predict is not None and num_predict > 0:
+            output_tokens = min(output_tokens, num_predict)
+        return (prompt_tokens / values.get("prefill_rate", self.DEFAULT_PREFILL_RATE)
+                + output_tokens / values.get("decode_rate", self.DEFAULT_DECODE_RATE))
+
+    def stats(self):
+        with self._lock:
+            return {model: dict(values) for model, values in self._models.items()}
+
+
+class Ticket:
+    """A request waiting for, or holding, the NPU"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, lane=LANE_INTERACTIVE, client="anonymous", weight=1.0, cost=1.0):
+        self.id = next(self._ids)
+        self.lane = lane
+        self.client = client
+        self.weight = weight
+        self.cost = cost
+        self.enqueued_at = None
+        self.granted_at = None
+        self.released = False
+        self.locked = False  # holds the NPU lock
+        # How long a streamed request blocks between queue updates; 0 when the
+        # caller awaits the grant itself (ASGI mode)
+        self.keepalive = KEEPALIVE_SECONDS
+
+    @property
+    def waiting(self):
+        return self.enqueued_at is not None and self.granted_at is None and not self.released
+
+    @property
+    def pending(self):
+        """Queued, or granted while the NPU lock is still held outside the scheduler"""
+        return self.enqueued_at is not None and not self.locked and not self.released
+
+
+class Scheduler:
+    """
+    Admission control for the NPU with priority lanes and fair queuing.
+
+    Interactive requests are served before batch requests. A batch request that
+    waited longer than the aging bound is served as if it were interactive.
+    Inside a lane, the policy decides:
+
+    - fair: clients are served by weighted fair queuing on their virtual time, so
+      one client flooding the queue doesn't starve the others
+    - sjf: shortest expected job first, where the estimated NPU time of a request
+      is reduced by the time it has waited so long jobs still get their turn
+
+    A ticket only joins the queue once its owner starts waiting on it, so a
+    request abandoned before it starts never blocks the queue. The granted ticket
+    also holds `variables.verrou`, shared with the original /generate route.
+    """
+
+    def __init__(self, aging_seconds=60.0, policy=POLICY_FAIR, lock=None):
+        self.aging_seconds = aging_seconds
+        self.policy = policy
+        self.cost_model = CostModel()
+        self.lock = lock if lock is not None else variables.verrou
+        self._condition = threading.Condition()
+        self._queue = []
+        self._running = None
+        self._virtual_time = 0.0
+        self._client_time = {}
+        self._async_waiters = []
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            aging_seconds=config.get("scheduler", "aging_seconds", 60.0, as_type=float),
+            policy=config.get("scheduler", "policy", POLICY_FAIR)
+        )
+
+    def submit(self, lane=LANE_INTERACTIVE, client="anonymous", weight=1.0, cost=1.0):
+        """Create a ticket; it is queued on the first call to wait()"""
+        return Ticket(lane if lane in LANES else LANE_INTERACTIVE, client, weight, cost)
+
+    def _effective_lane(self, ticket, now):
+        if ticket.lane == LANE_BATCH and now - ticket.enqueued_at >= self.aging_seconds:
+            return LANE_INTERACTIVE
+        return ticket.lane
+
+    def _sort_key(self, ticket, now):
+        lane = LANES.index(self._effective_lane(ticket, now))
+        if self.policy == POLICY_SJF:
+            return (lane, ticket.cost - (now - ticket.enqueued_at), ticket.enqueued_at, ticket.id)
+        start = max(self._client_time.get(ticket.client, 0.0), self._virtual_time)
+        return (lane, start, ticket.enqueued_at, ticket.id)
+
+    def _pick(self):
+        if self._running is not None or not self._queue:
+            return None
+        now = time.time()
+        return min(self._queue, key=lambda ticket: self._sort_key(ticket, now))
+
+    def _grant(self, ticket):
+        start = max(self._client_time.get(ticket.client, 0.0), self._virtual_time)
+        self._virtual_time = start
+        self._client_time[ticket.client] = start + ticket.cost / ticket.weight
+        self._queue.remove(ticket)
+        self._running = ticket
+        ticket.granted_at = time.time()
+        wait = ticket.granted_at - ticket.enqueued_at
+        metrics.observe(f"scheduler.wait.{ticket.lane}", wait)
+        if wait > 1:
+            logger.debug(f"Ticket {ticket.id} ({ticket.lane}, {ticket.client}) waited {wait:.1f}s")
+
+    def _wait_grant(self, ticket, timeout):
+        """Wait until the ticket is the running one, False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            if ticket.granted_at is not None:
+                return True
+            if ticket.enqueued_at is None:
+                ticket.enqueued_at = time.time()
+                self._queue.append(ticket)
+            while True:
+                if self._pick() is ticket:
+                    self._grant(ticket)
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                # Aging may change the order even if nothing is released, re-check periodically
+                self._condition.wait(1.0 if remaining is None else min(remaining, 1.0))
+        return True
+
+    def wait(self, ticket, timeout=None):
+        """
+        Wait until the ticket is granted the NPU
+
+        Returns:
+            True once granted (the NPU lock is then held), False on timeout
+        """
+        if not self._wait_grant(ticket, timeout):
+            return False
+        if not ticket.locked:
+            self.lock.acquire()
+            if ticket.released:
+                # Withdrawn while waiting for the lock
+                self.lock.release()
+                return False
+            ticket.locked = True
+        return True
+
+    async def wait_async(self, ticket, timeout=None):
+        """
+        Wait until the ticket is granted the NPU without blocking a thread
+
+        Returns:
+            True once granted (the NPU lock is then held), False on timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            event = asyncio.Event()
+            waiter = (loop, event)
+            with self._condition:
+                self._async_waiters.append(waiter)
+            try:
+                if self._wait_grant(ticket, 0):
+                    break
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                try:
+                    # Woken up on release, re-checked periodically for aging
+                    await asyncio.wait_for(event.wait(), 1.0 if remaining is None else min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                with self._condition:
+                    self._async_waiters.remove(waiter)
+
+        # The lock may still be held outside the scheduler, never block the event loop on it
+        while not ticket.locked:
+            if ticket.released:
+                return False
+            if self.lock.acquire(blocking=False):
+                ticket.locked = True
+                break
+            if deadline is not None and loop.time() >= deadline:
+                return False
+            await asyncio.sleep(LOCK_POLL_SECONDS)
+        return True
+
+    def acquire(self, lane=LANE_INTERACTIVE, client="anonymous", weight=1.0, cost=1.0):
+        """Submit a ticket and block until it is granted"""
+        ticket = self.submit(lane, client, weight, cost)
+        self.wait(ticket)
+        return ticket
+
+    def release(self, ticket):
+        """Release a granted ticket, or withdraw a waiting one"""
+        if ticket is None or ticket.released:
+            return
+        with self._condition:
+            ticket.released = True
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+            if self._running is ticket:
+                self._running = None
+                if ticket.locked:
+                    ticket.locked = False
+                    self.lock.release()
+            self._condition.notify_all()
+            for loop, event in self._async_waiters:
+                loop.call_soon_threadsafe(event.set)
+
+    def estimate(self, ticket):
+        """
+        Queue position and estimated start and completion of a ticket
+
+        Returns:
+            Dictionary with the position and the estimated seconds until the
+            request starts and until it completes
+        """
+        with self._condition:
+            now = time.time()
+            ahead = 0.0
+            position = 0
+            if self._running is not None:
+                ahead += max(self._running.cost - (now - self._running.granted_at), 0.0)
+                position += 1
+            if ticket.waiting:
+                for queued in sorted(self._queue, key=lambda t: self._sort_key(t, now)):
+                    if queued is ticket:
+                        break
+                    ahead += queued.cost
+                    position += 1
+            return {
+                "position": position,
+                "estimated_start": round(ahead, 1),
+                "eta": round(ahead + ticket.cost, 1)
+            }
+
+    def stats(self):
+        snapshot = metrics.snapshot()["observations"]
+        with self._condition:
+            now = time.time()
+            lanes = {}
+            for lane in LANES:
+                queued = [t for t in self._queue if t.lane == lane]
+                lanes[lane] = {
+                    "queued": len(queued),
+                    "oldest_wait": max((now - t.enqueued_at for t in queued), default=0.0),
+                    "wait": snapshot.get(f"scheduler.wait.{lane}", {})
+                }
+            running = None
+            if self._running is not None:
+                running = {
+                    "id": self._running.id,
+                    "lane": self._running.lane,
+                    "client": self._running.client,
+                    "running_for": now - self._running.granted_at,
+                    "estimated_cost": self._running.cost
+                }
+            return {
+                "policy": self.policy,
+                "lanes": lanes,
+                "running": running,
+                "aging_seconds": self.aging_seconds,
+                "models": self.cost_model.stats()
+            }
+
+
+scheduler = Scheduler.from_config()
+API_KEYS = parse_api_keys(config.get("scheduler", "api_keys", [], as_type=list))
+DEFAULT_LANE = parse_lane(config.get("scheduler", "default_lane", LANE_INTERACTIVE)) or LANE_INTERACTIVE
+
+
+def ticket_for_request(headers, remote_addr=None, options=None):
+    """
+    Create a scheduler ticket for an HTTP request
+
+    The lane mapped to the API key wins: the `X-Priority` header or the
+    `priority` option (in that order) can only lower it to batch. Without a
+    mapped key, the header, then the option, then the default lane decide.
+    The client identity is the API key when present, otherwise the remote
+    address.
+    """
+    api_key = get_api_key(headers)
+    lane, weight = API_KEYS.get(api_key, (None, 1.0)) if api_key else (None, 1.0)
+
+    option_lane = parse_lane(options.get("priority")) if isinstance(options, dict) else None
+    requested_lane = parse_lane(headers.get("X-Priority")) or option_lane
+    if lane is None:
+        lane = requested_lane or DEFAULT_LANE
+    elif requested_lane == LANE_BATCH:
+        # A client may lower the priority of its key, never raise it
+        lane = LANE_BATCH
+
+    client = f"key:{api_key}" if api_key else (remote_addr or "anonymous")
+    return scheduler.submit(lane, client, weight)
@@ -1,7 +1,6 @@
 import threading
 import json
 import time
-import datetime
 import logging
 import os
 import re  # Add import for regex used in JSON extraction
@@ -10,6 +9,17 @@ from flask import jsonify, Response
 import src.variables as variables
 from src.model_utils import get_simplified_model_name
 from .format_utils import create_format_instruction, validate_format_response
+from .stop_sequences import StopSequenceMatcher, normalize_stop_sequences
+from .inflight import is_deterministic
+from .response_cache import cache as response_cache
+from .scheduler import scheduler, PHASE_QUEUED
+from .npu_worker import WorkerCrashedError
+from .chunk_format import timestamp, chat_chunk, generate_chunk
+from .coalescing import TokenCoalescer, measure_stream
+from .thinking import (
+    ThinkingTracker, get_thinking_markers, prompt_opens_thinking,
+    PHASE_THINKING, PHASE_ANSWER, PHASE_MARKER
+)
 
 import config
 
@@ -28,6 +38,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger("rkllama.server_utils")
 
+# Keep-alive segment sent when a streamed generation produced nothing for a while
+PHASE_HEARTBEAT = "heartbeat"
+HEARTBEAT_SECONDS = config.get("streaming", "heartbeat_seconds", 5.0, as_type=float)
+HEARTBEAT_DETAILS = config.get("streaming", "heartbeat_details", True, as_type=bool)
+
 class RequestWrapper:
     """A class that mimics Flask's request object for custom request handling"""
     def __init__(self, json_data, path="/"):
@@ -39,7 +54,7 @@ class EndpointHandler:
     """Base class for endpoint handlers with common functionality"""
     
     @staticmethod
-    def prepare_prompt(messages, system=""):
+    def prepare_prompt(messages, system="", think=None):
         """Prepare prompt with proper system handling"""
         tokenizer = AutoTokenizer.from_pretrained(variables.model_id, trust_remote_code=True)
         supports_system_role = "raise_exception('System role not supported')" not in tokenizer.chat_template
@@ -49,7 +64,10 @@ class EndpointHandler:
         else:
             prompt_messages = messages
         
-        prompt_tokens = tokenizer.apply_chat_template(prompt_messages, tokenize=True, add_generation_prompt=True)
+        # Templates with a thinking switch (e.g. Qwen3) read `enable_thinking`, others ignore it
+        template_kwargs = {"enable_thinking": bool(think)} if think is not None else {}
+        prompt_tokens = tokenizer.apply_chat_template(prompt_messages, tokenize=True, add_generation_prompt=True,
+                                                      **template_kwargs)
         return tokenizer, prompt_tokens, len(prompt_tokens)
     
     @staticmethod
@@ -73,16 +91,417 @@ class EndpointHandler:
             "load": int(0.1 * 1_000_000_000)
         }
 
+    @staticmethod
+    def collect_metrics(metrics, stats, prompt_token_count):
+        """Add token counts from generation stats to the duration metrics"""
+        metrics["prompt_tokens"] = prompt_token_count
+        metrics["token_count"] = stats["token_count"]
+        metrics["done_reason"] = stats.get("done_reason", "stop")
+        if "thinking_count" in stats:
+            metrics["thinking_count"] = stats["thinking_count"]
+            metrics["answer_count"] = stats["answer_count"]
+        return metrics
+
+    @staticmethod
+    def metrics_fields(metrics):
+        """Ollama response fields for the final chunk or complete response"""
+        fields = {
+            "total_duration": metrics["total"],
+            "load_duration": metrics["load"],
+            "prompt_eval_count": metrics.get("prompt_tokens", 0),
+            "prompt_eval_duration": metrics["prompt_eval"],
+            "eval_count": metrics.get("token_count", 0),
+            "eval_duration": metrics["eval"]
+        }
+        if "thinking_count" in metrics:
+            fields["thinking_eval_count"] = metrics["thinking_count"]
+            fields["answer_eval_count"] = metrics["answer_count"]
+        return fields
+
+    @staticmethod
+    def get_stop_sequences(options):
+        """Extract the stop sequences from Ollama request options"""
+        if not options or not isinstance(options, dict):
+            return []
+        return normalize_stop_sequences(options.get("stop"))
+
+    @staticmethod
+    def create_thinking_tracker(model_name, tokenizer, prompt_tokens, think=None, think_budget=None):
+        """
+        Create a ThinkingTracker when the request asks for thinking control.
+
+        Returns None when neither `think` nor `think_budget` is set, in which case
+        the output is streamed untouched.
+        """
+        if think is None and think_budget is None:
+            return None
+        
+        if think is False:
+            # The model should not think at all: close any thinking block right away
+            think_budget = 0
+        elif think_budget is not None:
+            try:
+                think_budget = max(0, int(think_budget))
+            except (ValueError, TypeError):
+                logger.warning(f"Ignoring invalid think_budget: {think_budget!r}")
+                think_budget = None
+        
+        markers = get_thinking_markers(model_name)
+        starts_thinking = prompt_opens_thinking(tokenizer, prompt_tokens, markers)
+        return ThinkingTracker(markers, starts_thinking=starts_thinking, budget=think_budget)
+
+    @staticmethod
+    def generate_tokens(modele_rkllm, prompt_tokens, stats, stop=None, heartbeat=None):
+        """
+        Run inference in a background thread and yield decoded text as it arrives.
+
+        The token count and the time of the first token are recorded in `stats`.
+        When stop sequences are given, the decoded stream is matched on the fly,
+        text that could still be part of a stop sequence is held back, and the
+        NPU run is aborted as soon as a stop sequence completes.
+        With a `heartbeat` interval, None is yielded whenever no text was
+        yielded for that many seconds, e.g. during a long prefill.
+        """
+        matcher = StopSequenceMatcher(stop) if stop else None
+
+        thread_model = threading.Thread(target=modele_rkllm.run, args=(prompt_tokens,))
+        thread_model.start()
+
+        stats["token_count"] = 0
+        stats["prompt_eval_time"] = None
+        last_output = time.time()
+
+        try:
+            while True:
+                tokens_processed = False
+
+                while len(variables.global_text) > 0:
+                    tokens_processed = True
+                    stats["token_count"] += 1
+                    token = variables.global_text.pop(0)
+
+                    if stats["token_count"] == 1:
+                        stats["prompt_eval_time"] = time.time()
+
+                    if matcher:
+                        token = matcher.feed(token)
+
+                    if token:
+                        yield token
+                        last_output = time.time()
+
+                    if matcher and matcher.stopped:
+                        if DEBUG_MODE:
+                            logger.debug(f"Stop sequence {matcher.matched!r} reached, aborting generation")
+                        return
+
+                thread_model.join(timeout=0.005)
+                if not thread_model.is_alive() and len(variables.global_text) == 0:
+                    break
+
+                if not tokens_processed:
+                    if heartbeat and time.time() - last_output >= heartbeat:
+                        yield None
+                        last_output = time.time()
+                    time.sleep(0.01)
+
+            # Set by the worker process proxy when the NPU runtime crashed
+            error = getattr(modele_rkllm, "error", None)
+            if error is not None:
+                raise error
+
+            if matcher:
+                remaining = matcher.flush()
+                if remaining:
+                    yield remaining
+        finally:
+            # Stop sequence reached or client gone: don't keep the NPU busy for nothing
+            if thread_model.is_alive():
+                modele_rkllm.abort()
+                thread_model.join()
+            variables.global_text.clear()
+
+    @classmethod
+    def generate_segments(cls, modele_rkllm, prompt_tokens, stats, stop=None, tracker=None, tokenizer=None,
+                          heartbeat=None):
+        """
+        Yield (phase, text) segments of the generated output.
+
+        Without a tracker, everything is yielded as answer text. With a tracker,
+        thinking and answer phases are separated and thinking/answer token counts
+        are recorded in `stats`. When the thinking budget is exhausted, the run is
+        aborted and the end-of-thinking marker is forced through a continuation
+        run, or generation simply ends if no tokenizer is available.
+        With a `heartbeat` interval, (PHASE_HEARTBEAT, None) is yielded while
+        the NPU stays silent.
+        """
+        if tracker is None:
+            for token in cls.generate_tokens(modele_rkllm, prompt_tokens, stats, stop, heartbeat):
+                yield (PHASE_HEARTBEAT, None) if token is None else (PHASE_ANSWER, token)
+            return
+        
+        # rkllm_run may modify the token list, keep the original prompt for the continuation
+        base_tokens = list(prompt_tokens)
+        # The text sent to the client, which the continuation must start from
+        emitted_text = []
+        counted = 0
+        
+        tokens = cls.generate_tokens(modele_rkllm, prompt_tokens, stats, stop, heartbeat)
+        for token in tokens:
+            if token is None:
+                yield PHASE_HEARTBEAT, None
+                continue
+            for segment in tracker.feed(token):
+                emitted_text.append(segment[1])
+                yield segment
+            tracker.count_tokens(stats["token_count"] - counted)
+            counted = stats["token_count"]
+            if tracker.budget_exhausted():
+                break
+        else:
+            yield from tracker.flush()
+            cls._record_thinking_stats(stats, tracker)
+            return
+        
+        # Thinking budget exhausted: abort the current run
+        tokens.close()
+        segments, end_marker = tracker.end_thinking()
+        # The text held back by the tracker is emitted now, the forced marker is added below
+        emitted_text.extend(text for phase, text in segments if phase != PHASE_MARKER)
+        yield from segments
+        
+        if DEBUG_MODE:
+            logger.debug(f"Thinking budget of {tracker.budget} tokens exhausted, forcing {end_marker!r}")
+        
+        if tokenizer is None:
+            stats["done_reason"] = "length"
+            cls._record_thinking_stats(stats, tracker)
+            return
+        
+        continuation = base_tokens + tokenizer.encode(f"{''.join(emitted_text)}\n{end_marker}\n\n",
+                                                      add_special_tokens=False)
+        continuation_stats = {}
+        counted = 0
+        for token in cls.generate_tokens(modele_rkllm, continuation, continuation_stats, stop, heartbeat):
+            if token is None:
+                yield PHASE_HEARTBEAT, None
+                continue
+            yield from tracker.feed(token)
+            tracker.count_tokens(continuation_stats["token_count"] - counted)
+            counted = continuation_stats["token_count"]
+        yield from tracker.flush()
+        
+        stats["token_count"] += continuation_stats["token_count"]
+        cls._record_thinking_stats(stats, tracker)
+
+    @staticmethod
+    def get_cache_key(modele_rkllm, prompt_tokens, options=None, format_spec=None, think=None, think_budget=None):
+        """Response cache key for a deterministic request, or None when it can't be cached"""
+        if not response_cache.enabled or not is_deterministic(options):
+            return None
+        
+        sampling = {
+            "temperature": getattr(modele_rkllm, "temperature", None),
+            "context_length": getattr(modele_rkllm, "context_length", None)
+        }
+        request_options = dict(options) if isinstance(options, dict) else {}
+        request_options.update({"think": think, "think_budget": think_budget})
+        
+        return response_cache.make_key(getattr(modele_rkllm, "model_path", None), prompt_tokens,
+                                       sampling, request_options, format_spec)
+
+    @classmethod
+    def cached_segments(cls, cache_key, modele_rkllm, prompt_tokens, stats, stop=None, tracker=None, tokenizer=None,
+                        ticket=None, keepalive=False):
+        """
+        Yield the generated segments, replaying them from the response cache on a hit.
+
+        On a miss the segments are recorded while they are streamed and stored once
+        the generation completes; interrupted generations are never cached.
+        With a scheduler ticket, the NPU is only waited for on a miss and is held
+        until the generation ends, including for streamed responses. With
+        `keepalive`, a (PHASE_QUEUED, estimate) segment is yielded every few
+        seconds while the request is waiting, then a (PHASE_HEARTBEAT, progress)
+        segment whenever the NPU stays silent for HEARTBEAT_SECONDS.
+        """
+        entry = response_cache.get(cache_key) if cache_key else None
+        if entry is not None:
+            scheduler.release(ticket)
+            stats.update(entry["stats"])
+            stats["prompt_eval_time"] = time.time()
+            for phase, text in entry["segments"]:
+                yield phase, text
+            return
+        
+        try:
+            if ticket is not None:
+                timeout = 0 if keepalive else None
+                while not scheduler.wait(ticket, timeout):
+                    yield PHASE_QUEUED, scheduler.estimate(ticket)
+                    timeout = ticket.keepalive
+            
+            # Durations are measured from the moment the NPU was granted
+            start_time = stats["start_time"] = time.time()
+            prompt_token_count = len(prompt_tokens)
+            segments = []
+            heartbeat = HEARTBEAT_SECONDS if keepalive else None
+            for segment in cls.generate_segments(modele_rkllm, prompt_tokens, stats, stop, tracker, tokenizer,
+                                                 heartbeat):
+                if segment[0] == PHASE_HEARTBEAT:
+                    yield PHASE_HEARTBEAT, cls.prefill_progress(modele_rkllm, prompt_token_count, stats)
+                    continue
+                if cache_key:
+                    segments.append(segment)
+                yield segment
+            
+            if stats["prompt_eval_time"] is not None:
+                scheduler.cost_model.observe(cls.cost_model_key(modele_rkllm), prompt_token_count,
+                                             stats["prompt_eval_time"] - start_time, stats["token_count"],
+                                             time.time() - stats["prompt_eval_time"])
+        finally:
+            scheduler.release(ticket)
+        
+        if cache_key:
+            response_cache.put(cache_key, segments, stats, time.time() - start_time)
+
+    @staticmethod
+    def cost_model_key(modele_rkllm):
+        return getattr(modele_rkllm, "model_path", None) or variables.model_id
+
+    @classmethod
+    def prefill_progress(cls, modele_rkllm, prompt_token_count, stats):
+        """Elapsed time and estimated progress of the prefill, None once tokens are generated"""
+        if stats.get("prompt_eval_time") is not None:
+            return None
+        elapsed = time.time() - stats["start_time"]
+        expected = scheduler.cost_model.prefill_seconds(cls.cost_model_key(modele_rkllm), prompt_token_count)
+        return {
+            "elapsed": round(elapsed, 1),
+            # The runtime doesn't report prefill progress, it is estimated from the learned rate
+            "progress": round(min(elapsed / expected, 0.99), 2) if expected > 0 else None
+        }
+
+    @classmethod
+    def estimate_cost(cls, ticket, modele_rkllm, prompt_token_count, options=None):
+        """Set the estimated NPU time of a ticket once the prompt has been tokenized"""
+        if ticket is None:
+            return
+        num_predict = None
+        if isinstance(options, dict):
+            try:
+                num_predict = int(options.get("num_predict", 0))
+            except (ValueError, TypeError):
+                pass
+        ticket.cost = scheduler.cost_model.estimate(cls.cost_model_key(modele_rkllm), prompt_token_count,
+                                                    num_predict)
+
+    @classmethod
+    def handle_streaming(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec, stop=None,
+                         tracker=None, tokenizer=None, think=None, cache_key=None, ticket=None, coalescer=None):
+        """
+        Handle a streaming response, with the chunk templates of the endpoint
+        (`streaming_line` and `format_streaming_chunk`)
+        """
+        coalescer = coalescer or TokenCoalescer()
+        
+        def generate():
+            start_time = time.time()
+            stats = {}
+            complete_text = ""
+            
+            try:
+                for phase, text in cls.cached_segments(cache_key, modele_rkllm, prompt_tokens, stats, stop,
+                                                          tracker, tokenizer, ticket, keepalive=True):
+                    if phase in (PHASE_QUEUED, PHASE_HEARTBEAT):
+                        # Keep-alive while waiting for the NPU (estimated start and completion)
+                        # or during a long prefill (elapsed time and estimated progress)
+                        for content, thinking in coalescer.flush():
+                            yield cls.streaming_line(model_name, content, thinking)
+                        yield cls.heartbeat_line(model_name, phase, text)
+                        continue
+                    parts = cls.split_segment(phase, text, think)
+                    if parts is None:
+                        continue
+                    content, thinking = parts
+                    complete_text += content
+                    for content, thinking in coalescer.add(content, thinking):
+                        yield cls.streaming_line(model_name, content, thinking)
+                for content, thinking in coalescer.flush():
+                    yield cls.streaming_line(model_name, content, thinking)
+            except WorkerCrashedError as e:
+                # The stream has started, report the failure in-band like Ollama does
+                for content, thinking in coalescer.flush():
+                    yield cls.streaming_line(model_name, content, thinking)
+                logger.error(f"Generation failed: {e}")
+                yield f"{json.dumps({'error': str(e)})}\n"
+                return
+            
+            metrics = cls.calculate_durations(stats.get("start_time", start_time), stats["prompt_eval_time"])
+            cls.collect_metrics(metrics, stats, prompt_token_count)
+            
+            format_data = None
+            if format_spec and complete_text:
+                success, parsed_data, error, cleaned_json = validate_format_response(complete_text, format_spec)
+                if success and parsed_data:
+                    format_type = (
+                        format_spec.get("type", "") if isinstance(format_spec, dict) 
+                        else "json"
+                    )
+                    format_data = {
+                        "format_type": format_type,
+                        "parsed": parsed_data,
+                        "cleaned_json": cleaned_json
+                    }
+            
+            final_chunk = cls.format_streaming_chunk(model_name, "", True, metrics, format_data)
+            yield f"{json.dumps(final_chunk)}\n"
+                    
+        response = Response(measure_stream(generate(), coalescer.label), content_type='application/x-ndjson')
+        # Lets the ASGI server await the NPU without tying up a thread
+        response.ticket = ticket
+        return response
+    
+    @classmethod
+    def heartbeat_line(cls, model_name, phase, details=None):
+        """Empty chunk keeping an idle stream alive, with the queue position or prefill progress"""
+        chunk = cls.format_streaming_chunk(model_name, "")
+        if HEARTBEAT_DETAILS and details is not None:
+            chunk["queue" if phase == PHASE_QUEUED else "prefill"] = details
+        return f"{json.dumps(chunk)}\n"
+
+    @staticmethod
+    def split_segment(phase, text, think=None):
+        """
+        Map a generated segment to its (content, thinking) parts in the response.
+
+        Returns None when the segment must not be sent: markers and thinking text
+        when thinking is returned separately (`think=True`) or disabled (`think=False`).
+        Without an explicit `think`, everything is streamed inline as before.
+        """
+        if think is None or phase == PHASE_ANSWER:
+            return text, None
+        if phase == PHASE_THINKING and think:
+            return "", text
+        return None
+
+    @staticmethod
+    def _record_thinking_stats(stats, tracker):
+        stats["thinking_count"] = tracker.thinking_tokens
+        stats["answer_count"] = tracker.answer_tokens
+
 
 class ChatEndpointHandler(EndpointHandler):
     """Handler for /api/chat endpoint requests"""
     
-    @staticmethod
-    def format_streaming_chunk(model_name, token, is_final=False, metrics=None, format_data=None):
+    # Intermediate chunks, serialized without building a dict
+    streaming_line = staticmethod(chat_chunk)
+    
+    @classmethod
+    def format_streaming_chunk(cls, model_name, token, is_final=False, metrics=None, format_data=None, thinking=None):
         """Format a streaming chunk for chat endpoint"""
         chunk = {
             "model": model_name,
-            "created_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "created_at": timestamp(),
             "message": {
                 "role": "assistant",
                 "content": token if not is_final else ""
@@ -90,45 +509,40 @@ class ChatEndpointHandler(EndpointHandler):
             "done": is_final
         }
         
+        if thinking is not None:
+            chunk["message"]["thinking"] = thinking
+        
         if is_final:
-            chunk["done_reason"] = "stop"
+            chunk["done_reason"] = metrics.get("done_reason", "stop") if metrics else "stop"
             if metrics:
-                chunk.update({
-                    "total_duration": metrics["total"],
-                    "load_duration": metrics["load"],
-                    "prompt_eval_count": metrics.get("prompt_tokens", 0),
-                    "prompt_eval_duration": metrics["prompt_eval"],
-                    "eval_count": metrics.get("token_count", 0),
-                    "eval_duration": metrics["eval"]
-                })
+                chunk.update(cls.metrics_fields(metrics))
                 
         return chunk
     
-    @staticmethod
-    def format_complete_response(model_name, complete_text, metrics, format_data=None):
+    @classmethod
+    def format_complete_response(cls, model_name, complete_text, metrics, format_data=None, thinking=None):
         """Format a complete non-streaming response for chat endpoint"""
         response = {
             "model": model_name,
-            "created_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "created_at": timestamp(),
             "message": {
                 "role": "assistant",
                 "content": complete_text if not (format_data and "cleaned_json" in format_data) 
                           else format_data["cleaned_json"]
             },
-            "done_reason": "stop",
-            "done": True,
-            "total_duration": metrics["total"],
-            "load_duration": metrics["load"],
-            "prompt_eval_count": metrics.get("prompt_tokens", 0),
-            "prompt_eval_duration": metrics["prompt_eval"],
-            "eval_count": metrics.get("token_count", 0),
-            "eval_duration": metrics["eval"]
+            "done_reason": metrics.get("done_reason", "stop"),
+            "done": True
         }
         
+        if thinking is not None:
+            response["message"]["thinking"] = thinking
+        
+        response.update(cls.metrics_fields(metrics))
         return response
         
     @classmethod
-    def handle_request(cls, modele_rkllm, model_name, messages, system="", stream=True, format_spec=None, options=None):
+    def handle_request(cls, modele_rkllm, model_name, messages, system="", stream=True, format_spec=None, options=None,
+                       think=None, think_budget=None, ticket=None):
         """Process a chat request with proper format handling"""
         simplified_model_name = get_simplified_model_name(model_name)
         
@@ -147,110 +561,44 @@ class ChatEndpointHandler(EndpointHandler):
                             messages[i]["content"] += format_instruction
                             break
             
-            tokenizer, prompt_tokens, prompt_token_count = cls.prepare_prompt(messages, system)
+            tokenizer, prompt_tokens, prompt_token_count = cls.prepare_prompt(messages, system, think)
+            stop = cls.get_stop_sequences(options)
+            if think_budget is None and isinstance(options, dict):
+                think_budget = options.get("think_budget")
+            tracker = cls.create_thinking_tracker(model_name, tokenizer, prompt_tokens, think, think_budget)
+            cls.estimate_cost(ticket, modele_rkllm, prompt_token_count, options)
+            cache_key = cls.get_cache_key(modele_rkllm, prompt_tokens, options, format_spec, think, think_budget)
             
             if stream:
                 return cls.handle_streaming(modele_rkllm, simplified_model_name, prompt_tokens, 
-                                          prompt_token_count, format_spec)
+                                          prompt_token_count, format_spec, stop, tracker, tokenizer, think,
+                                          cache_key, ticket, TokenCoalescer.from_options(options))
             else:
                 return cls.handle_complete(modele_rkllm, simplified_model_name, prompt_tokens, 
-                                         prompt_token_count, format_spec)
+                                         prompt_token_count, format_spec, stop, tracker, tokenizer, think,
+                                         cache_key, ticket)
         finally:
             variables.system = original_system
             
     @classmethod
-    def handle_streaming(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec):
-        """Handle streaming chat response"""
-        def generate():
-            thread_model = threading.Thread(target=modele_rkllm.run, args=(prompt_tokens,))
-            thread_model.start()
-            
-            count = 0
-            start_time = time.time()
-            prompt_eval_time = None
-            complete_text = ""
-            final_sent = False
-            
-            thread_finished = False
-            
-            while not thread_finished or not final_sent:
-                tokens_processed = False
-                
-                while len(variables.global_text) > 0:
-                    tokens_processed = True
-                    count += 1
-                    token = variables.global_text.pop(0)
-                    
-                    if count == 1:
-                        prompt_eval_time = time.time()
-                    
-                    complete_text += token
-                    
-                    if variables.global_status != 1:
-                        chunk = cls.format_streaming_chunk(model_name, token)
-                        yield f"{json.dumps(chunk)}\n"
-                    else:
-                        pass
-                
-                thread_model.join(timeout=0.005)
-                thread_finished = not thread_model.is_alive()
-                
-                if thread_finished and not final_sent:
-                    final_sent = True
-                    
-                    metrics = cls.calculate_durations(start_time, prompt_eval_time)
-                    metrics["prompt_tokens"] = prompt_token_count
-                    metrics["token_count"] = count
-                    
-                    format_data = None
-                    if format_spec and complete_text:
-                        success, parsed_data, error, cleaned_json = validate_format_response(complete_text, format_spec)
-                        if success and parsed_data:
-                            format_type = (
-                                format_spec.get("type", "") if isinstance(format_spec, dict) 
-                                else "json"
-                            )
-                            format_data = {
-                                "format_type": format_type,
-                                "parsed": parsed_data,
-                                "cleaned_json": cleaned_json
-                            }
-                    
-                    final_chunk = cls.format_streaming_chunk(model_name, "", True, metrics, format_data)
-                    yield f"{json.dumps(final_chunk)}\n"
-                
-                if not tokens_processed:
-                    time.sleep(0.01)
-                    
-        return Response(generate(), content_type='application/x-ndjson')
-    
-    @classmethod
-    def handle_complete(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec):
+    def handle_complete(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec, stop=None,
+                        tracker=None, tokenizer=None, think=None, cache_key=None, ticket=None):
         """Handle complete non-streaming chat response"""
         start_time = time.time()
-        prompt_eval_time = None
-        
-        thread_model = threading.Thread(target=modele_rkllm.run, args=(prompt_tokens,))
-        thread_model.start()
-        
-        count = 0
+        stats = {}
         complete_text = ""
+        thinking_text = ""
         
-        while thread_model.is_alive() or len(variables.global_text) > 0:
-            while len(variables.global_text) > 0:
-                count += 1
-                token = variables.global_text.pop(0)
-                
-                if count == 1:
-                    prompt_eval_time = time.time()
-                
-                complete_text += token
-            
-            thread_model.join(timeout=0.005)
+        for phase, text in cls.cached_segments(cache_key, modele_rkllm, prompt_tokens, stats, stop,
+                                                  tracker, tokenizer, ticket):
+            parts = cls.split_segment(phase, text, think)
+            if parts is None:
+                continue
+            complete_text += parts[0]
+            thinking_text += parts[1] or ""
         
-        metrics = cls.calculate_durations(start_time, prompt_eval_time)
-        metrics["prompt_tokens"] = prompt_token_count
-        metrics["token_count"] = count
+        metrics = cls.calculate_durations(stats.get("start_time", start_time), stats["prompt_eval_time"])
+        cls.collect_metrics(metrics, stats, prompt_token_count)
         
         format_data = None
         if format_spec and complete_text:
@@ -266,60 +614,60 @@ class ChatEndpointHandler(EndpointHandler):
                     "cleaned_json": cleaned_json
                 }
         
-        response = cls.format_complete_response(model_name, complete_text, metrics, format_data)
+        response = cls.format_complete_response(model_name, complete_text, metrics, format_data,
+                                                thinking_text if think else None)
         return jsonify(response), 200
 
 
 class GenerateEndpointHandler(EndpointHandler):
     """Handler for /api/generate endpoint requests"""
     
-    @staticmethod
-    def format_streaming_chunk(model_name, token, is_final=False, metrics=None, format_data=None):
+    # Intermediate chunks, serialized without building a dict
+    streaming_line = staticmethod(generate_chunk)
+    
+    @classmethod
+    def format_streaming_chunk(cls, model_name, token, is_final=False, metrics=None, format_data=None, thinking=None):
         """Format a streaming chunk for generate endpoint"""
         chunk = {
             "model": model_name,
-            "created_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "created_at": timestamp(),
             "response": token if not is_final else "",
             "done": is_final
         }
         
+        if thinking is not None:
+            chunk["thinking"] = thinking
+        
         if is_final:
-            chunk["done_reason"] = "stop"
+            chunk["done_reason"] = metrics.get("done_reason", "stop") if metrics else "stop"
             if metrics:
-                chunk.update({
-                    "total_duration": metrics["total"],
-                    "load_duration": metrics["load"],
-                    "prompt_eval_count": metrics.get("prompt_tokens", 0),
-                    "prompt_eval_duration": metrics["prompt_eval"],
-                    "eval_count": metrics.get("token_count", 0),
-                    "eval_duration": metrics["eval"]
-                })
+                chunk.update(cls.metrics_fields(metrics))
                 
         return chunk
     
-    @staticmethod
-    def format_complete_response(model_name, complete_text, metrics, format_data=None):
+    @classmethod
+    def format_complete_response(cls, model_name, complete_text, metrics, format_data=None, thinking=None):
         """Format a complete non-streaming response for generate endpoint"""
         response = {
             "model": model_name,
-            "created_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "created_at": timestamp(),
             "response": complete_text if not (format_data and "cleaned_json" in format_data) 
                        else format_data["cleaned_json"],
-            "done_reason": "stop",
-            "done": True,
-            "total_duration": metrics["total"],
-            "load_duration": metrics["load"],
-            "prompt_eval_count": metrics.get("prompt_tokens", 0),
-            "prompt_eval_duration": metrics["prompt_eval"],
-            "eval_count": metrics.get("token_count", 0),
-            "eval_duration": metrics["eval"],
-            "context": []
+            "done_reason": metrics.get("done_reason", "stop"),
+            "done": True
         }
         
+        if thinking is not None:
+            response["thinking"] = thinking
+        
+        response.update(cls.metrics_fields(metrics))
+        response["context"] = []
+        
         return response
     
     @classmethod
-    def handle_request(cls, modele_rkllm, model_name, prompt, system="", stream=True, format_spec=None, options=None):
+    def handle_request(cls, modele_rkllm, model_name, prompt, system="", stream=True, format_spec=None, options=None,
+                       think=None, think_budget=None, ticket=None):
         """Process a generate request with proper format handling"""
         messages = [{"role": "user", "content": prompt}]
         
@@ -343,110 +691,44 @@ class GenerateEndpointHandler(EndpointHandler):
                         logger.debug(f"Adding format instruction to prompt: {format_instruction}")
                     messages[0]["content"] += format_instruction
             
-            tokenizer, prompt_tokens, prompt_token_count = cls.prepare_prompt(messages, system)
+            tokenizer, prompt_tokens, prompt_token_count = cls.prepare_prompt(messages, system, think)
+            stop = cls.get_stop_sequences(options)
+            if think_budget is None and isinstance(options, dict):
+                think_budget = options.get("think_budget")
+            tracker = cls.create_thinking_tracker(model_name, tokenizer, prompt_tokens, think, think_budget)
+            cls.estimate_cost(ticket, modele_rkllm, prompt_token_count, options)
+            cache_key = cls.get_cache_key(modele_rkllm, prompt_tokens, options, format_spec, think, think_budget)
             
             if stream:
                 return cls.handle_streaming(modele_rkllm, simplified_model_name, prompt_tokens, 
-                                          prompt_token_count, format_spec)
+                                          prompt_token_count, format_spec, stop, tracker, tokenizer, think,
+                                          cache_key, ticket, TokenCoalescer.from_options(options))
             else:
                 return cls.handle_complete(modele_rkllm, simplified_model_name, prompt_tokens, 
-                                         prompt_token_count, format_spec)
+                                         prompt_token_count, format_spec, stop, tracker, tokenizer, think,
+                                         cache_key, ticket)
         finally:
             variables.system = original_system
     
     @classmethod
-    def handle_streaming(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec):
-        """Handle streaming generate response"""
-        def generate():
-            thread_model = threading.Thread(target=modele_rkllm.run, args=(prompt_tokens,))
-            thread_model.start()
-            
-            count = 0
-            start_time = time.time()
-            prompt_eval_time = None
-            complete_text = ""
-            final_sent = False
-            
-            thread_finished = False
-            
-            while not thread_finished or not final_sent:
-                tokens_processed = False
-                
-                while len(variables.global_text) > 0:
-                    tokens_processed = True
-                    count += 1
-                    token = variables.global_text.pop(0)
-                    
-                    if count == 1:
-                        prompt_eval_time = time.time()
-                    
-                    complete_text += token
-                    
-                    if variables.global_status != 1:
-                        chunk = cls.format_streaming_chunk(model_name, token)
-                        yield f"{json.dumps(chunk)}\n"
-                    else:
-                        pass
-                
-                thread_model.join(timeout=0.005)
-                thread_finished = not thread_model.is_alive()
-                
-                if thread_finished and not final_sent:
-                    final_sent = True
-                    
-                    metrics = cls.calculate_durations(start_time, prompt_eval_time)
-                    metrics["prompt_tokens"] = prompt_token_count
-                    metrics["token_count"] = count
-                    
-                    format_data = None
-                    if format_spec and complete_text:
-                        success, parsed_data, error, cleaned_json = validate_format_response(complete_text, format_spec)
-                        if success and parsed_data:
-                            format_type = (
-                                format_spec.get("type", "") if isinstance(format_spec, dict) 
-                                else "json"
-                            )
-                            format_data = {
-                                "format_type": format_type,
-                                "parsed": parsed_data,
-                                "cleaned_json": cleaned_json
-                            }
-                    
-                    final_chunk = cls.format_streaming_chunk(model_name, "", True, metrics, format_data)
-                    yield f"{json.dumps(final_chunk)}\n"
-                
-                if not tokens_processed:
-                    time.sleep(0.01)
-                    
-        return Response(generate(), content_type='application/x-ndjson')
-    
-    @classmethod
-    def handle_complete(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec):
+    def handle_complete(cls, modele_rkllm, model_name, prompt_tokens, prompt_token_count, format_spec, stop=None,
+                        tracker=None, tokenizer=None, think=None, cache_key=None, ticket=None):
         """Handle complete generate response"""
         start_time = time.time()
-        prompt_eval_time = None
-        
-        thread_model = threading.Thread(target=modele_rkllm.run, args=(prompt_tokens,))
-        thread_model.start()
-        
-        count = 0
+        stats = {}
         complete_text = ""
+        thinking_text = ""
         
-        while thread_model.is_alive() or len(variables.global_text) > 0:
-            while len(variables.global_text) > 0:
-                count += 1
-                token = variables.global_text.pop(0)
-                
-                if count == 1:
-                    prompt_eval_time = time.time()
-                
-                complete_text += token
-            
-            thread_model.join(timeout=0.005)
+        for phase, text in cls.cached_segments(cache_key, modele_rkllm, prompt_tokens, stats, stop,
+                                                  tracker, tokenizer, ticket):
+            parts = cls.split_segment(phase, text, think)
+            if parts is None:
+                continue
+            complete_text += parts[0]
+            thinking_text += parts[1] or ""
         
-        metrics = cls.calculate_durations(start_time, prompt_eval_time)
-        metrics["prompt_tokens"] = prompt_token_count
-        metrics["token_count"] = count
+        metrics = cls.calculate_durations(stats.get("start_time", start_time), stats["prompt_eval_time"])
+        cls.collect_metrics(metrics, stats, prompt_token_count)
         
         format_data = None
         if format_spec and complete_text:
@@ -520,7 +802,8 @@ class GenerateEndpointHandler(EndpointHandler):
                     "cleaned_json": cleaned_json
                 }
         
-        response = cls.format_complete_response(model_name, complete_text, metrics, format_data)
+        response = cls.format_complete_response(model_name, complete_text, metrics, format_data,
+                                                thinking_text if think else None)
         
         if DEBUG_MODE and format_data:
             logger.debug(f"Created formatted response with JSON content")
@@ -528,7 +811,8 @@ class GenerateEndpointHandler(EndpointHandler):
         return jsonify(response), 200
 
 
-def process_ollama_chat_request(modele_rkllm, model_name, messages, system="", stream=True, format_spec=None, options=None):
+def process_ollama_chat_request(modele_rkllm, model_name, messages, system="", stream=True, format_spec=None, options=None,
+                                think=None, think_budget=None, ticket=None):
     """Process /api/chat request with correct format"""
     return ChatEndpointHandler.handle_request(
         modele_rkllm=modele_rkllm,
@@ -537,10 +821,14 @@ def process_ollama_chat_request(modele_rkllm, model_name, messages, system="", s
         system=system,
         stream=stream,
         format_spec=format_spec,
-        options=options
+        options=options,
+        think=think,
+        think_budget=think_budget,
+        ticket=ticket
     )
 
-def process_ollama_generate_request(modele_rkllm, model_name, prompt, system="", stream=True, format_spec=None, options=None):
+def process_ollama_generate_request(modele_rkllm, model_name, prompt, system="", stream=True, format_spec=None, options=None,
+                                    think=None, think_budget=None, ticket=None):
     """Process /api/generate request with correct format"""
     return GenerateEndpointHandler.handle_request(
         modele_rkllm=modele_rkllm,
@@ -549,5 +837,8 @@ def process_ollama_generate_request(modele_rkllm, model_name, prompt, system="",
         system=system,
         stream=stream,
         format_spec=format_spec,
-        options=options
+        options=options,
+        think=think,
+        think_budget=think_budget,
+        ticket=ticket
     )
@@ -0,0 +1,123 @@
+import logging
+
+logger = logging.getLogger("rkllama.stop_sequences")
+
+
+def normalize_stop_sequences(stop):
+    """
+    Normalize the Ollama `options.stop` value into a list of non-empty strings
+
+    Args:
+        stop: A string, a list of strings or None
+
+    Returns:
+        List of stop sequences (possibly empty)
+    """
+    if not stop:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, (list, tuple)):
+        logger.warning(f"Ignoring invalid stop option: {stop!r}")
+        return []
+    return [s for s in stop if isinstance(s, str) and s]
+
+
+class StopSequenceMatcher:
+    """
+    Streaming multi-pattern matcher for stop sequences (Aho-Corasick automaton).
+
+    Text is fed chunk by chunk as the model decodes it. Matches split across
+    chunks are detected, and only the shortest suffix that could still be the
+    beginning of a stop sequence is held back from the output.
+    """
+
+    def __init__(self, stop_sequences):
+        self.stop_sequences = normalize_stop_sequences(stop_sequences)
+        # Automaton tables, one entry per node (node 0 is the root)
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._match = [0]  # Length of the longest stop sequence ending at this node
+
+        for sequence in self.stop_sequences:
+            self._add(sequence)
+        self._build()
+
+        self.state = 0
+        self.pending = ""
+        self.stopped = False
+        self.matched = None
+        self.remainder = ""
+
+    def _add(self, sequence):
+        node = 0
+        for char in sequence:
+            if char not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[node] + 1)
+                self._match.append(0)
+                self._goto[node][char] = len(self._goto) - 1
+            node = self._goto[node][char]
+        self._match[node] = max(self._match[node], len(sequence))
+
+    def _build(self):
+        # Breadth-first traversal to compute failure links
+        queue = list(self._goto[0].values())
+        while queue:
+            node = queue.pop(0)
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._match[child] = max(self._match[child], self._match[self._fail[child]])
+
+    def _step(self, char):
+        node = self.state
+        while node and char not in self._goto[node]:
+            node = self._fail[node]
+        self.state = self._goto[node].get(char, 0)
+
+    def feed(self, text):
+        """
+        Feed decoded text and return the part that is safe to emit.
+
+        Once a stop sequence completes, `stopped` is set and the returned text
+        ends right before the stop sequence. The input that followed the match
+        is kept in `remainder`; further input is ignored.
+        """
+        if self.stopped or not text:
+            return ""
+        if not self.stop_sequences:
+            return text
+
+        self.pending += text
+        # `pending` always holds exactly the characters of the current automaton depth
+        offset = len(self.pending) - len(text)
+        for index, char in enumerate(text):
+            self._step(char)
+            match_length = self._match[self.state]
+            if match_length:
+                end = offset + index + 1
+                self.stopped = True
+                self.matched = self.pending[end - match_length:end]
+                self.remainder = text[index + 1:]
+                emitted = self.pending[:end - match_length]
+                self.pending = ""
+                return emitted
+
+        keep = self._depth[self.state]
+        emitted = self.pending[:len(self.pending) - keep]
+        self.pending = self.pending[len(self.pending) - keep:]
+        return emitted
+
+    def flush(self):
+        """Return any held-back text once the stream has ended without a match"""
+        if self.stopped:
+            return ""
+        emitted, self.pending = self.pending, ""
+        return emitted
@@ -0,0 +1,135 @@
+import logging
+from . import special_tokens
+from .stop_sequences import StopSequenceMatcher
+
+logger = logging.getLogger("rkllama.thinking")
+
+# Markers emitted as plain text by most reasoning models (DeepSeek-R1 distills, Qwen3, ...)
+DEFAULT_THINKING_MARKERS = ("<think>", "</think>")
+
+# Segment phases produced by ThinkingTracker
+PHASE_THINKING = "thinking"
+PHASE_ANSWER = "answer"
+PHASE_MARKER = "marker"
+
+
+def get_thinking_markers(model_name):
+    """
+    Get the (begin, end) thinking marker pairs for a model
+
+    Args:
+        model_name: Model directory name or simplified name
+
+    Returns:
+        List of (begin_of_thinking, end_of_thinking) tuples
+    """
+    markers = [DEFAULT_THINKING_MARKERS]
+    name = (model_name or "").lower().replace("-", "_")
+
+    # Most specific family first: deepseek_v3 before deepseek
+    for family in sorted(special_tokens.models, key=len, reverse=True):
+        if family not in name:
+            continue
+        tokens = special_tokens.models[family]
+        # Only families with a dedicated end-of-thinking marker can be tracked
+        if tokens.get("bot") and tokens.get("eot") and "thinking" in tokens["eot"]:
+            markers.append((tokens["bot"], tokens["eot"]))
+        break
+
+    return markers
+
+
+def prompt_opens_thinking(tokenizer, prompt_tokens, markers):
+    """Check if the chat template already opened a thinking block at the end of the prompt"""
+    try:
+        tail = tokenizer.decode(prompt_tokens[-8:]).rstrip()
+    except Exception:
+        return False
+    return any(tail.endswith(begin) for begin, _ in markers)
+
+
+class ThinkingTracker:
+    """
+    Splits a decoded stream into thinking and answer phases.
+
+    Text is fed as it is generated and returned as (phase, text) segments, where
+    phase is PHASE_THINKING, PHASE_ANSWER or PHASE_MARKER (the markers themselves).
+    Markers split across tokens are handled by holding back partial matches.
+    Token counts per phase are kept to enforce an optional thinking budget.
+    """
+
+    def __init__(self, markers, starts_thinking=False, budget=None):
+        self.markers = markers
+        self.active_markers = markers[0]
+        self.phase = PHASE_THINKING if starts_thinking else PHASE_ANSWER
+        self.thinking_done = False
+        self.budget = budget
+        self.thinking_tokens = 0
+        self.answer_tokens = 0
+        self._matcher = self._new_matcher()
+
+    def _new_matcher(self):
+        if self.phase == PHASE_THINKING:
+            return StopSequenceMatcher([end for _, end in self.markers])
+        if self.thinking_done:
+            # A single thinking block per answer, the rest is passed through
+            return StopSequenceMatcher([])
+        return StopSequenceMatcher([begin for begin, _ in self.markers])
+
+    def _switch_phase(self, marker):
+        if self.phase == PHASE_THINKING:
+            self.phase = PHASE_ANSWER
+            self.thinking_done = True
+        else:
+            self.phase = PHASE_THINKING
+            self.active_markers = next((pair for pair in self.markers if pair[0] == marker), self.markers[0])
+        self._matcher = self._new_matcher()
+
+    def feed(self, text):
+        """Feed decoded text and return the list of (phase, text) segments ready to emit"""
+        segments = []
+        while text:
+            emitted = self._matcher.feed(text)
+            if emitted:
+                segments.append((self.phase, emitted))
+            if not self._matcher.stopped:
+                break
+            marker, text = self._matcher.matched, self._matcher.remainder
+            segments.append((PHASE_MARKER, marker))
+            self._switch_phase(marker)
+        return segments
+
+    def count_tokens(self, count):
+        """Attribute newly generated tokens to the current phase"""
+        if self.phase == PHASE_THINKING:
+            self.thinking_tokens += count
+        else:
+            self.answer_tokens += count
+
+    def budget_exhausted(self):
+        """True when the model is still thinking and has used up its thinking budget"""
+        return (self.phase == PHASE_THINKING and self.budget is not None
+                and self.thinking_tokens >= self.budget)
+
+    def end_thinking(self):
+        """
+        Force the end of the thinking phase.
+
+        Returns the held-back thinking text and the end-of-thinking marker as
+        segments, along with the marker text to feed back to the model.
+        """
+        segments = []
+        pending = self._matcher.flush()
+        if pending:
+            segments.append((PHASE_THINKING, pending))
+        marker = self.active_markers[1]
+        segments.append((PHASE_MARKER, marker))
+        self.phase = PHASE_ANSWER
+        self.thinking_done = True
+        self._matcher = self._new_matcher()
+        return segments, marker
+
+    def flush(self):
+        """Return the held-back text once generation has ended"""
+        pending = self._matcher.flush()
+        return [(self.phase, pending)] if pending else []
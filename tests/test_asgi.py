@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import unittest
+
+from werkzeug.wrappers import Response
+
+from src.asgi import AsgiApp
+from src.inflight import SharedStream
+
+# Idle streaming connections opened at once, like a busy Open WebUI instance
+IDLE_STREAMS = 150
+
+
+def shared_response(stream, offset=0):
+    """Response of a coalesced or resumed stream, as returned by the Flask views"""
+    response = Response(stream.subscribe(offset), content_type="application/x-ndjson")
+    response.shared_stream = stream
+    response.offset = offset
+    return response
+
+
+class SharedStreamConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = AsgiApp(flask_app=None, worker_threads=4)
+
+    def tearDown(self):
+        self.app.workers.shutdown(wait=False)
+        self.app.npu_executor.shutdown(wait=False)
+
+    def open_streams(self, stream, count):
+        bodies = [[] for _ in range(count)]
+        disconnects = [asyncio.Event() for _ in range(count)]
+        tasks = []
+        for body, disconnected in zip(bodies, disconnects):
+            async def send(message, body=body):
+                body.append(message.get("body", b""))
+            tasks.append(asyncio.ensure_future(
+                self.app.stream_shared(shared_response(stream), send, disconnected)))
+        return bodies, disconnects, tasks
+
+    def test_idle_streams_hold_no_thread(self):
+        async def scenario():
+            stream = SharedStream()
+            threads = threading.active_count()
+            bodies, _, tasks = self.open_streams(stream, IDLE_STREAMS)
+            await asyncio.sleep(0.2)
+
+            self.assertEqual(stream.subscribers, IDLE_STREAMS)
+            self.assertEqual(threading.active_count(), threads)
+            self.assertTrue(all(not task.done() for task in tasks))
+
+            def produce():
+                for i in range(3):
+                    stream.append(f'{{"response": "{i}"}}\n')
+                stream.finish()
+
+            producer = threading.Thread(target=produce)
+            producer.start()
+            await asyncio.wait_for(asyncio.gather(*tasks), 10)
+            producer.join()
+
+            expected = b"".join(f'{{"response": "{i}"}}\n'.encode() for i in range(3))
+            for body in bodies:
+                self.assertEqual(b"".join(body), expected)
+            self.assertEqual(stream.subscribers, 0)
+
+        asyncio.run(scenario())
+
+    def test_disconnect_leaves_an_idle_stream(self):
+        async def scenario():
+            stream = SharedStream()
+            stream.append("buffered\n")
+            bodies, disconnects, tasks = self.open_streams(stream, 10)
+            await asyncio.sleep(0.1)
+            self.assertTrue(all(body == [b"buffered\n"] for body in bodies))
+
+            for disconnected in disconnects:
+                disconnected.set()
+            await asyncio.wait_for(asyncio.gather(*tasks), 10)
+            # Nobody waits for the next chunk, the producer may stop after the grace period
+            self.assertEqual(stream.subscribers, 0)
+            self.assertTrue(stream.abandoned)
+
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import hashlib
+import http.server
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src import downloader, metrics
+from src.downloader import Download, DownloadError
+
+SIZE = 1024 * 1024
+SEGMENT_SIZE = 256 * 1024
+# Bytes of a range sent before the stand-in drops the connection, in the middle of a segment
+DROP_AFTER = 100 * 1024
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send_headers(self, status, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", f'"{self.server.etag}"')
+        self.send_header("Accept-Ranges", "bytes")
+
+    def do_HEAD(self):
+        self.send_headers(200, len(self.server.data))
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = 0, len(data) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or end)
+        with self.server.lock:
+            self.server.ranges.append((start, end))
+            drop_after, self.server.drop_after = self.server.drop_after, None
+
+        self.send_headers(206 if match else 200, end - start + 1)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+
+        position = start
+        while position <= end:
+            count = min(16 * 1024, end + 1 - position)
+            if drop_after is not None:
+                if drop_after <= 0:
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                count = min(count, drop_after)
+                drop_after -= count
+            self.wfile.write(data[position:position + count])
+            position += count
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """Local HTTP server of a model file, serving ranges and dropping a connection on demand"""
+
+    daemon_threads = True
+
+    def __init__(self, data):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.data = data
+        self.drop_after = None
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    @property
+    def etag(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/model.rkllm"
+
+    @property
+    def requested(self):
+        """Bytes asked for by the range requests received"""
+        return sum(end + 1 - start for start, end in self.ranges)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(SIZE)
+        self.server = StandIn(self.data)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.directory.name, "model.rkllm")
+        patcher = mock.patch.object(downloader, "MIN_SEGMENT_SIZE", SEGMENT_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def download(self, **kwargs):
+        kwargs.setdefault("retries", 0)
+        download = Download(self.server.url, self.destination, connections=4, buffer_size=32 * 1024,
+                            timeout=5, **kwargs)
+        download.start().wait()
+        return download
+
+    def read_destination(self):
+        with open(self.destination, "rb") as f:
+            return f.read()
+
+    def test_parallel_ranges(self):
+        download = self.download()
+        self.assertIsNone(download.error)
+        self.assertEqual(self.read_destination(), self.data)
+        self.assertTrue(download.verified)
+        self.assertEqual(sorted(self.server.ranges), [(start, start + SEGMENT_SIZE - 1)
+                                                      for start in range(0, SIZE, SEGMENT_SIZE)])
+        self.assertFalse(os.path.exists(download.part_path))
+        self.assertFalse(os.path.exists(download.state_path))
+
+    def test_retry_after_dropped_connection(self):
+        retries = metrics.get_counter("download.retries")
+        self.server.drop_after = DROP_AFTER
+        download = self.download(retries=2)
+        self.assertIsNone(download.error)
+        self.assertEqual(self.read_destination(), self.data)
+        self.assertEqual(metrics.get_counter("download.retries"), retries + 1)
+        # The retry continues the segment where the connection was dropped
+        self.assertTrue(any(start % SEGMENT_SIZE for start, _ in self.server.ranges))
+        self.assertLess(self.server.requested, SIZE + SEGMENT_SIZE)
+
+    def test_resume_from_part_file(self):
+        self.server.drop_after = DROP_AFTER
+        failed = self.download()
+        self.assertIsInstance(failed.error, DownloadError)
+        self.assertFalse(os.path.exists(self.destination))
+        with open(failed.state_path, "r") as f:
+            state = json.load(f)
+        saved = sum(written for _, _, written in state["segments"])
+        self.assertEqual(state["etag"], self.server.etag)
+        self.assertTrue(0 < saved < SIZE)
+
+        self.server.ranges = []
+        download = self.download()
+        self.assertIsNone(download.error)
+        self.assertEqual(download.resumed, saved)
+        self.assertEqual(self.server.requested, SIZE - saved)
+        self.assertEqual(self.read_destination(), self.data)
+
+    def test_etag_change_restarts(self):
+        self.server.drop_after = DROP_AFTER
+        self.assertIsNotNone(self.download().error)
+
+        # The remote file changed, the partial one can't be completed with it
+        self.server.data = os.urandom(SIZE)
+        self.server.ranges = []
+        download = self.download()
+        self.assertIsNone(download.error)
+        self.assertEqual(download.resumed, 0)
+        self.assertEqual(self.server.requested, SIZE)
+        self.assertEqual(self.read_destination(), self.server.data)
+
+    def test_sha256_mismatch(self):
+        download = self.download(sha256="0" * 64)
+        self.assertIn("SHA-256 mismatch", str(download.error))
+        # A corrupt file is not resumed
+        self.assertFalse(os.path.exists(download.part_path))
+        self.assertFalse(os.path.exists(download.state_path))
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_atomic_replace(self):
+        with open(self.destination, "wb") as f:
+            f.write(b"previous model")
+        replace = os.replace
+        replaced = []
+
+        def record(source, destination):
+            if destination == self.destination:
+                replaced.append((source, self.read_destination()))
+            replace(source, destination)
+
+        with mock.patch.object(downloader.os, "replace", side_effect=record):
+            download = self.download()
+        self.assertIsNone(download.error)
+        # The previous file stays whole until the verified one takes its place
+        self.assertEqual(replaced, [(download.part_path, b"previous model")])
+        self.assertEqual(self.read_destination(), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()